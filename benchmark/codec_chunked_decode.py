@@ -0,0 +1,87 @@
+"""SoundStream.decode_chunked vs decode on long codes: equivalence, peak memory, time.
+
+Decodes the (8, T) stage 2 codes in --codes (random codes of --seconds
+seconds if not given) in full and in chunks, and fails if any sample differs
+by more than --atol, so it doubles as a test that the chunks join without
+seams. Only the decoder part of the codec is loaded. Run from src/yue:
+
+    cd src/yue && python ../../benchmark/codec_chunked_decode.py --seconds 240
+    cd src/yue && python ../../benchmark/codec_chunked_decode.py --codes output/stage2/vtrack.npy
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from models.soundstream_hubert_new import SoundStreamDecoder  # noqa: E402
+from omegaconf import OmegaConf  # noqa: E402
+
+
+def load_decoder(config_path: str, checkpoint_path: str, device: torch.device) -> SoundStreamDecoder:
+    config = OmegaConf.load(config_path)
+    codec = SoundStreamDecoder(**config.generator.config)
+    state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    codec.load_state_dict(state_dict["codec_model"])
+    return codec.to(device).eval()
+
+
+def timed(device: torch.device, fn):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    result = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        peak = f"{torch.cuda.max_memory_allocated(device) / 2**30:.2f} GB"
+    else:
+        peak = "n/a"
+    return result, time.perf_counter() - start, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--basic_model_config", default="./xcodec_mini_infer/final_ckpt/config.yaml")
+    parser.add_argument("--resume_path", default="./xcodec_mini_infer/final_ckpt/ckpt_00360000.pth")
+    parser.add_argument("--codes", type=str, default="", help="Stage 2 .npy output to decode.")
+    parser.add_argument("--seconds", type=float, default=180)
+    parser.add_argument("--chunk_frames", type=int, default=1500)
+    parser.add_argument("--context_frames", type=int, default=16)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument("--skip_full", action="store_true")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    codec = load_decoder(args.basic_model_config, args.resume_path, device)
+    if args.codes:
+        codes = np.load(args.codes).astype(np.int16)
+    else:
+        codes = np.random.default_rng(0).integers(0, 1024, (8, int(args.seconds * 50)))
+    # (8, T) -> (n_q=8, batch=1, T), as post-processing decodes them
+    codes = torch.as_tensor(codes, dtype=torch.long).unsqueeze(1).to(device)
+
+    with torch.no_grad():
+        chunked, chunked_time, chunked_peak = timed(
+            device,
+            lambda: codec.decode_chunked(codes, args.chunk_frames, args.context_frames),
+        )
+        print(f"chunked  {chunked_time:7.2f}s  peak {chunked_peak}  {chunked.shape[-1]} samples")
+        if args.skip_full:
+            return
+        full, full_time, full_peak = timed(device, lambda: codec.decode(codes))
+        print(f"full     {full_time:7.2f}s  peak {full_peak}  {full.shape[-1]} samples")
+
+    assert chunked.shape == full.shape, f"{tuple(chunked.shape)} != {tuple(full.shape)}"
+    diff = (chunked - full).abs().max().item()
+    print(f"max abs difference {diff:.2e}")
+    if diff > args.atol:
+        sys.exit(f"chunked decode differs from decode by more than {args.atol}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""SoundStream.encode_chunked vs encode on long audio: token agreement, peak memory, time.
+
+The --audio files are looped to --seconds, then encoded in full (unless
+--skip_full, e.g. when it runs out of memory) and in chunks. Agreement is
+reported over all frames and over the frames within --boundary frames of a
+chunk boundary, where the chunked semantic model misses the most context.
+Run from src/yue, where the codec finds its semantic model:
+
+    cd src/yue && python ../../benchmark/codec_chunked_encode.py --seconds 240
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torchaudio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from models.soundstream_hubert_new import SoundStream  # noqa: E402
+from omegaconf import OmegaConf  # noqa: E402
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_codec(config_path: str, checkpoint_path: str, device: torch.device) -> SoundStream:
+    config = OmegaConf.load(config_path)
+    codec = SoundStream(**config.generator.config)
+    state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=False)
+    codec.load_state_dict(state_dict["codec_model"])
+    return codec.to(device).eval()
+
+
+def load_audio(path: str) -> torch.Tensor:
+    audio, sr = torchaudio.load(path)
+    return torchaudio.functional.resample(audio.mean(dim=0, keepdim=True), sr, 16000)
+
+
+def timed(device: torch.device, fn):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    result = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        peak = f"{torch.cuda.max_memory_allocated(device) / 2**30:.2f} GB"
+    else:
+        peak = "n/a"
+    return result, time.perf_counter() - start, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--basic_model_config", default="./xcodec_mini_infer/final_ckpt/config.yaml")
+    parser.add_argument("--resume_path", default="./xcodec_mini_infer/final_ckpt/ckpt_00360000.pth")
+    parser.add_argument(
+        "--audio",
+        nargs="+",
+        default=[os.path.join(BENCHMARK_DIR, f"test{i}.mp3") for i in range(1, 5)],
+    )
+    parser.add_argument("--seconds", type=float, default=180)
+    parser.add_argument("--chunk_frames", type=int, default=1500)
+    parser.add_argument("--context_frames", type=int, default=250)
+    parser.add_argument("--boundary", type=int, default=25, help="Frames on each side of a boundary.")
+    parser.add_argument("--skip_full", action="store_true")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    codec = load_codec(args.basic_model_config, args.resume_path, device)
+    audio = torch.cat([load_audio(path) for path in args.audio], dim=-1)
+    n_samples = int(args.seconds * 16000)
+    audio = audio.repeat(1, n_samples // audio.shape[-1] + 1)[:, :n_samples]
+    x = audio.unsqueeze(0).to(device)
+
+    with torch.no_grad():
+        chunked, chunked_time, chunked_peak = timed(
+            device,
+            lambda: codec.encode_chunked(x, 0.5, args.chunk_frames, args.context_frames),
+        )
+        print(f"chunked  {chunked_time:7.2f}s  peak {chunked_peak}  {chunked.shape[-1]} frames")
+        if args.skip_full:
+            return
+        full, full_time, full_peak = timed(device, lambda: codec.encode(x, 0.5))
+        print(f"full     {full_time:7.2f}s  peak {full_peak}  {full.shape[-1]} frames")
+
+    same = (full == chunked).all(dim=0)[0].cpu()
+    near = torch.zeros_like(same)
+    for boundary in range(args.chunk_frames, same.shape[0], args.chunk_frames):
+        near[max(boundary - args.boundary, 0) : boundary + args.boundary] = True
+    print(f"agreement {same.float().mean():.4f} overall", end="")
+    if near.any():
+        print(
+            f", {same[near].float().mean():.4f} near chunk boundaries"
+            f", {same[~near].float().mean():.4f} elsewhere"
+        )
+    else:
+        print(" (a single chunk, identical to encode)")
+
+
+if __name__ == "__main__":
+    main()
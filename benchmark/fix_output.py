@@ -0,0 +1,96 @@
+"""Microbenchmark of Stage2Pipeline.fix_output against the previous Counter loop.
+
+Checks that both give identical outputs on random tracks with different
+rates of invalid codes and on edge cases (ties, rows where an invalid value is
+the most frequent, rows with no valid code, batched tracks), then times them on
+--seconds of 50 Hz codes.
+
+    python benchmark/fix_output.py --seconds 180
+"""
+
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from infer_stage2 import Stage2Pipeline  # noqa: E402
+
+
+def fix_output_reference(output):
+    """The previous Stage2Pipeline.fix_output."""
+    fixed_output = copy.deepcopy(output)
+    for i, line in enumerate(output):
+        for j, element in enumerate(line):
+            if element < 0 or element > 1023:
+                counter = Counter(line)
+                most_frequant = sorted(
+                    counter.items(), key=lambda x: x[1], reverse=True
+                )[0][0]
+                fixed_output[i, j] = most_frequant
+    return fixed_output
+
+
+def fix_output(output):
+    return Stage2Pipeline.fix_output(None, output)
+
+
+def random_track(rng, n_frames: int, invalid_rate: float, n_codes: int = 1024):
+    output = rng.integers(0, n_codes, (8, n_frames))
+    invalid = rng.random((8, n_frames)) < invalid_rate
+    output[invalid] = rng.choice([-1, 1024, 2047, -45334], invalid.sum())
+    return output
+
+
+def edge_cases(rng):
+    yield "ties", random_track(rng, 40, 0.1, n_codes=4)
+    yield "invalid mode", np.where(rng.random((8, 50)) < 0.6, -1, rng.integers(0, 1024, (8, 50)))
+    yield "invalid tie", np.array([[-1, 5, -1, 5, 7, 1024, 1024, 1024, 5, -1]] * 8)
+    yield "no valid code", rng.choice([-1, 1024, 5000], (8, 30))
+    yield "all valid", random_track(rng, 30, 0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=180.0)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    failed = False
+    for name, output in edge_cases(rng):
+        ok = np.array_equal(fix_output(output), fix_output_reference(output))
+        failed |= not ok
+        print(f"{name:<16}{'ok' if ok else 'MISMATCH'}")
+
+    batch = np.stack([random_track(rng, 200, 0.05) for _ in range(4)])
+    ok = np.array_equal(fix_output(batch), np.stack([fix_output_reference(t) for t in batch]))
+    failed |= not ok
+    print(f"{'batched (4,8,T)':<16}{'ok' if ok else 'MISMATCH'}")
+
+    n_frames = int(args.seconds * 50)
+    print(f"\n(8, {n_frames}) track{'invalid':>10}{'previous ms':>14}{'numpy ms':>11}{'speedup':>10}")
+    for invalid_rate in [0.0, 0.0001, 0.001, 0.01]:
+        output = random_track(rng, n_frames, invalid_rate)
+        start = time.perf_counter()
+        reference = fix_output_reference(output)
+        reference_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(10):
+            fixed = fix_output(output)
+        numpy_time = (time.perf_counter() - start) / 10
+        ok = np.array_equal(fixed, reference)
+        failed |= not ok
+        print(
+            f"{'':<15}{invalid_rate:>10.2%}{reference_time * 1000:>14.1f}"
+            f"{numpy_time * 1000:>11.2f}{reference_time / numpy_time:>9.0f}x"
+            f"{'' if ok else '  MISMATCH'}"
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""CPU throughput of the GGUF (llama.cpp) stage 1 and stage 2 backends.
+
+Stage 1 is measured as prompt prefill and CFG decode (conditional and
+unconditional sequence per token), stage 2 as one teacher-forced 300 frame
+window through Stage2Pipeline_GGUF. Without model files a small random Llama
+is converted with convert_gguf.py, which only exercises the plumbing.
+
+    python benchmark/gguf_throughput.py --stage1_model s1.Q8_0.gguf --stage2_model s2.Q8_0.gguf --threads 8 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from gguf_context import GGUFContext  # noqa: E402
+from infer_stage2 import Stage2Pipeline_GGUF  # noqa: E402
+
+CODEBOOK0_BEGIN = 45334
+
+
+def random_gguf(path: str, outtype: str):
+    from convert_gguf import write_gguf
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=16384,
+    )
+    write_gguf(LlamaForCausalLM(config).eval(), path, outtype)
+
+
+def bench_stage1(model_path, threads, cache_mode, prompt_len, new_tokens):
+    rng = np.random.default_rng(0)
+    context = GGUFContext(model_path, prompt_len + new_tokens + 1, threads, cache_mode)
+    uncond_context = GGUFContext(model_path, new_tokens + 2, threads, cache_mode)
+    prompt = rng.integers(CODEBOOK0_BEGIN, CODEBOOK0_BEGIN + 1024, prompt_len)
+
+    start = time.perf_counter()
+    logits = context.eval(prompt)
+    uncond_context.eval(prompt[-1:])
+    prefill_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(new_tokens):
+        token = int(logits[CODEBOOK0_BEGIN : CODEBOOK0_BEGIN + 1024].argmax()) + CODEBOOK0_BEGIN
+        logits = context.eval([token])
+        uncond_context.eval([token])
+    decode_time = time.perf_counter() - start
+    return prompt_len / prefill_time, new_tokens / decode_time
+
+
+def bench_stage2(model_path, threads, cache_mode, frames):
+    pipeline = Stage2Pipeline_GGUF(
+        model_path, torch.device("cpu"), cache_mode=cache_mode, n_threads=threads
+    )
+    rng = np.random.default_rng(0)
+    codec_ids = rng.integers(CODEBOOK0_BEGIN, CODEBOOK0_BEGIN + 1024, frames)
+    start = time.perf_counter()
+    output = pipeline.generate_window(codec_ids)
+    elapsed = time.perf_counter() - start
+    assert output.shape[0] == frames * 8
+    return frames / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stage1_model", type=str, default="")
+    parser.add_argument("--stage2_model", type=str, default="")
+    parser.add_argument("--outtype", type=str, default="q8_0", help="Type of the random model.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[None])
+    parser.add_argument("--cache_mode", type=str, default="FP16")
+    parser.add_argument("--prompt_len", type=int, default=1024)
+    parser.add_argument("--new_tokens", type=int, default=256)
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not args.stage1_model or not args.stage2_model:
+            random_model = os.path.join(tmp_dir, f"random.{args.outtype}.gguf")
+            random_gguf(random_model, args.outtype)
+        stage1_model = args.stage1_model or random_model
+        stage2_model = args.stage2_model or random_model
+
+        print(
+            f"{'threads':>8}{'s1 prefill tok/s':>18}{'s1 cfg decode tok/s':>21}"
+            f"{'s2 frames/s':>13}{'s2 realtime x':>15}"
+        )
+        for threads in args.threads:
+            prefill, decode = bench_stage1(
+                stage1_model, threads, args.cache_mode, args.prompt_len, args.new_tokens
+            )
+            frames_per_s = bench_stage2(stage2_model, threads, args.cache_mode, args.frames)
+            # Stage 1 emits 2 tokens and stage 2 decodes 2 tracks per 50 Hz frame
+            print(
+                f"{str(threads or 'auto'):>8}{prefill:>18.1f}{decode:>21.1f}"
+                f"{frames_per_s:>13.1f}{frames_per_s / 2 / 50:>15.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""KV cache memory versus decode speed of the HF stage 1 cache modes.
+
+Runs greedy generate() on a tiny randomly initialised Llama on CPU with each
+--stage1_cache_mode and reports the bytes held by the KV cache after
+generation, decode tokens/s and how many greedy tokens match FP16. FP16 is
+the unquantized cache in the model dtype (float32 here).
+
+    python benchmark/hf_kv_cache_modes.py --prompt_len 1024 --new_tokens 512
+
+Q4 needs `optimum-quanto`, Q6/Q8 need `hqq`; unavailable modes are skipped.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from common import get_hf_cache_kwargs  # noqa: E402
+
+
+def tensor_nbytes(obj, seen=None) -> int:
+    """Bytes of all tensors reachable from obj, quantized tensor subclasses included."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, torch.Tensor):
+        if hasattr(obj, "__tensor_flatten__"):
+            names, _ = obj.__tensor_flatten__()
+            return sum(tensor_nbytes(getattr(obj, name), seen) for name in names)
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_nbytes(x, seen) for x in obj)
+    if isinstance(obj, dict):
+        return sum(tensor_nbytes(x, seen) for x in obj.values())
+    if hasattr(obj, "__dict__") and not isinstance(obj, type):
+        return sum(tensor_nbytes(x, seen) for x in vars(obj).values())
+    return 0
+
+
+def run(model, input_ids, new_tokens, cache_mode):
+    kwargs = dict(
+        max_new_tokens=new_tokens,
+        min_new_tokens=new_tokens,
+        do_sample=False,
+        return_dict_in_generate=True,
+        **get_hf_cache_kwargs(cache_mode),
+    )
+    with torch.no_grad():
+        # Prefill-only run, so the timed run below is dominated by decode
+        start = time.perf_counter()
+        model.generate(input_ids, **dict(kwargs, max_new_tokens=1, min_new_tokens=1))
+        prefill_time = time.perf_counter() - start
+        start = time.perf_counter()
+        out = model.generate(input_ids, **kwargs)
+        total_time = time.perf_counter() - start
+    decode_time = max(total_time - prefill_time, 1e-9)
+    return out.sequences[0, input_ids.shape[-1] :], tensor_nbytes(out.past_key_values), new_tokens / decode_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt_len", type=int, default=1024)
+    parser.add_argument("--new_tokens", type=int, default=512)
+    parser.add_argument("--hidden_size", type=int, default=512)
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--num_heads", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--modes", type=str, nargs="+", default=["FP16", "Q8", "Q6", "Q4"])
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=32000,
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 2,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=args.num_heads,
+        num_key_value_heads=args.num_heads,
+        max_position_embeddings=args.prompt_len + args.new_tokens,
+    )
+    model = LlamaForCausalLM(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (1, args.prompt_len))
+
+    reference = None
+    print(f"{'mode':<6}{'kv MiB':>10}{'tokens/s':>12}{'match FP16':>12}")
+    for cache_mode in args.modes:
+        try:
+            tokens, nbytes, tokens_per_s = run(model, input_ids, args.new_tokens, cache_mode)
+        except (ImportError, ValueError) as e:
+            print(f"{cache_mode:<6}skipped: {e}")
+            continue
+        if reference is None and cache_mode == "FP16":
+            reference = tokens
+        match = (
+            f"{(tokens == reference).float().mean().item():.1%}" if reference is not None else "-"
+        )
+        print(f"{cache_mode:<6}{nbytes / 2**20:>10.2f}{tokens_per_s:>12.1f}{match:>12}")
+
+
+if __name__ == "__main__":
+    main()
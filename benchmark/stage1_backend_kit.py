@@ -0,0 +1,257 @@
+"""Conformance and speed kit for the stage 1 backends (src/yue/stage1_backends.py).
+
+Every backend is driven through the backend protocol only, the way
+Stage1Pipeline.generate drives it, and compared with a cache-free fp32
+reference: a plain LlamaForCausalLM forward of the whole sequence for the
+conditional row, and of the tokens from the segment's last prompt token on
+for the unconditional row, at every step.
+
+    cfg      teacher-forced CFG decode of the reference's greedy tokens; the
+             log-probs of both rows and the argmax of the CFG mix must match
+    segment  a second segment prompt restarts the CFG row at its last token
+    trim     rolling back to a snapshot and decoding again gives the same logits
+    speed    prefill and CFG decode tokens/s, timed on a second pass after an
+             untimed warm-up, so compiled backends are measured without compiling
+
+Log-prob differences must stay within --atol, or within the backend's entry
+of ATOL when it is not given: a Q4 cache alone moves the log-probs by about
+0.06 on the random model.
+
+Without --hf_model a small random Llama is built (and converted to GGUF), which
+checks the plumbing on CPU in a few seconds. With real models:
+
+    python benchmark/stage1_backend_kit.py --hf_model m-a-p/YuE-s1-7B-anneal-en-cot \\
+        --gguf_model s1.Q8_0.gguf --backends hf_bf16 gguf gguf_Q8 --atol 0.5
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from stage1_backends import (  # noqa: E402
+    Stage1Backend_EXL2,
+    Stage1Backend_GGUF,
+    Stage1Backend_HF,
+)
+
+LOGITS_BEGIN = 32002
+LOGITS_END = 56722
+CODEC_BEGIN = 45334
+CFG_SCALE = 1.5
+
+# Max log-prob difference per backend when --atol is not given
+DEFAULT_ATOL = 0.05
+ATOL = {"hf_Q4": 0.1}
+
+BACKENDS = {
+    "hf_bf16": lambda a: Stage1Backend_HF(
+        a.hf_model, a.device, compile=False, dtype=torch.bfloat16, **slice_kwargs()
+    ),
+    "hf_compile": lambda a: Stage1Backend_HF(
+        a.hf_model, a.device, compile=True, dtype=torch.float32, **slice_kwargs()
+    ),
+    "hf_Q8": lambda a: Stage1Backend_HF(
+        a.hf_model, a.device, cache_mode="Q8", compile=False, dtype=torch.float32, **slice_kwargs()
+    ),
+    "hf_Q6": lambda a: Stage1Backend_HF(
+        a.hf_model, a.device, cache_mode="Q6", compile=False, dtype=torch.float32, **slice_kwargs()
+    ),
+    "hf_Q4": lambda a: Stage1Backend_HF(
+        a.hf_model, a.device, cache_mode="Q4", compile=False, dtype=torch.float32, **slice_kwargs()
+    ),
+    "gguf": lambda a: Stage1Backend_GGUF(
+        a.gguf_model, a.cache_len, n_threads=a.threads, max_new_tokens=a.new_tokens, **slice_kwargs()
+    ),
+    "gguf_Q8": lambda a: Stage1Backend_GGUF(
+        a.gguf_model, a.cache_len, cache_mode="Q8", n_threads=a.threads,
+        max_new_tokens=a.new_tokens, **slice_kwargs()
+    ),
+    "exl2": lambda a: Stage1Backend_EXL2(a.exl2_model, a.device, **slice_kwargs()),
+}
+
+
+def slice_kwargs():
+    return dict(logits_begin=LOGITS_BEGIN, logits_end=LOGITS_END)
+
+
+def random_models(tmp_dir: str, gguf_model: bool):
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=16384,
+    )
+    model = LlamaForCausalLM(config).eval()
+    hf_path = os.path.join(tmp_dir, "random_llama")
+    model.save_pretrained(hf_path)
+    gguf_path = ""
+    if gguf_model:
+        from convert_gguf import write_gguf
+
+        gguf_path = os.path.join(tmp_dir, "random_llama.f32.gguf")
+        write_gguf(model, gguf_path, "f32")
+    return hf_path, gguf_path
+
+
+def cfg_mix(logits: torch.Tensor) -> torch.Tensor:
+    logits = F.log_softmax(logits.float().cpu(), dim=-1)
+    return CFG_SCALE * logits[0] + (1 - CFG_SCALE) * logits[1]
+
+
+def last_logits(model, ids, device: torch.device) -> torch.Tensor:
+    input_ids = torch.tensor([ids], dtype=torch.long, device=device)
+    with torch.no_grad():
+        logits = model(input_ids).logits[0, -1, LOGITS_BEGIN:LOGITS_END]
+    return logits.float().cpu()
+
+
+def run_reference(model_path: str, device: torch.device, prompts, new_tokens: int):
+    """Greedy CFG decode without any cache, one full forward per row and step.
+
+    Returns the tokens (one list per segment) and the per-step log-probs of
+    both rows, like run().
+    """
+    from transformers import LlamaForCausalLM
+
+    model = LlamaForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    model = model.to(device).eval()
+    seq, out_tokens, steps = [], [], []
+    for prompt in prompts:
+        seq += prompt
+        # The unconditional row only sees the segment from its last prompt token
+        uncond_from = len(seq) - 1
+        segment = []
+        for _ in range(new_tokens):
+            logits = torch.stack(
+                (last_logits(model, seq, device), last_logits(model, seq[uncond_from:], device))
+            )
+            steps.append(F.log_softmax(logits, dim=-1))
+            token = LOGITS_BEGIN + int(cfg_mix(logits).argmax())
+            segment.append(token)
+            seq.append(token)
+        out_tokens.append(segment)
+    return out_tokens, steps
+
+
+def run(backend, cache_len, prompts, tokens=None, new_tokens=0):
+    """Drive a backend like Stage1Pipeline.generate does for len(prompts) segments.
+
+    Decodes greedily from the CFG mix unless tokens (one list per segment) are
+    given to teacher-force. Returns the tokens, the per-step log-probs of both
+    rows, and prefill/decode timings.
+    """
+    backend.alloc(2, cache_len)
+    out_tokens, steps = [], []
+    prefill_time = decode_time = 0.0
+    n_prefill = n_decode = 0
+    for i, prompt in enumerate(prompts):
+        start = time.perf_counter()
+        logits = backend.prefill(prompt, backend.n_tokens + len(prompt) - 1)
+        prefill_time += time.perf_counter() - start
+        n_prefill += len(prompt)
+        segment = []
+        for j in range(len(tokens[i]) if tokens else new_tokens):
+            steps.append(F.log_softmax(logits.float().cpu(), dim=-1))
+            token = tokens[i][j] if tokens else LOGITS_BEGIN + int(cfg_mix(logits).argmax())
+            segment.append(token)
+            start = time.perf_counter()
+            logits = backend.decode_step(token)
+            decode_time += time.perf_counter() - start
+            n_decode += 1
+        out_tokens.append(segment)
+    return out_tokens, steps, n_prefill / prefill_time, n_decode / max(decode_time, 1e-9)
+
+
+def check_trim(backend, prompt, tokens):
+    """Decode tokens, roll back to the snapshot, decode them again."""
+    backend.alloc(2, len(prompt) + len(tokens) + 1)
+    backend.prefill(prompt, len(prompt) - 1)
+    snapshot = backend.snapshot()
+    first = [backend.decode_step(t).float().cpu() for t in tokens]
+    backend.trim(snapshot)
+    second = [backend.decode_step(t).float().cpu() for t in tokens]
+    return max((a - b).abs().max().item() for a, b in zip(first, second))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hf_model", type=str, default="", help="Reference and hf_* backends.")
+    parser.add_argument("--gguf_model", type=str, default="")
+    parser.add_argument("--exl2_model", type=str, default="")
+    parser.add_argument("--backends", type=str, nargs="+", default=["hf_bf16", "hf_Q8", "gguf", "gguf_Q8"])
+    parser.add_argument("--prompt_len", type=int, default=256)
+    parser.add_argument("--new_tokens", type=int, default=64)
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument(
+        "--atol", type=float, default=None, help="Max log-prob difference (default: ATOL)."
+    )
+    parser.add_argument("--min_agreement", type=float, default=0.95, help="CFG argmax agreement.")
+    args = parser.parse_args()
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    rng = np.random.default_rng(0)
+    prompts = [
+        rng.integers(0, 32000, args.prompt_len // 2).tolist()
+        + rng.integers(CODEC_BEGIN, CODEC_BEGIN + 1024, args.prompt_len // 2).tolist()
+    ]
+    prompts += [rng.integers(0, 32000, 16).tolist() for _ in range(args.segments - 1)]
+    args.cache_len = sum(len(p) for p in prompts) + (args.new_tokens + 1) * args.segments
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not args.hf_model:
+            args.hf_model, args.gguf_model = random_models(
+                tmp_dir, any(b.startswith("gguf") for b in args.backends)
+            )
+
+        ref_tokens, ref_steps = run_reference(
+            args.hf_model, args.device, prompts, args.new_tokens
+        )
+        ref_mix = [CFG_SCALE * s[0] + (1 - CFG_SCALE) * s[1] for s in ref_steps]
+
+        print(
+            f"{'backend':<12}{'max diff':>10}{'agree':>8}{'trim diff':>11}"
+            f"{'prefill tok/s':>15}{'decode tok/s':>14}  result"
+        )
+        print(f"{'llama_fp32':<12}{0:>10.4f}{1:>8.2%}{'':>11}{'':>15}{'':>14}  reference")
+        failed = False
+        for name in args.backends:
+            try:
+                backend = BACKENDS[name](args)
+                run(backend, args.cache_len, prompts, tokens=ref_tokens)  # warm up
+            except Exception as e:  # missing package, no GPU, no model file
+                print(f"{name:<12}skipped: {type(e).__name__}: {e}")
+                continue
+            _, steps, prefill_speed, decode_speed = run(
+                backend, args.cache_len, prompts, tokens=ref_tokens
+            )
+            max_diff = max((a - b).abs().max().item() for a, b in zip(steps, ref_steps))
+            mix = [CFG_SCALE * s[0] + (1 - CFG_SCALE) * s[1] for s in steps]
+            agreement = np.mean([int(a.argmax()) == int(b.argmax()) for a, b in zip(mix, ref_mix)])
+            trim_diff = check_trim(backend, prompts[0], ref_tokens[0])
+            atol = args.atol if args.atol is not None else ATOL.get(name, DEFAULT_ATOL)
+            ok = max_diff <= atol and agreement >= args.min_agreement and trim_diff <= atol
+            failed |= not ok
+            print(
+                f"{name:<12}{max_diff:>10.4f}{agreement:>8.2%}{trim_diff:>11.4f}"
+                f"{prefill_speed:>15.1f}{decode_speed:>14.1f}  {'PASS' if ok else 'FAIL'}"
+            )
+            del backend
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
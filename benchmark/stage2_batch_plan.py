@@ -0,0 +1,95 @@
+"""Stage 2 batch plans for given memory budgets, without loading a model.
+
+Builds the Stage2MemoryModel of a config (--model, or a 1B Llama shape by
+default) for each cache mode, plans the windows of --songs songs of --seconds
+seconds for each --budgets_gb, and checks that every batch fits its budget,
+that each window is planned once and that batches go longest window first.
+
+    python benchmark/stage2_batch_plan.py --budgets_gb 4 10 20 --seconds 150 --songs 4
+    python benchmark/stage2_batch_plan.py --model m-a-p/YuE-s2-1B-general --budgets_gb 6
+"""
+
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from infer_stage2 import STAGE2_PARTS, Stage2Pipeline, Stage2Window  # noqa: E402
+from stage2_memory import CACHE_MODE_BYTES, Stage2MemoryModel  # noqa: E402
+from transformers import AutoConfig, LlamaConfig  # noqa: E402
+
+
+class PlannedPipeline(Stage2Pipeline):
+    """Just the batch planning of a pipeline with an injected memory budget."""
+
+    def __init__(self, memory_model: Stage2MemoryModel, memory_budget: int):
+        super().__init__(torch.device("cpu"))
+        self.memory_model = memory_model
+        self.memory_budget = memory_budget
+
+    def max_batch_size(self, n_frames: int) -> int:
+        return self.memory_model.max_batch_size(n_frames, self.memory_budget)
+
+
+def song_windows(n_songs: int, n_frames: int):
+    windows = []
+    for song_idx in range(n_songs):
+        for part_idx in range(len(STAGE2_PARTS)):
+            # Tracks of a song differ by a few frames, like stage 1 outputs
+            frames = n_frames - part_idx * 7
+            for seg_idx, start in enumerate(range(0, frames, 300)):
+                n = min(300, frames - start)
+                windows.append(Stage2Window(song_idx, part_idx, seg_idx, torch.zeros((1, n))))
+    return windows
+
+
+def check_plan(pipeline: PlannedPipeline, windows, batches):
+    planned = sorted(id(w) for batch in batches for w in batch)
+    assert planned == sorted(id(w) for w in windows), "windows lost or planned twice"
+    longest = [batch[0].n_frames for batch in batches]
+    assert longest == sorted(longest, reverse=True), "batches are not longest first"
+    for batch in batches:
+        n_frames = max(w.n_frames for w in batch)
+        used = len(batch) * pipeline.memory_model.row_bytes(n_frames)
+        assert len(batch) == 1 or used <= pipeline.memory_budget, "batch exceeds the budget"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="", help="HF config to plan for.")
+    parser.add_argument("--dtype_bytes", type=int, default=2, help="Bytes per activation.")
+    parser.add_argument("--budgets_gb", type=float, nargs="+", default=[2, 6, 20])
+    parser.add_argument("--songs", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=120)
+    args = parser.parse_args()
+
+    if args.model:
+        config = AutoConfig.from_pretrained(args.model)
+    else:
+        config = LlamaConfig(
+            vocab_size=83734,
+            hidden_size=2048,
+            intermediate_size=5504,
+            num_hidden_layers=16,
+            num_attention_heads=16,
+            num_key_value_heads=16,
+        )
+    windows = song_windows(args.songs, int(args.seconds * 50))
+    print(f"{len(windows)} windows of {args.songs} songs of {args.seconds:g}s")
+    print(f"{'cache':<6}{'budget GB':>10}{'MB/row':>8}{'rows':>6}{'batches':>9}  batch sizes")
+    for cache_mode, cache_bytes in CACHE_MODE_BYTES.items():
+        memory_model = Stage2MemoryModel.from_config(config, cache_bytes, args.dtype_bytes)
+        for budget_gb in args.budgets_gb:
+            pipeline = PlannedPipeline(memory_model, int(budget_gb * 2**30))
+            batches = pipeline.plan_batches(windows)
+            check_plan(pipeline, windows, batches)
+            print(
+                f"{cache_mode:<6}{budget_gb:>10g}{memory_model.row_bytes(300) / 2**20:>8.0f}"
+                f"{pipeline.max_batch_size(300):>6}{len(batches):>9}  {[len(b) for b in batches]}"
+            )
+
+
+if __name__ == "__main__":
+    main()
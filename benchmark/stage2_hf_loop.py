@@ -0,0 +1,176 @@
+"""Stage2Pipeline_HF decode loop vs the previous model.generate()-per-frame loop.
+
+Both run teacher-forced greedy decoding of the windows of a vocal and an
+instrumental track of --frames frames. The reference decodes them the way the
+previous pipeline did: per track, full 300 frame windows in batches of
+--batch_size and the tail window in a pass of its own. The pipeline packs
+windows of both tracks into padded batches (Stage2Pipeline.plan_batches). The
+script checks that both produce the same tokens and reports frames/s. Without
+--model a small random Llama is used on CPU, which measures the per-step
+overhead the loop removes rather than model compute. Each loop is timed on a
+second pass over the same batches, after an untimed warm-up pass.
+
+    python benchmark/stage2_hf_loop.py --frames 657 --batch_size 4
+    python benchmark/stage2_hf_loop.py --model m-a-p/YuE-s2-1B-general --dtype float16 --frames 3000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from common import AllowedVocabProcessor  # noqa: E402
+from infer_stage2 import Stage2Pipeline_HF, Stage2Window  # noqa: E402
+from transformers import LogitsProcessor, LogitsProcessorList, StaticCache  # noqa: E402
+
+
+def random_model(path: str):
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=83734,
+        hidden_size=128,
+        intermediate_size=256,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=16384,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+class CodebookStepProcessor(LogitsProcessor):
+    """Allow only the codebook of the current step, like the pipeline's per-codebook head."""
+
+    def __init__(self, len_prompt: int):
+        self.len_prompt = len_prompt
+        self.codebooks = [
+            AllowedVocabProcessor([(46358 + i * 1024, 46358 + (i + 1) * 1024)]) for i in range(7)
+        ]
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        step = (input_ids.shape[1] - self.len_prompt) % 8 - 1
+        return self.codebooks[step](input_ids, scores)
+
+
+def generate_reference(pipeline: Stage2Pipeline_HF, windows: list):
+    """The previous Stage2Pipeline_HF.generate_batch, one model.generate() per frame.
+
+    Restricted to the codebook of each step, the previous loop allowed all of
+    codebooks 1-7 at every step and left invalid codes to fix_output.
+    """
+    codec_ids = torch.cat([w.codec_ids for w in windows]).to(pipeline.device)
+    batch_size = codec_ids.shape[0]
+    prompt_ids = torch.cat(
+        [
+            torch.tensor([[pipeline.mmtokenizer.soa, pipeline.mmtokenizer.stage_1]] * batch_size),
+            codec_ids.cpu(),
+            torch.tensor([[pipeline.mmtokenizer.stage_2]] * batch_size),
+        ],
+        dim=1,
+    ).to(pipeline.device)
+    len_prompt = prompt_ids.shape[-1]
+    logits_processor = LogitsProcessorList([CodebookStepProcessor(len_prompt)])
+    past_key_values = StaticCache(
+        pipeline.model.config,
+        max_batch_size=batch_size,
+        max_cache_len=prompt_ids.shape[1] + codec_ids.shape[1] * 8,
+        device=pipeline.model.device,
+        dtype=pipeline.model.dtype,
+    )
+    for frames_idx in range(codec_ids.shape[1]):
+        cb0 = codec_ids[:, frames_idx : frames_idx + 1]
+        prompt_ids = torch.cat([prompt_ids, cb0], dim=1)
+        prompt_ids = pipeline.model.generate(
+            input_ids=prompt_ids,
+            min_new_tokens=7,
+            max_new_tokens=7,
+            do_sample=False,
+            eos_token_id=pipeline.mmtokenizer.eoa,
+            pad_token_id=pipeline.mmtokenizer.eoa,
+            logits_processor=logits_processor,
+            past_key_values=past_key_values,
+        )
+    return list(prompt_ids[:, len_prompt:].cpu().numpy())
+
+
+def run_reference(pipeline: Stage2Pipeline_HF, windows: list, batch_size: int):
+    outputs = []
+    for part_idx in range(2):
+        full = [w for w in windows if w.part_idx == part_idx and w.n_frames == 300]
+        tail = [w for w in windows if w.part_idx == part_idx and w.n_frames < 300]
+        for start in range(0, len(full), batch_size):
+            batch = full[start : start + batch_size]
+            outputs += zip(batch, generate_reference(pipeline, batch))
+        if tail:
+            outputs += zip(tail, generate_reference(pipeline, tail))
+    return outputs
+
+
+def run_pipeline(pipeline: Stage2Pipeline_HF, windows: list, batch_size: int):
+    outputs = []
+    for batch in pipeline.plan_batches(windows):
+        outputs += zip(batch, pipeline.generate_windows(batch))
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="")
+    parser.add_argument("--dtype", type=str, default="float32")
+    parser.add_argument("--frames", type=int, default=657, help="Frames per track.")
+    parser.add_argument("--batch_size", type=int, default=4, help="Windows per batch.")
+    parser.add_argument("--compile", action="store_true", help="Like --stage2_compile.")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not args.model:
+            args.model = os.path.join(tmp_dir, "random_llama")
+            random_model(args.model)
+        pipeline = Stage2Pipeline_HF(
+            args.model,
+            device,
+            batch_size=args.batch_size,
+            compile=args.compile,
+            dtype=getattr(torch, args.dtype),
+        )
+
+    # Two tracks cut into windows like Stage2Pipeline.collect_windows
+    rng = np.random.default_rng(0)
+    windows = []
+    for part_idx in range(2):
+        codec_ids = torch.as_tensor(
+            pipeline.get_codec_ids(rng.integers(0, 1024, (1, args.frames))), dtype=torch.long
+        )
+        for seg_idx, seg in enumerate(torch.split(codec_ids, 300, dim=-1)):
+            windows.append(Stage2Window(0, part_idx, seg_idx, seg))
+    n_frames = 2 * args.frames
+
+    results = {}
+    for name, fn in [("generate() per frame", run_reference), ("padded decode loop", run_pipeline)]:
+        # Warm up on the same batches, so --compile is timed without compiling
+        fn(pipeline, windows, args.batch_size)
+        start = time.perf_counter()
+        outputs = fn(pipeline, windows, args.batch_size)
+        elapsed = time.perf_counter() - start
+        results[name] = {(w.part_idx, w.seg_idx): o for w, o in outputs}
+        print(f"{name:<22}{n_frames / elapsed:>10.1f} frames/s  {elapsed:.2f}s")
+
+    reference, output = results.values()
+    match = np.mean([(reference[k] == output[k]).mean() for k in reference])
+    print(f"token match: {match:.2%}")
+    sys.exit(0 if match == 1 else 1)
+
+
+if __name__ == "__main__":
+    # Like infer_stage2.py, the cache updates must not be recorded by autograd
+    torch.autograd.grad_mode._enter_inference_mode(True)
+    torch.autograd.set_grad_enabled(False)
+    main()
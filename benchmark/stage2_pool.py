@@ -0,0 +1,98 @@
+"""Stage 2 on one pipeline vs Stage2Pipeline_Pool (--stage2_devices).
+
+Decodes the stage 1 tracks of --songs random songs with both and checks that
+the pool reassembles the same outputs. On a multi-GPU node pass the devices
+and the real model; without --model a small random Llama runs on CPU workers,
+which checks the plumbing (speedup needs as many free cores as workers).
+
+    python benchmark/stage2_pool.py --devices cpu cpu
+    python benchmark/stage2_pool.py --model m-a-p/YuE-s2-1B-general --devices cuda:0 cuda:1 cuda:2 cuda:3 --songs 16
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+from common import parser as infer_parser  # noqa: E402
+from infer_stage2 import Stage2Pipeline_Pool, build_pipeline  # noqa: E402
+from stage2_hf_loop import random_model  # noqa: E402
+
+
+def write_songs(tmp_dir: str, n_songs: int, seconds: float):
+    rng = np.random.default_rng(0)
+    output_dirs = []
+    for i in range(n_songs):
+        output_dir = os.path.join(tmp_dir, f"song{i}")
+        os.makedirs(os.path.join(output_dir, "stage1"))
+        # Uneven lengths, so batches and tail windows differ
+        n_frames = int(seconds * 50 * rng.uniform(0.5, 1.0))
+        for name in ["vtrack.npy", "itrack.npy"]:
+            np.save(
+                os.path.join(output_dir, "stage1", name),
+                rng.integers(0, 1024, (1, n_frames)),
+            )
+        output_dirs.append(output_dir)
+    return output_dirs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="")
+    parser.add_argument("--devices", type=str, nargs="+", default=["cpu", "cpu"])
+    parser.add_argument("--songs", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=8.0, help="Longest song.")
+    parser.add_argument("--batch_size", type=int, default=2)
+    args, infer_args = parser.parse_known_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not args.model:
+            args.model = os.path.join(tmp_dir, "random_llama")
+            random_model(args.model)
+        output_dirs = write_songs(tmp_dir, args.songs, args.seconds)
+        infer_args = infer_parser.parse_args(
+            [
+                "--stage2_model", args.model,
+                "--stage2_batch_size", str(args.batch_size),
+                *infer_args,
+            ]
+        )
+
+        pipeline = build_pipeline(infer_args, torch.device(args.devices[0]))
+        start = time.perf_counter()
+        reference = pipeline.generate_many(output_dirs)
+        single_time = time.perf_counter() - start
+        del pipeline
+
+        pool = Stage2Pipeline_Pool(infer_args, args.devices)
+        try:
+            start = time.perf_counter()
+            outputs = pool.generate_many(output_dirs)
+            pool_time = time.perf_counter() - start
+        finally:
+            pool.close()
+
+    n_frames = sum(o.shape[-1] for song in reference for o in song.values())
+    print(f"{'1 x ' + args.devices[0]:<24}{n_frames / single_time:>10.1f} frames/s")
+    print(
+        f"{f'pool of {len(args.devices)}':<24}{n_frames / pool_time:>10.1f} frames/s"
+        f"  {single_time / pool_time:.2f}x"
+    )
+    match = all(
+        (song[name] == pool_song[name]).all()
+        for song, pool_song in zip(reference, outputs)
+        for name in song
+    )
+    print(f"outputs match: {match}")
+    sys.exit(0 if match else 1)
+
+
+if __name__ == "__main__":
+    torch.autograd.grad_mode._enter_inference_mode(True)
+    torch.autograd.set_grad_enabled(False)
+    main()
@@ -0,0 +1,66 @@
+from functools import lru_cache
+from typing import Optional, Tuple
+
+import torch
+import torchaudio
+from torchaudio.transforms import Resample
+
+# Extra audio decoded on each side of a range, so the resampling filter sees
+# the same neighbouring samples as when the whole file is resampled
+RESAMPLE_MARGIN = 0.05  # s
+
+
+@lru_cache(maxsize=None)
+def get_resampler(orig_freq: int, new_freq: int, device: str = "cpu") -> Resample:
+    """One Resample per rate pair and device, its sinc kernel is computed once."""
+    return Resample(orig_freq=orig_freq, new_freq=new_freq).to(device)
+
+
+def resample(audio: torch.Tensor, orig_freq: int, new_freq: int) -> torch.Tensor:
+    if orig_freq == new_freq:
+        return audio
+    return get_resampler(orig_freq, new_freq, str(audio.device))(audio)
+
+
+def load_audio(
+    path: str,
+    sampling_rate: Optional[int] = None,
+    mono: bool = False,
+    start_time: float = 0.0,
+    end_time: Optional[float] = None,
+) -> Tuple[torch.Tensor, int]:
+    """(channels, samples) audio of path from start_time to end_time (the end of the file if None).
+
+    Only that range and RESAMPLE_MARGIN around it is decoded; the decoder
+    seeks to it where the container allows. Channels are averaged to one if
+    mono, before resampling to sampling_rate (the file's own rate if None).
+    """
+    sr = torchaudio.info(path).sample_rate
+    target_sr = sampling_rate or sr
+    margin = RESAMPLE_MARGIN if target_sr != sr else 0.0
+
+    frame_offset = int(round(max(start_time - margin, 0.0) * sr))
+    num_frames = -1
+    if end_time is not None:
+        num_frames = max(int(round((end_time + margin) * sr)) - frame_offset, 0)
+    audio, sr = torchaudio.load(path, frame_offset=frame_offset, num_frames=num_frames)
+    if mono:
+        audio = torch.mean(audio, dim=0, keepdim=True)
+    audio = resample(audio, sr, target_sr)
+
+    # Cut the margin, in samples of the target rate
+    begin = int(round(start_time * target_sr)) - int(round(frame_offset * target_sr / sr))
+    begin = max(begin, 0)
+    end = None
+    if end_time is not None:
+        end = begin + int(round((end_time - start_time) * target_sr))
+    return audio[:, begin:end], target_sr
+
+
+def load_audio_mono(
+    path: str,
+    sampling_rate: int = 16000,
+    start_time: float = 0.0,
+    end_time: Optional[float] = None,
+) -> torch.Tensor:
+    return load_audio(path, sampling_rate, mono=True, start_time=start_time, end_time=end_time)[0]
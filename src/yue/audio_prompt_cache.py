@@ -0,0 +1,84 @@
+import hashlib
+import os
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AudioPromptCache:
+    """Codec codes of whole audio prompt files, so each file is encoded once.
+
+    Entries are keyed by the file's content, the codec checkpoint and the
+    bandwidth, and hold the codes of the full file; get() trims a copy to the
+    requested frame range. Within a run entries are kept in memory, so the
+    prompt tracks that --extend_mp3 also continues are encoded only once, for
+    any of their ranges. With cache_dir they are also saved as
+    <cache_dir>/<key>.npy for later runs.
+    """
+
+    def __init__(self, codec_checkpoint: str, cache_dir: str = ""):
+        self.codec_checkpoint = codec_checkpoint
+        self.cache_dir = cache_dir
+        self.codes: Dict[str, np.ndarray] = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, path: str, target_bw: float) -> str:
+        # Checked on use, runs without audio prompts don't need the checkpoint
+        stat = os.stat(self.codec_checkpoint)
+        codec = f"{os.path.abspath(self.codec_checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}"
+        key = f"{codec}\n{target_bw}\n{file_digest(path)}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(
+        self,
+        path: str,
+        target_bw: float,
+        encode: Callable[[], np.ndarray],
+        start_frame: int = 0,
+        end_frame: Optional[int] = None,
+    ) -> np.ndarray:
+        """The codes of frames start_frame to end_frame of path (to its end if None).
+
+        encode() computes the codes of the whole file on a miss.
+        """
+        return self.get_many([path], target_bw, lambda _: [encode()], start_frame, end_frame)[0]
+
+    def get_many(
+        self,
+        paths: List[str],
+        target_bw: float,
+        encode: Callable[[List[str]], List[np.ndarray]],
+        start_frame: int = 0,
+        end_frame: Optional[int] = None,
+    ) -> List[np.ndarray]:
+        """get() of several files, encode(missed_paths) computes all misses at once."""
+        keys = [self.key(path, target_bw) for path in paths]
+        missed: Dict[str, str] = {}  # key: path, a file given twice is encoded once
+        for path, key in zip(paths, keys):
+            cache_path = os.path.join(self.cache_dir, f"{key}.npy")
+            if key in self.codes:
+                continue
+            if self.cache_dir and os.path.exists(cache_path):
+                self.codes[key] = np.load(cache_path)
+            else:
+                missed.setdefault(key, path)
+
+        if missed:
+            for key, codes in zip(missed, encode(list(missed.values()))):
+                if self.cache_dir:
+                    cache_path = os.path.join(self.cache_dir, f"{key}.npy")
+                    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, codes)
+                    os.replace(tmp_path, cache_path)
+                self.codes[key] = codes
+        return [self.codes[key][..., start_frame:end_frame].copy() for key in keys]
@@ -2,17 +2,22 @@ import argparse
 import random
 import re
 from datetime import datetime
+from typing import List
 
 import numpy as np
 import torch
-from exllamav2 import (
-    ExLlamaV2Cache,
-    ExLlamaV2Cache_Q4,
-    ExLlamaV2Cache_Q6,
-    ExLlamaV2Cache_Q8,
-)
 from transformers import LogitsProcessor
 
+try:
+    from exllamav2 import (
+        ExLlamaV2Cache,
+        ExLlamaV2Cache_Q4,
+        ExLlamaV2Cache_Q6,
+        ExLlamaV2Cache_Q8,
+    )
+except ImportError:  # HF-only install
+    ExLlamaV2Cache = ExLlamaV2Cache_Q4 = ExLlamaV2Cache_Q6 = ExLlamaV2Cache_Q8 = None
+
 parser = argparse.ArgumentParser()
 # Model Configuration:
 parser.add_argument(
@@ -49,11 +54,27 @@ parser.add_argument(
     action="store_true",
     help="Use exllamav2 to load and run stage 2 model.",
 )
+parser.add_argument(
+    "--stage1_use_gguf",
+    action="store_true",
+    help="Use llama.cpp to run a GGUF stage 1 model on CPU (see convert_gguf.py), --stage1_model is the .gguf file.",
+)
+parser.add_argument(
+    "--stage2_use_gguf",
+    action="store_true",
+    help="Use llama.cpp to run a GGUF stage 2 model on CPU (see convert_gguf.py), --stage2_model is the .gguf file.",
+)
+parser.add_argument(
+    "--gguf_threads",
+    type=int,
+    default=None,
+    help="CPU threads for the GGUF backend, defaults to llama.cpp's choice.",
+)
 parser.add_argument(
     "--stage2_batch_size",
     type=int,
     default=4,
-    help="The non-exl2 batch size used in Stage 2 inference.",
+    help="Windows per batch of the HF stage 2 backend. 0: as many as fit in --stage2_memory_gb.",
 )
 parser.add_argument(
     "--stage1_cache_size",
@@ -65,13 +86,25 @@ parser.add_argument(
     "--stage2_cache_size",
     type=int,
     default=8192,
-    help="The exl2 cache size used in Stage 2 inference.",
+    help="Tokens of the exl2 stage 2 cache, a batch of 300 frame windows takes 2720 per window. 0: size batches to --stage2_memory_gb instead.",
+)
+parser.add_argument(
+    "--cache_alloc_bucket",
+    type=int,
+    default=1024,
+    help="Stage 1 KV cache is sized to the job (prompt, segments, max_new_tokens, extend_mp3 prefix), rounded up to a multiple of this many tokens and capped at --stage1_cache_size.",
+)
+parser.add_argument(
+    "--stage1_prefill_chunk",
+    type=int,
+    default=512,
+    help="HF stage 1 forwards prompts in chunks of at most this many tokens, padded to power-of-two buckets so each bucket compiles once.",
 )
 parser.add_argument(
     "--stage1_cache_mode",
     type=str,
     default="FP16",
-    help="The cache mode used in Stage 1 inference (FP16, Q8, Q6, Q4). Quantized k/v cache will save VRAM at the cost of some speed and precision.",
+    help="The cache mode used in Stage 1 inference (FP16, Q8, Q6, Q4). Quantized k/v cache will save VRAM at the cost of some speed and precision. The HF backend has no 6-bit cache, so Q6 there is the same 8-bit cache as Q8 (hqq package); Q4 is 4-bit (optimum-quanto package).",
 )
 parser.add_argument(
     "--stage2_cache_mode",
@@ -79,11 +112,62 @@ parser.add_argument(
     default="FP16",
     help="The cache mode used in Stage 2 inference (FP16, Q8, Q6, Q4). Quantized k/v cache will save VRAM at the cost of some speed and precision.",
 )
+parser.add_argument(
+    "--stage2_memory_gb",
+    type=float,
+    default=0.0,
+    help="Memory per device for the stage 2 KV cache and activations, used when --stage2_batch_size (HF) or --stage2_cache_size (exl2) is 0. Batch sizes are then planned from an estimate of the memory per window for the model and --stage2_cache_mode. 0: 90%% of the memory free after the model is loaded.",
+)
+parser.add_argument(
+    "--stage2_devices",
+    type=str,
+    nargs="+",
+    default=[],
+    help="Run stage 2 data-parallel, one worker process with its own model per device (e.g. cuda:0 cuda:1, or cpu cpu for the HF and GGUF backends). Windows are batched as usual and each batch goes to whichever worker is free.",
+)
+parser.add_argument(
+    "--stage2_result_cache",
+    type=str,
+    default="",
+    help="Directory of a stage 2 result cache. Windows whose codebook 0 frames were already decoded with the same stage 2 model (--resume_after_n, --extend_mp3, reruns) are read from it instead of decoded again. Disabled if empty.",
+)
+parser.add_argument(
+    "--stage2_result_cache_gb",
+    type=float,
+    default=2.0,
+    help="Size limit of --stage2_result_cache in GB, least recently used windows are deleted beyond it.",
+)
 parser.add_argument(
     "--stage1_no_guidance",
     action="store_true",
     help="Disable classifier-free guidance for stage 1",
 )
+parser.add_argument(
+    "--stage1_engine_rows",
+    type=int,
+    default=8,
+    help="Batch rows of the continuous-batching stage 1 engine (exl2 only, other backends render "
+    "--manifest songs one at a time), a song with CFG takes two rows.",
+)
+parser.add_argument(
+    "--stage1_loop_policy",
+    type=str,
+    default="off",
+    choices=["off", "stop", "resample"],
+    help="What to do when a stage 1 segment degenerates into a token loop or silence: off (default, generate every segment to its full length), stop (end the segment with EOA) or resample (restart the segment, up to --stage1_loop_retries times, then stop). The detector can fire on long held notes, silences or repeated choruses, so it is opt-in.",
+)
+parser.add_argument(
+    "--stage1_loop_retries",
+    type=int,
+    default=2,
+    help="Number of times a degenerate segment is resampled with --stage1_loop_policy resample.",
+)
+parser.add_argument(
+    "--stage1_loop_window",
+    type=int,
+    default=200,
+    help="Rolling window of the stage 1 loop detector in frames (50 per second).",
+)
 parser.add_argument(
     "--custom_filename",
     type=str,
@@ -97,16 +181,22 @@ parser.add_argument(
     help="The timestamp used for saving files.",
 )
 # Prompt
+parser.add_argument(
+    "--manifest",
+    type=str,
+    default="",
+    help="A jobs.jsonl file with one song per line (name, genre or genre_txt, lyrics or lyrics_txt, seed, prompt paths). Renders all songs in one invocation into <output_dir>/<name>, batching across songs, and resumes from <output_dir>/manifest_progress.json. --genre_txt and --lyrics_txt are ignored.",
+)
 parser.add_argument(
     "--genre_txt",
     type=str,
-    required=True,
+    default="",
     help="The file path to a text file containing genre tags that describe the musical style or characteristics (e.g., instrumental, genre, mood, vocal timbre, vocal gender). This is used as part of the generation prompt.",
 )
 parser.add_argument(
     "--lyrics_txt",
     type=str,
-    required=True,
+    default="",
     help="The file path to a text file containing the lyrics for the music generation. These lyrics will be processed and split into structured segments to guide the generation process.",
 )
 parser.add_argument(
@@ -132,6 +222,12 @@ parser.add_argument(
     default=30.0,
     help="The end time in seconds to extract the audio prompt from the given audio file.",
 )
+parser.add_argument(
+    "--audio_prompt_cache",
+    type=str,
+    default="",
+    help="Directory where the codec codes of audio prompt and --extend_mp3 files are kept, keyed by file content, codec checkpoint and bandwidth. Later runs with the same files skip loading the codec model and encoding them. Within a run each file is encoded once either way.",
+)
 parser.add_argument(
     "--use_dual_tracks_prompt",
     action="store_true",
@@ -166,6 +262,22 @@ parser.add_argument(
     action="store_true",
     help="If set, the model will not be offloaded from the GPU to CPU after Stage 1 inference.",
 )
+parser.add_argument(
+    "--postprocess_workers",
+    type=int,
+    default=2,
+    help="Worker threads used to post-process songs in --manifest mode.",
+)
+parser.add_argument(
+    "--preview",
+    action="store_true",
+    help="After stage 1, decode its tracks with the codec and write a quick low-fidelity mix to <output_dir>/preview, before stage 2 runs.",
+)
+parser.add_argument(
+    "--preview_only",
+    action="store_true",
+    help="Stop after stage 1 and its --preview, skipping stage 2 and postprocessing.",
+)
 parser.add_argument("--cuda_idx", type=int, default=0)
 parser.add_argument(
     "--seed", type=int, default=None, help="An integer value to reproduce generation."
@@ -233,6 +345,16 @@ parser.add_argument(
 parser.add_argument(
     "--no_flash_attn", action="store_true", help="Disable flash attention"
 )
+parser.add_argument(
+    "--no_compile",
+    action="store_true",
+    help="Run the HF stage 1 model eagerly instead of compiling its prefill and decode steps with torch.compile.",
+)
+parser.add_argument(
+    "--stage2_compile",
+    action="store_true",
+    help="Compile the HF stage 2 model with torch.compile (dynamic shapes, as batch size and prompt length vary between batches).",
+)
 
 
 def sanitize_filename(text, replacement="_"):
@@ -248,6 +370,27 @@ def seed_everything(seed: int = 42):
     torch.backends.cudnn.benchmark = False
 
 
+def align(n, m):
+    return ((n + m - 1) // m) * m
+
+
+def plan_cache_len(needed_tokens: int, max_cache_size: int, bucket: int) -> int:
+    """Round the tokens a job needs up to an allocation bucket, capped at max_cache_size."""
+    if bucket <= 0:
+        return max_cache_size
+    return min(align(max(needed_tokens, 1), bucket), max_cache_size)
+
+
+def stage1_needed_tokens(
+    prefix_len: int, segment_prompts: List[List[int]], max_new_tokens: int, max_cache_size: int
+) -> int:
+    """Cache tokens a stage 1 job uses: its prefix (at most one window) plus every prompt and segment."""
+    max_context = max_cache_size - max_new_tokens - 1
+    return min(prefix_len, max_context) + sum(
+        len(p) + max_new_tokens + 1 for p in segment_prompts
+    )
+
+
 def get_cache_class(cache_mode: str):
     if cache_mode == "Q4":
         return ExLlamaV2Cache_Q4
@@ -259,10 +402,67 @@ def get_cache_class(cache_mode: str):
         return ExLlamaV2Cache
 
 
-class BlockTokenRangeProcessor(LogitsProcessor):
-    def __init__(self, start_id, end_id):
-        self.blocked_token_ids = list(range(start_id, end_id))
+# transformers quantized KV cache per cache mode: (backend, nbits).
+# Neither backend has a 6-bit mode, so Q6 is stored in 8 bits.
+HF_CACHE_MODES = {
+    "Q4": ("quanto", 4),
+    "Q6": ("hqq", 8),
+    "Q8": ("hqq", 8),
+}
+
+
+def get_hf_cache_kwargs(cache_mode: str, residual_length: int = 128) -> dict:
+    """Settings of the transformers QuantizedCache matching a --stage*_cache_mode.
+
+    Empty for FP16, where Stage1Backend_HF allocates a StaticCache. Otherwise
+    the backend builds QuantizedCache(config, **kwargs["cache_config"]) in
+    alloc; benchmark/hf_kv_cache_modes.py passes the whole dict to generate().
+    The newest `residual_length` tokens are kept in full precision and
+    quantized in chunks; quanto needs `optimum-quanto`, hqq needs `hqq`.
+    """
+    if cache_mode not in HF_CACHE_MODES:
+        return {}
+    backend, nbits = HF_CACHE_MODES[cache_mode]
+    return {
+        "cache_implementation": "quantized",
+        "cache_config": {
+            "backend": backend,
+            "nbits": nbits,
+            "residual_length": residual_length,
+        },
+    }
+
+
+class AllowedVocabProcessor(LogitsProcessor):
+    """Mask all scores except the token ids in `allowed_ranges` ([start, end) pairs).
+
+    The mask is an additive bias (0 / -inf) built once per shape, device and
+    dtype, so applying it is a single add. `begin`:`end` spans the allowed
+    ranges; `slice` cuts full-vocab scores down to it, so softmax and top-p
+    only touch those rows, and `apply(scores, offset=begin)` masks such a slice.
+    """
+
+    def __init__(self, allowed_ranges):
+        self.allowed_ranges = [(start, end) for start, end in allowed_ranges if end > start]
+        self.begin = min(start for start, _ in self.allowed_ranges)
+        self.end = max(end for _, end in self.allowed_ranges)
+        self.biases = {}
+
+    def bias(self, n: int, device, dtype, offset: int = 0) -> torch.Tensor:
+        """Bias for scores of the n token ids starting at offset."""
+        key = (n, offset, device, dtype)
+        if key not in self.biases:
+            bias = torch.full((n,), -float("inf"))
+            for start, end in self.allowed_ranges:
+                bias[max(start - offset, 0) : max(end - offset, 0)] = 0
+            self.biases[key] = bias.to(device=device, dtype=dtype)
+        return self.biases[key]
+
+    def apply(self, scores: torch.Tensor, offset: int = 0) -> torch.Tensor:
+        return scores + self.bias(scores.shape[-1], scores.device, scores.dtype, offset)
+
+    def slice(self, scores: torch.Tensor) -> torch.Tensor:
+        return scores[..., self.begin : self.end]
 
     def __call__(self, input_ids, scores):
-        scores[:, self.blocked_token_ids] = -float("inf")
-        return scores
+        return self.apply(scores)
@@ -0,0 +1,175 @@
+"""Convert a YuE stage 1 or stage 2 HF checkpoint to GGUF for --stage*_use_gguf.
+
+    python convert_gguf.py --model m-a-p/YuE-s1-7B-anneal-en-cot --outfile s1.Q8_0.gguf --outtype q8_0
+
+f32, f16, bf16, q8_0, q5_0, q4_0 are written directly with the `gguf` package.
+The k-quants (q6_k, q5_k_m, q4_k_m) write an f16 file first and quantize it
+with llama.cpp, which needs `llama-cpp-python`.
+"""
+
+import argparse
+import os
+
+import gguf
+import numpy as np
+import sentencepiece
+import torch
+from transformers import AutoModelForCausalLM
+
+TOKENIZER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "mm_tokenizer_v0.2_hf", "tokenizer.model"
+)
+
+DIRECT_TYPES = {
+    "f32": gguf.GGMLQuantizationType.F32,
+    "f16": gguf.GGMLQuantizationType.F16,
+    "bf16": gguf.GGMLQuantizationType.BF16,
+    "q8_0": gguf.GGMLQuantizationType.Q8_0,
+    "q5_0": gguf.GGMLQuantizationType.Q5_0,
+    "q4_0": gguf.GGMLQuantizationType.Q4_0,
+}
+FILE_TYPES = {
+    "f32": gguf.LlamaFileType.ALL_F32,
+    "f16": gguf.LlamaFileType.MOSTLY_F16,
+    "bf16": gguf.LlamaFileType.MOSTLY_BF16,
+    "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
+    "q5_0": gguf.LlamaFileType.MOSTLY_Q5_0,
+    "q4_0": gguf.LlamaFileType.MOSTLY_Q4_0,
+    "q6_k": gguf.LlamaFileType.MOSTLY_Q6_K,
+    "q5_k_m": gguf.LlamaFileType.MOSTLY_Q5_K_M,
+    "q4_k_m": gguf.LlamaFileType.MOSTLY_Q4_K_M,
+}
+
+
+def permute_rope(weights: np.ndarray, n_head: int) -> np.ndarray:
+    """HF rotates q/k halves, llama.cpp rotates adjacent pairs."""
+    return (
+        weights.reshape(n_head, 2, weights.shape[0] // n_head // 2, *weights.shape[1:])
+        .swapaxes(1, 2)
+        .reshape(weights.shape)
+    )
+
+
+def add_vocab(writer: gguf.GGUFWriter, vocab_size: int):
+    """Write the mm tokenizer as a sentencepiece vocab, llama.cpp needs one to load the model."""
+    sp = sentencepiece.SentencePieceProcessor(model_file=TOKENIZER_PATH)
+    tokens, scores, types = [], [], []
+    for i in range(vocab_size):
+        if i >= sp.vocab_size():
+            tokens.append(f"[PAD{i}]".encode())
+            scores.append(-1000.0)
+            types.append(gguf.TokenType.UNUSED)
+            continue
+        tokens.append(sp.id_to_piece(i).encode("utf-8"))
+        scores.append(sp.get_score(i))
+        if sp.is_unknown(i):
+            types.append(gguf.TokenType.UNKNOWN)
+        elif sp.is_control(i):
+            types.append(gguf.TokenType.CONTROL)
+        elif sp.is_unused(i):
+            types.append(gguf.TokenType.UNUSED)
+        elif sp.is_byte(i):
+            types.append(gguf.TokenType.BYTE)
+        else:
+            types.append(gguf.TokenType.NORMAL)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores(scores)
+    writer.add_token_types(types)
+    writer.add_bos_token_id(sp.bos_id())
+    writer.add_eos_token_id(sp.eos_id())
+    writer.add_unk_token_id(sp.unk_id())
+
+
+def write_gguf(model, outfile: str, outtype: str):
+    config = model.config
+    n_head = config.num_attention_heads
+    n_head_kv = getattr(config, "num_key_value_heads", None) or n_head
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // n_head
+    qtype = DIRECT_TYPES[outtype]
+
+    writer = gguf.GGUFWriter(outfile, "llama")
+    writer.add_name(os.path.basename(os.path.splitext(outfile)[0]))
+    writer.add_context_length(config.max_position_embeddings)
+    writer.add_embedding_length(config.hidden_size)
+    writer.add_block_count(config.num_hidden_layers)
+    writer.add_feed_forward_length(config.intermediate_size)
+    writer.add_head_count(n_head)
+    writer.add_head_count_kv(n_head_kv)
+    writer.add_rope_dimension_count(head_dim)
+    writer.add_rope_freq_base(getattr(config, "rope_theta", 10000.0))
+    writer.add_layer_norm_rms_eps(config.rms_norm_eps)
+    writer.add_vocab_size(config.vocab_size)
+    writer.add_file_type(FILE_TYPES[outtype])
+    writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
+    add_vocab(writer, config.vocab_size)
+
+    names = gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, config.num_hidden_layers)
+    state_dict = model.state_dict()
+    if getattr(config, "tie_word_embeddings", False):
+        state_dict.pop("lm_head.weight", None)
+    for name, tensor in state_dict.items():
+        if name.endswith("rotary_emb.inv_freq"):
+            continue
+        data = tensor.float().numpy()
+        if name.endswith("q_proj.weight"):
+            data = permute_rope(data, n_head)
+        elif name.endswith("k_proj.weight"):
+            data = permute_rope(data, n_head_kv)
+        gguf_name = names.get_name(name, try_suffixes=(".weight", ".bias"))
+        if gguf_name is None:
+            raise ValueError(f"Can't map tensor {name}")
+
+        # Norms stay in f32, like llama.cpp's own converter
+        tensor_type = qtype if data.ndim > 1 else gguf.GGMLQuantizationType.F32
+        data = gguf.quants.quantize(data, tensor_type)
+        writer.add_tensor(gguf_name, data, raw_dtype=tensor_type)
+        print(f"{gguf_name:<32} {tensor_type.name:<6} {tuple(tensor.shape)}")
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file(progress=True)
+    writer.close()
+
+
+def quantize_with_llama_cpp(infile: str, outfile: str, outtype: str, n_threads: int):
+    import llama_cpp
+
+    params = llama_cpp.llama_model_quantize_default_params()
+    params.ftype = int(FILE_TYPES[outtype])
+    params.nthread = n_threads
+    ret = llama_cpp.llama_model_quantize(
+        infile.encode("utf-8"), outfile.encode("utf-8"), params
+    )
+    if ret != 0:
+        raise RuntimeError(f"llama.cpp quantization to {outtype} failed ({ret})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--model", type=str, required=True, help="HF model id or path.")
+    parser.add_argument("--outfile", type=str, required=True)
+    parser.add_argument(
+        "--outtype", type=str, default="q8_0", choices=list(FILE_TYPES.keys())
+    )
+    parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args()
+
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model, torch_dtype=torch.bfloat16, low_cpu_mem_usage=True
+    )
+    if args.outtype in DIRECT_TYPES:
+        write_gguf(model, args.outfile, args.outtype)
+        return
+
+    f16_file = args.outfile + ".f16.tmp"
+    write_gguf(model, f16_file, "f16")
+    del model
+    try:
+        quantize_with_llama_cpp(f16_file, args.outfile, args.outtype, args.threads)
+    finally:
+        os.remove(f16_file)
+
+
+if __name__ == "__main__":
+    main()
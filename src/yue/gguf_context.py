@@ -0,0 +1,75 @@
+import ctypes
+
+import numpy as np
+
+# llama.cpp KV cache types per --stage*_cache_mode, llama.cpp has no 6-bit cache type
+GGML_TYPE_F16 = 1
+GGML_TYPE_Q4_0 = 2
+GGML_TYPE_Q8_0 = 8
+GGUF_CACHE_TYPES = {
+    "FP16": GGML_TYPE_F16,
+    "Q8": GGML_TYPE_Q8_0,
+    "Q6": GGML_TYPE_Q8_0,
+    "Q4": GGML_TYPE_Q4_0,
+}
+
+
+class GGUFContext:
+    """One llama.cpp sequence over a GGUF model, fed with token ids.
+
+    Tokens are appended with `eval`, which returns the logits of the last token.
+    `seek` rolls the sequence back, the KV cache past that point is dropped on
+    the next `eval`. Several contexts of the same file share the weights through
+    mmap.
+
+    Args:
+        model_path (str): GGUF file, see convert_gguf.py.
+        n_ctx (int): KV cache size in tokens.
+        n_threads (int): CPU threads, None for llama.cpp's default.
+        cache_mode (str): FP16, Q8, Q6 or Q4 KV cache.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        n_ctx: int,
+        n_threads: int = None,
+        cache_mode: str = "FP16",
+        n_batch: int = 512,
+    ):
+        import llama_cpp
+
+        self.llama_cpp = llama_cpp
+        cache_type = GGUF_CACHE_TYPES.get(cache_mode, GGML_TYPE_F16)
+        self.llm = llama_cpp.Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_batch=min(n_batch, n_ctx),
+            n_threads=n_threads,
+            type_k=cache_type,
+            type_v=cache_type,
+            # llama.cpp needs flash attention for a quantized V cache
+            flash_attn=cache_type != GGML_TYPE_F16,
+            logits_all=False,
+            verbose=False,
+        )
+        self.n_ctx = n_ctx
+        self.n_vocab = self.llm.n_vocab()
+
+    @property
+    def n_tokens(self) -> int:
+        return self.llm.n_tokens
+
+    def seek(self, n_tokens: int):
+        self.llm.n_tokens = n_tokens
+
+    def reset(self):
+        self.llm.reset()
+
+    def eval(self, tokens) -> np.ndarray:
+        """Append tokens to the sequence, return the float32 logits of the last one."""
+        self.llm.eval([int(t) for t in tokens])
+        logits = self.llama_cpp.llama_get_logits_ith(self.llm.ctx, -1)
+        return np.ctypeslib.as_array(
+            ctypes.cast(logits, ctypes.POINTER(ctypes.c_float)), shape=(self.n_vocab,)
+        ).copy()
@@ -11,7 +11,7 @@ def check_exit(status: int):
 
 
 if __name__ == "__main__":
-    parser.parse_args()  # make --help work
+    args = parser.parse_args()  # make --help work
     dirname = os.path.dirname(os.path.abspath(__file__))
 
     generation_timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
@@ -22,6 +22,9 @@ if __name__ == "__main__":
             f"python {os.path.join(dirname, 'infer_stage1.py')} {' '.join(sys.argv[1:])} --generation_timestamp {generation_timestamp}"
         )
     )
+    if args.preview_only:
+        print("Preview written, skipping stage 2 and postprocessing.")
+        sys.exit(0)
     print("Starting stage 2...")
     check_exit(
         os.system(
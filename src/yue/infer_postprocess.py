@@ -1,10 +1,12 @@
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import soundfile as sf
 import torch
 import torchaudio
-from models.soundstream_hubert_new import SoundStream
+from manifest import ManifestProgress, load_manifest
+from models.soundstream_hubert_new import SoundStreamDecoder
 from omegaconf import OmegaConf
 from post_process_audio import replace_low_freq_with_energy_matched
 from vocoder import build_codec_model, process_audio
@@ -25,8 +27,39 @@ def save_audio(wav: torch.Tensor, path, sample_rate: int, rescale: bool = False)
     )
 
 
+def load_codec_decoder(
+    config_path: str, resume_path: str, device: torch.device
+) -> SoundStreamDecoder:
+    model_config = OmegaConf.load(config_path)
+    assert model_config.generator.name == "SoundStream"
+    # Only decodes, so the semantic model and the encoders are never built
+    codec_model = SoundStreamDecoder(**model_config.generator.config).to(device)
+    # Loaded to the CPU, only the decoder's weights are copied to the device
+    parameter_dict = torch.load(resume_path, map_location="cpu", weights_only=False)
+    codec_model.load_state_dict(parameter_dict["codec_model"])
+    codec_model.eval()
+    codec_model.fuse_quantizer()
+    return codec_model
+
+
+def decode_codes(
+    codec_model: SoundStreamDecoder, codes: np.ndarray, device: torch.device
+) -> torch.Tensor:
+    """(n_q, T) codec ids of one track -> (1, samples) 16 kHz audio on the CPU."""
+    codes = torch.as_tensor(codes.astype(np.int16), dtype=torch.long).unsqueeze(1)
+    # In 30s chunks, whole songs would take GBs of decoder activations
+    wav = codec_model.decode_chunked(codes.to(device))
+    return wav.float().cpu().squeeze(0)
+
+
+def mix_tracks(vocal_path: str, inst_path: str, mix_path: str):
+    vocal_stem, sr = sf.read(vocal_path)
+    instrumental_stem, _ = sf.read(inst_path)
+    sf.write(mix_path, vocal_stem + instrumental_stem, sr)
+
+
 def post_process(
-    codec_model: SoundStream,
+    codec_model: SoundStreamDecoder,
     device: torch.device,
     output_dir: str,
     config_path: str,
@@ -35,6 +68,8 @@ def post_process(
     rescale: bool,
     custom_filename: str,
     generation_timestamp: str,
+    vocal_decoder=None,
+    inst_decoder=None,
 ):
     # custom filename
     custom_filename = sanitize_filename(custom_filename).strip()
@@ -52,22 +87,11 @@ def post_process(
     ]
     tracks = []
     for npy in stage2_result:
-        codec_result = np.load(npy)
-        decodec_rlt = []
-        decoded_waveform = codec_model.decode(
-            torch.as_tensor(codec_result.astype(np.int16), dtype=torch.long)
-            .unsqueeze(0)
-            .permute(1, 0, 2)
-            .to(device)
-        )
-        decoded_waveform = decoded_waveform.cpu().squeeze(0)
-        decodec_rlt.append(torch.as_tensor(decoded_waveform))
-        decodec_rlt = torch.cat(decodec_rlt, dim=-1)
         save_path = os.path.join(
             recons_output_dir, os.path.splitext(os.path.basename(npy))[0] + ".mp3"
         )
         tracks.append(save_path)
-        save_audio(decodec_rlt, save_path, 16000)
+        save_audio(decode_codes(codec_model, np.load(npy), device), save_path, 16000)
     # mix tracks
     for inst_path in tracks:
         try:
@@ -83,17 +107,15 @@ def post_process(
                     recons_mix_dir,
                     os.path.basename(inst_path).replace("itrack", "mixed"),
                 )
-                vocal_stem, sr = sf.read(inst_path)
-                instrumental_stem, _ = sf.read(vocal_path)
-                mix_stem = (vocal_stem + instrumental_stem) / 1
-                sf.write(recons_mix, mix_stem, sr)
+                mix_tracks(vocal_path, inst_path, recons_mix)
         except Exception as e:
             print(e)
 
     # vocoder to upsample audios
-    vocal_decoder, inst_decoder = build_codec_model(
-        config_path, vocal_decoder_path, inst_decoder_path
-    )
+    if vocal_decoder is None or inst_decoder is None:
+        vocal_decoder, inst_decoder = build_codec_model(
+            config_path, vocal_decoder_path, inst_decoder_path
+        )
     vocoder_output_dir = os.path.join(output_dir, "vocoder")
     vocoder_stems_dir = os.path.join(vocoder_output_dir, "stems")
     vocoder_mix_dir = os.path.join(vocoder_output_dir, "mix")
@@ -141,6 +163,45 @@ def post_process(
     )
 
 
+def run_manifest(args, codec_model: SoundStreamDecoder, device: torch.device):
+    """Post-process every --manifest job that finished stage 2 in a pool of worker threads."""
+    jobs = load_manifest(args.manifest)
+    progress = ManifestProgress(args.output_dir)
+    pending = progress.pending(jobs, "postprocess")
+
+    # Models are shared read-only between the workers
+    vocal_decoder, inst_decoder = build_codec_model(
+        args.config_path, args.vocal_decoder_path, args.inst_decoder_path
+    )
+
+    def work(job):
+        post_process(
+            codec_model,
+            device,
+            job.output_dir(args.output_dir),
+            args.config_path,
+            args.vocal_decoder_path,
+            args.inst_decoder_path,
+            args.rescale,
+            job.name,
+            args.generation_timestamp,
+            vocal_decoder=vocal_decoder,
+            inst_decoder=inst_decoder,
+        )
+
+    with ThreadPoolExecutor(max_workers=args.postprocess_workers) as pool:
+        futures = {pool.submit(work, job): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                future.result()
+                progress.mark(job, "postprocess")
+            except Exception as e:
+                print(f"Post-processing {job.name} failed: {e}")
+                progress.mark(job, "postprocess", f"failed: {e}")
+            print(f"Manifest: {progress.summary(jobs)}")
+
+
 def main():
     args = parser.parse_args()
     if args.seed is not None:
@@ -151,14 +212,11 @@ def main():
     device = torch.device(
         f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu"
     )
-    model_config = OmegaConf.load(args.basic_model_config)
-    assert model_config.generator.name == "SoundStream"
-    codec_model = SoundStream(**model_config.generator.config).to(device)
-    parameter_dict = torch.load(
-        args.resume_path, map_location=device, weights_only=False
-    )
-    codec_model.load_state_dict(parameter_dict["codec_model"])
-    codec_model.eval()
+    codec_model = load_codec_decoder(args.basic_model_config, args.resume_path, device)
+
+    if args.manifest:
+        run_manifest(args, codec_model, device)
+        return
 
     post_process(
         codec_model,
@@ -1,26 +1,39 @@
 import os
-import random
 import re
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-import torchaudio
+from audio_io import load_audio_mono
+from audio_prompt_cache import AudioPromptCache
 from codecmanipulator import CodecManipulator
 from einops import rearrange
-from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Tokenizer
-from exllamav2.generator import ExLlamaV2Sampler
+from infer_postprocess import decode_codes, load_codec_decoder, mix_tracks, save_audio
+from loop_detector import LoopDetector
+from manifest import ManifestJob, ManifestProgress, load_manifest
 from mmtokenizer import _MMSentencePieceTokenizer
 from models.soundstream_hubert_new import SoundStream
 from omegaconf import OmegaConf
-from torchaudio.transforms import Resample
+from stage1_backends import Stage1Backend_EXL2, Stage1Backend_GGUF, Stage1Backend_HF
+from stage1_engine import Stage1Engine, Stage1Job, plan_page_len
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, LogitsProcessorList
 
-from common import BlockTokenRangeProcessor, get_cache_class, parser, seed_everything
+from common import (
+    AllowedVocabProcessor,
+    parser,
+    plan_cache_len,
+    seed_everything,
+    stage1_needed_tokens,
+)
+
+# Stage 1 samples EOA or an xcodec token, backends only compute logits in this range
+STAGE1_LOGITS_BEGIN = 32002  # EOA
+STAGE1_CODEC_BEGIN = 45334
+STAGE1_LOGITS_END = 56722
+STAGE1_MIN_NEW_TOKENS = 100  # EOA can't be sampled before
 
 
 @dataclass
@@ -39,25 +52,23 @@ class SampleSettings:
             self.guidance_scale = None
 
 
-def load_audio_mono(filepath, sampling_rate=16000):
-    audio, sr = torchaudio.load(filepath)
-    # Convert to mono
-    audio = torch.mean(audio, dim=0, keepdim=True)
-    # Resample if needed
-    if sr != sampling_rate:
-        resampler = Resample(orig_freq=sr, new_freq=sampling_rate)
-        audio = resampler(audio)
-    return audio
+def encode_audio(codec_model, audio_prompts, device, target_bw=0.5):
+    """Codes of (1, samples) mono signals, encoded as one zero padded batch."""
+    lengths = [audio.shape[-1] for audio in audio_prompts]
+    batch = torch.zeros((len(audio_prompts), 1, max(lengths)))
+    for i, audio in enumerate(audio_prompts):
+        batch[i, :, : lengths[i]] = audio
+    with torch.no_grad():
+        # Long audio is encoded in 30s chunks, with the peak memory of a short prompt
+        codes = codec_model.encode_batch(batch.to(device), lengths, target_bw=target_bw)
+    return [raw_codes.transpose(0, 1).cpu().numpy().astype(np.int16) for raw_codes in codes]
 
 
-def encode_audio(codec_model, audio_prompt, device, target_bw=0.5):
-    if len(audio_prompt.shape) < 3:
-        audio_prompt.unsqueeze_(0)
-    with torch.no_grad():
-        raw_codes = codec_model.encode(audio_prompt.to(device), target_bw=target_bw)
-    raw_codes = raw_codes.transpose(0, 1)
-    raw_codes = raw_codes.cpu().numpy().astype(np.int16)
-    return raw_codes
+def interleave_tracks(vocals_ids: List[int], instrumental_ids: List[int]) -> List[int]:
+    """Vocal and instrumental ids alternating frame by frame, cut to the shorter track."""
+    min_length = min(len(vocals_ids), len(instrumental_ids))
+    tracks = np.stack([vocals_ids[:min_length], instrumental_ids[:min_length]], axis=1)
+    return tracks.reshape(-1).tolist()
 
 
 class Stage1Pipeline:
@@ -72,12 +83,21 @@ class Stage1Pipeline:
         extend_mp3_start_time: int,
         extend_mp3_end_time: int,
         extend_current_segment: bool,
+        cache_size: int = 16384,
+        cache_bucket: int = 1024,
+        loop_policy: str = "off",
+        loop_retries: int = 0,
+        loop_window: int = 200,
+        audio_prompt_cache: str = "",
     ):
         self.device = device
+        self.backend = None
         self.codec_tool = CodecManipulator("xcodec", 0, 1)
         self.basic_model_config = basic_model_config
         self.resume_path = resume_path
         self.codec_model = None
+        self.codec_decoder = None
+        self.audio_prompt_cache = AudioPromptCache(resume_path, audio_prompt_cache)
 
         # Load tokenizer
         self.mmtokenizer = _MMSentencePieceTokenizer(
@@ -90,6 +110,22 @@ class Stage1Pipeline:
         self.start_of_segment = self.mmtokenizer.tokenize("[start_of_segment]")
         self.end_of_segment = self.mmtokenizer.tokenize("[end_of_segment]")
 
+        # Tokens that can be sampled, EOA only after STAGE1_MIN_NEW_TOKENS
+        eoa = self.mmtokenizer.eoa
+        self.vocab = AllowedVocabProcessor(
+            [(eoa, eoa + 1), (STAGE1_CODEC_BEGIN, STAGE1_LOGITS_END)]
+        )
+        self.codec_vocab = AllowedVocabProcessor([(STAGE1_CODEC_BEGIN, STAGE1_LOGITS_END)])
+
+        # cache_size is the upper bound, each job allocates what it needs
+        self.cache_size = cache_size
+        self.cache_bucket = cache_bucket
+
+        # Degenerate segment handling
+        self.loop_policy = loop_policy
+        self.loop_retries = loop_retries
+        self.loop_window = loop_window
+
     def load_codec_model(self):
         if self.codec_model is not None:
             return
@@ -103,6 +139,27 @@ class Stage1Pipeline:
         self.codec_model.to(self.device)  # from old
         self.codec_model.eval()
 
+    def encode_audio_files(
+        self, paths: List[str], start_time: float = 0.0, end_time: Optional[float] = None
+    ) -> List[List[int]]:
+        """Codec token ids of each path from start_time to end_time (the end of the file if None).
+
+        The cache holds the codes of whole files, so every range of a file is cut
+        from one encode that matches a full-length encode at the range's edges.
+        The files that aren't cached are encoded as one batch, and the codec
+        model is only loaded if one isn't cached.
+        """
+        start_frame = int(start_time * 50)  # 50 is tps of xcodec
+        end_frame = None if end_time is None else int(end_time * 50)
+
+        def encode(missed_paths):
+            self.load_codec_model()
+            audios = [load_audio_mono(path, 16000) for path in missed_paths]
+            return encode_audio(self.codec_model, audios, self.device, target_bw=0.5)
+
+        codes = self.audio_prompt_cache.get_many(paths, 0.5, encode, start_frame, end_frame)
+        return [self.codec_tool.npy2ids(raw_codes[0]) for raw_codes in codes]
+
     def get_prompt_texts(self, genres: str, lyrics: str):
         def split_lyrics(lyrics):
             pattern = r"\[(\w+)\](.*?)(?=\[|\Z)"
@@ -130,39 +187,18 @@ class Stage1Pipeline:
         prompt_start_time: int,
         prompt_end_time: int,
     ):
-        self.load_codec_model()
         if use_dual_tracks_prompt:
-            vocals_ids = load_audio_mono(vocal_track_prompt_path)
-            instrumental_ids = load_audio_mono(instrumental_track_prompt_path)
-            vocals_ids = encode_audio(
-                self.codec_model, vocals_ids, self.device, target_bw=0.5
-            )
-            instrumental_ids = encode_audio(
-                self.codec_model, instrumental_ids, self.device, target_bw=0.5
-            )
-            vocals_ids = self.codec_tool.npy2ids(vocals_ids[0])
-            instrumental_ids = self.codec_tool.npy2ids(instrumental_ids[0])
-            # Ensure both arrays are of the same minimum length
-            min_length = min(len(vocals_ids), len(instrumental_ids))
-            vocals_ids = vocals_ids[:min_length]
-            instrumental_ids = instrumental_ids[:min_length]
-            ids_segment_interleaved = rearrange(
-                [np.array(vocals_ids), np.array(instrumental_ids)], "b n -> (n b)"
+            vocals_ids, instrumental_ids = self.encode_audio_files(
+                [vocal_track_prompt_path, instrumental_track_prompt_path],
+                prompt_start_time,
+                prompt_end_time,
             )
-            audio_prompt_codec = ids_segment_interleaved[
-                int(prompt_start_time * 50 * 2) : int(prompt_end_time * 50 * 2)
-            ]
-            audio_prompt_codec = audio_prompt_codec.tolist()
+            audio_prompt_codec = interleave_tracks(vocals_ids, instrumental_ids)
         elif use_audio_prompt:
-            audio_prompt = load_audio_mono(audio_prompt_path)
-            raw_codes = encode_audio(
-                self.codec_model, audio_prompt, self.device, target_bw=0.5
-            )
             # Format audio prompt
-            code_ids = self.codec_tool.npy2ids(raw_codes[0])
-            audio_prompt_codec = code_ids[
-                int(prompt_start_time * 50) : int(prompt_end_time * 50)
-            ]  # 50 is tps of xcodec
+            (audio_prompt_codec,) = self.encode_audio_files(
+                [audio_prompt_path], prompt_start_time, prompt_end_time
+            )
         audio_prompt_codec_ids = (
             [self.mmtokenizer.soa]
             + self.codec_tool.sep_ids
@@ -222,12 +258,105 @@ class Stage1Pipeline:
             + self.codec_tool.sep_ids
         )
 
+    def get_segment_prompts(
+        self,
+        prompt_texts: List[str],
+        run_n_segments: int,
+        use_dual_tracks_prompt: bool,
+        vocal_track_prompt_path: str,
+        instrumental_track_prompt_path: str,
+        use_audio_prompt: bool,
+        audio_prompt_path: str,
+        prompt_start_time: int,
+        prompt_end_time: int,
+    ) -> List[List[int]]:
+        """Prompt token ids of each segment of a fresh song."""
+        segment_prompts = [
+            self.get_first_segment_prompt(
+                prompt_texts[1],
+                prompt_texts[0],
+                use_dual_tracks_prompt,
+                vocal_track_prompt_path,
+                instrumental_track_prompt_path,
+                use_audio_prompt,
+                audio_prompt_path,
+                prompt_start_time,
+                prompt_end_time,
+            )
+        ]
+        segment_prompts += [
+            self.get_segment_prompt(prompt_texts[i + 1])
+            for i in range(1, run_n_segments)
+        ]
+        return segment_prompts
+
+    def sample(
+        self,
+        logits: torch.Tensor,
+        cfg_scale,
+        seen: torch.Tensor,
+        vocab: AllowedVocabProcessor,
+        sample_settings: SampleSettings,
+        generator: torch.Generator,
+    ) -> torch.Tensor:
+        """Transformers-equiv. CFG, repetition penalty, token masking, temperature and top-p.
+
+        logits (bsz, n) and the seen mask cover the backend's logits slice, which
+        starts at STAGE1_LOGITS_BEGIN; returns the sampled index into it.
+        """
+        if cfg_scale is not None:
+            logits = F.log_softmax(logits, dim=-1)
+            logits = cfg_scale * logits[0] + (1 - cfg_scale) * logits[1]
+        else:
+            logits = logits[0]
+        penalty = sample_settings.repetition_penalty
+        logits = torch.where(
+            seen, torch.where(logits < 0, logits * penalty, logits / penalty), logits
+        )
+        logits = vocab.apply(logits, offset=STAGE1_LOGITS_BEGIN)
+        logits = logits / sample_settings.temperature
+
+        sorted_logits, sorted_idx = torch.sort(logits)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        remove = cumulative_probs <= 1 - sample_settings.top_p
+        remove[-1] = False
+        logits = logits.scatter(
+            0, sorted_idx, sorted_logits.masked_fill(remove, -float("inf"))
+        )
+        return torch.multinomial(logits.softmax(dim=-1), 1, generator=generator)
+
+    def sample_token(
+        self,
+        logits: torch.Tensor,
+        cfg_scale,
+        seen: torch.Tensor,
+        n_new_tokens: int,
+        sample_settings: SampleSettings,
+        generator: torch.Generator,
+    ) -> int:
+        """Token id sampled after n_new_tokens of the segment, EOA is allowed from STAGE1_MIN_NEW_TOKENS."""
+        vocab = self.vocab if n_new_tokens >= STAGE1_MIN_NEW_TOKENS else self.codec_vocab
+        return STAGE1_LOGITS_BEGIN + self.sample(
+            logits, cfg_scale, seen, vocab, sample_settings, generator
+        ).item()
+
+    def seen_mask(self, ids: List[int], device: torch.device) -> torch.Tensor:
+        """Repetition penalty mask of the sampled logits slice, True for tokens in ids."""
+        seen = torch.zeros(
+            STAGE1_LOGITS_END - STAGE1_LOGITS_BEGIN, dtype=torch.bool, device=device
+        )
+        ids = torch.tensor(ids, dtype=torch.long)
+        ids = ids[(ids >= STAGE1_LOGITS_BEGIN) & (ids < STAGE1_LOGITS_END)]
+        seen[(ids - STAGE1_LOGITS_BEGIN).to(device)] = True
+        return seen
+
     def save(
         self,
         raw_output: torch.Tensor,
         output_dir: str,
         use_audio_prompt: bool,
         use_dual_tracks_prompt: bool,
+        preview: bool = False,
     ):
         # save raw output and check sanity
         ids = raw_output[0].cpu().numpy()
@@ -262,6 +391,28 @@ class Stage1Pipeline:
         inst_save_path = os.path.join(stage1_output_dir, "itrack.npy")
         np.save(vocal_save_path, vocals)
         np.save(inst_save_path, instrumentals)
+        if preview:
+            self.save_preview(vocals, instrumentals, output_dir)
+
+    def save_preview(self, vocals: np.ndarray, instrumentals: np.ndarray, output_dir: str):
+        """Decode the codebook 0 tracks with the codec and write them and their mix at 16 kHz.
+
+        Sounds rougher than the stage 2 + vocoder result, but takes seconds, so a
+        take can be judged before running stage 2. Decoded and mixed like the
+        recons/ tracks of infer_postprocess, by the decoder half of the codec.
+        """
+        if self.codec_decoder is None:
+            self.codec_decoder = load_codec_decoder(
+                self.basic_model_config, self.resume_path, self.device
+            )
+        preview_dir = os.path.join(output_dir, "preview")
+        paths = []
+        for name, codes in (("vtrack", vocals), ("itrack", instrumentals)):
+            paths.append(os.path.join(preview_dir, f"{name}.mp3"))
+            save_audio(decode_codes(self.codec_decoder, codes, self.device), paths[-1], 16000)
+        mix_path = os.path.join(preview_dir, "mixed.mp3")
+        mix_tracks(paths[0], paths[1], mix_path)
+        print(f"Created preview: {mix_path}")
 
     def encode_existing_song_for_continuation(
         self,
@@ -272,39 +423,23 @@ class Stage1Pipeline:
     ) -> List[int]:
         """Encode dual-track audio into interleaved tokens, with trimming."""
 
-        self.load_codec_model()  # Ensure model is loaded
-
-        # Process vocals
-        voc_audio = load_audio_mono(vocal_path)
-        voc_raw = encode_audio(self.codec_model, voc_audio, self.device, target_bw=0.5)
-        voc_ids = self.codec_tool.npy2ids(voc_raw[0])
-
-        # Process instrumental
-        instr_audio = load_audio_mono(instrumental_path)
-        instr_raw = encode_audio(
-            self.codec_model, instr_audio, self.device, target_bw=0.5
+        # Cut from the cached codes of the whole files, which the dual-track
+        # prompt of the same files shares whatever its range
+        start_time, end_time = 0, None
+        if extend_mp3_start_time > 0 or extend_mp3_end_time > 0:
+            start_time = extend_mp3_start_time
+            end_time = extend_mp3_end_time if extend_mp3_end_time > 0 else None
+        voc_ids, instr_ids = self.encode_audio_files(
+            [vocal_path, instrumental_path], start_time, end_time
         )
-        instr_ids = self.codec_tool.npy2ids(instr_raw[0])
-
-        # Validate & interleave
-        min_length = min(len(voc_ids), len(instr_ids))
-        interleaved = [
-            tok
-            for pair in zip(voc_ids[:min_length], instr_ids[:min_length])
-            for tok in pair
-        ]
+        interleaved = interleave_tracks(voc_ids, instr_ids)
 
         if extend_mp3_start_time > 0 or extend_mp3_end_time > 0:
-            if extend_mp3_end_time == 0:
-                extend_mp3_end_time = 999
-            interleaved = interleaved[
-                int(extend_mp3_start_time * 50 * 2) : int(extend_mp3_end_time * 50 * 2)
-            ]
             print(
                 "trimmed extend_mp3_interleaved to "
                 + str(extend_mp3_start_time)
                 + "-"
-                + str(extend_mp3_end_time)
+                + str(extend_mp3_end_time or "end")
                 + " s, size:"
                 + str(len(interleaved))
                 + " tokens"
@@ -312,27 +447,6 @@ class Stage1Pipeline:
 
         return interleaved
 
-
-class Stage1Pipeline_HF(Stage1Pipeline):
-    def __init__(
-        self, model_path: str, device: torch.device, cache_size: int, **kwargs
-    ):
-        super().__init__(device, **kwargs)
-
-        # Load HF model
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.bfloat16,
-            attn_implementation="flash_attention_2",
-            # load_in_4bit=True,
-            device_map=self.device,
-        )
-        self.model.eval()
-        if torch.__version__ >= "2.0.0":
-            self.model = torch.compile(self.model)
-        self.cache_size = cache_size
-        print("load and compile done.")
-
     def generate(
         self,
         use_dual_tracks_prompt: bool,
@@ -348,14 +462,54 @@ class Stage1Pipeline_HF(Stage1Pipeline):
         prompt_end_time: int,
         seed: int,
         sample_settings: SampleSettings,
+        resume_after_n: int = -1,  # -1: don't resume, 0: after first
+        extend_mp3: bool = False,
+        extend_mp3_start_time: int = 0,  # 0: start
+        extend_mp3_end_time: int = 0,  # 0: all
+        extend_current_segment: bool = False,
     ) -> torch.Tensor:
+        cfg = sample_settings.guidance_scale_seg0 is not None
+        bsz = 2 if cfg else 1
+
         lyrics, prompt_texts = self.get_prompt_texts(genres, lyrics)
-        run_n_segments = min(run_n_segments, len(lyrics))
 
-        for i in tqdm(range(run_n_segments)):
-            # Get prompt
-            if i == 0:
-                prompt_ids = self.get_first_segment_prompt(
+        # Context limit of the largest cache we are allowed to allocate
+        max_context = self.cache_size - max_new_tokens - 1
+
+        # seq holds the tokens before the first segment prompt
+        seq = []
+        if resume_after_n >= 0:
+            print(f"Resuming after segment {resume_after_n}")
+            seq = self.load_checkpoint(resume_after_n)
+            start_segment = resume_after_n + 1
+        elif extend_mp3 and not extend_current_segment:
+            start_segment = 1
+        else:
+            start_segment = 0
+
+        # Adjust the number of segments to generate
+        max_possible = len(lyrics) - start_segment
+        remaining_segments = min(run_n_segments, max_possible)
+        if remaining_segments <= 0:
+            return torch.tensor([seq], dtype=torch.long)  # No more segments to generate
+        segments = range(start_segment, start_segment + remaining_segments)
+
+        if resume_after_n >= 0:
+            segment_prompts = [self.get_segment_prompt(prompt_texts[i + 1]) for i in segments]
+        elif extend_mp3:
+            print("Tokenizing mp3s")
+            existing_tokens = self.encode_existing_song_for_continuation(
+                vocal_track_prompt_path,
+                instrumental_track_prompt_path,
+                extend_mp3_start_time,
+                extend_mp3_end_time,
+            )
+            if len(existing_tokens) > max_context:
+                existing_tokens = existing_tokens[-max_context:]
+                print("seq_prefix > max_context, truncating up to " + str(max_context))
+            # Continue the mp3 in its segment, or end it and start the next one
+            first_prompt = (
+                self.get_first_segment_prompt(
                     prompt_texts[1],
                     prompt_texts[0],
                     use_dual_tracks_prompt,
@@ -366,423 +520,382 @@ class Stage1Pipeline_HF(Stage1Pipeline):
                     prompt_start_time,
                     prompt_end_time,
                 )
+                + existing_tokens
+            )
+            if extend_current_segment:
+                print("extending current [segment] 0")
             else:
-                prompt_ids = self.get_segment_prompt(prompt_texts[i + 1])
-            prompt_ids = torch.as_tensor(prompt_ids).unsqueeze(0).to(self.device)
-            input_ids = (
-                torch.cat([raw_output, prompt_ids], dim=1) if i > 0 else prompt_ids
+                print("extending mp3, creating new [segment] 1")
+                first_prompt += [self.mmtokenizer.eoa] + self.get_segment_prompt(
+                    prompt_texts[start_segment + 1]
+                )
+            segment_prompts = [first_prompt] + [
+                self.get_segment_prompt(prompt_texts[i + 1]) for i in segments[1:]
+            ]
+        else:
+            segment_prompts = self.get_segment_prompts(
+                prompt_texts,
+                remaining_segments,
+                use_dual_tracks_prompt,
+                vocal_track_prompt_path,
+                instrumental_track_prompt_path,
+                use_audio_prompt,
+                audio_prompt_path,
+                prompt_start_time,
+                prompt_end_time,
             )
 
-            print("before window slicing")
+        # Size the cache for this job instead of always allocating cache_size
+        needed_tokens = stage1_needed_tokens(
+            len(seq), segment_prompts, max_new_tokens, self.cache_size
+        )
+        cache_len = plan_cache_len(needed_tokens, self.cache_size, self.cache_bucket)
+        print(
+            f"Stage 1 cache: {cache_len} tokens x {bsz} "
+            f"(job needs {needed_tokens}, limit {self.cache_size})"
+        )
+        max_context = cache_len - max_new_tokens - 1
+        self.backend.alloc(bsz, cache_len)
+        window_start = 0
+
+        device = self.backend.device
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        loop_detector = LoopDetector(window=self.loop_window)
+        os.makedirs("segments", exist_ok=True)
+
+        for n, i in enumerate(tqdm(segments)):
+            seq += segment_prompts[n]
+
             # Use window slicing in case output sequence exceeds the context of model
-            max_context = self.cache_size - max_new_tokens - 1
-            if input_ids.shape[-1] > max_context:
+            if len(seq) > max_context:
                 print(
-                    f"Section {i}: output length {input_ids.shape[-1]} exceeding context length {max_context}, "
+                    f"Section {i}: output length {len(seq)} exceeding context length {max_context}, "
                     f"now using the last {max_context} tokens."
                 )
-                input_ids = input_ids[:, -max_context:]
-
-            # past_key_values = StaticCache(
-            #    #self.model.config, max_batch_size=1, max_cache_len=input_ids.shape[-1] + max_new_tokens, device=self.model.device, dtype=self.model.dtype
-            #    self.model.config, max_batch_size=1, max_cache_len=3780, device=self.model.device, dtype=torch.bfloat16
-            # )
-            # cache_config = QuantizedCacheConfig(backend='HQQ', nbits=8, device=self.model.device, compute_dtype=torch.bfloat16)
-            # past_key_values = HQQQuantizedCache(cache_config=cache_config)
-
-            processors = LogitsProcessorList(
-                [
-                    BlockTokenRangeProcessor(0, 32002),
-                    BlockTokenRangeProcessor(32016, 32016),
-                ]
+                window_start = len(seq) - max_context
+                self.backend.trim(0)
+            full_ids = seq[window_start:]
+
+            # Forward what the cache is missing, the unconditional row only sees the last token
+            logits = self.backend.prefill(
+                full_ids[self.backend.n_tokens :], len(full_ids) - 1
+            )
+            seen = self.seen_mask(full_ids, device)
+
+            # Snapshot the segment start so a degenerate take can be resampled
+            segment_start = (self.backend.snapshot(), logits, seen.clone())
+            loop_detector.reset()
+            loop_events = []
+            cfg_scale = (
+                sample_settings.guidance_scale_seg0
+                if i == 0
+                else sample_settings.guidance_scale
             )
 
-            print("before model generate")
-            with torch.no_grad():
-                output_seq = self.model.generate(
-                    input_ids=input_ids,
-                    max_new_tokens=max_new_tokens,
-                    min_new_tokens=100,
-                    do_sample=True,
-                    top_p=sample_settings.top_p,
-                    temperature=sample_settings.temperature,
-                    repetition_penalty=sample_settings.repetition_penalty,
-                    eos_token_id=self.mmtokenizer.eoa,
-                    pad_token_id=self.mmtokenizer.eoa,
-                    logits_processor=processors,
-                    guidance_scale=(
-                        sample_settings.guidance_scale_seg0
-                        if i == 0
-                        else sample_settings.guidance_scale
-                    ),
-                    # past_key_values=past_key_values,
-                )
-            print("after model generate")
+            # Generate until EOA or max_new_tokens
+            new_ids = []
+            progress = tqdm(total=max_new_tokens, mininterval=10)
+            while True:
+                # Make sure sequence ends with EOA if we reached max_new_tokens
+                if len(new_ids) == max_new_tokens:
+                    token = self.mmtokenizer.eoa
+                else:
+                    token = self.sample_token(
+                        logits,
+                        cfg_scale if cfg else None,
+                        seen,
+                        len(new_ids),
+                        sample_settings,
+                        generator,
+                    )
 
-            if output_seq[0][-1].item() != self.mmtokenizer.eoa:
-                tensor_eoa = torch.tensor(
-                    [[self.mmtokenizer.eoa]], dtype=torch.long, device=output_seq.device
-                )
-                output_seq = torch.cat((output_seq, tensor_eoa), dim=1)
-            if i > 0:
-                raw_output = torch.cat(
-                    [raw_output, prompt_ids, output_seq[:, input_ids.shape[-1] :]],
-                    dim=1,
-                )
-            else:
-                raw_output = output_seq
-        return raw_output
+                # Watch for token loops and silence
+                if self.loop_policy != "off" and len(new_ids) < max_new_tokens:
+                    event = loop_detector.update(token)
+                    if event is not None:
+                        event.update(
+                            segment=i, new_tokens=len(new_ids), retry=len(loop_events)
+                        )
+                        loop_events.append(event)
+                        if (
+                            self.loop_policy == "resample"
+                            and len(loop_events) <= self.loop_retries
+                        ):
+                            print(
+                                f"Section {i}: degenerate output ({event['reason']}) "
+                                f"after {len(new_ids)} tokens, resampling segment."
+                            )
+                            snapshot, logits, seen = segment_start
+                            seen = seen.clone()
+                            self.backend.trim(snapshot)
+                            loop_detector.reset()
+                            new_ids = []
+                            progress.reset()
+                            continue
+                        print(
+                            f"Section {i}: degenerate output ({event['reason']}) "
+                            f"after {len(new_ids)} tokens, ending segment."
+                        )
+                        token = self.mmtokenizer.eoa
+
+                # Accept token, update cache even if it is EOA so the next segment follows it
+                new_ids.append(token)
+                seen[token - STAGE1_LOGITS_BEGIN] = True
+                progress.update()
+                logits = self.backend.decode_step(token)
+
+                # End on EOA
+                if token == self.mmtokenizer.eoa:
+                    break
+            progress.close()
+            if loop_events:
+                print(f"Section {i}: degeneration events: {loop_events}")
+            seq += new_ids
+
+            # After each segment, save the sequence so far for --resume_after_n
+            checkpoint = {
+                "current_segment": i,
+                "seq": torch.tensor([seq], dtype=torch.long),
+                "lyrics": lyrics,  # Save original lyrics structure
+                "loop_events": loop_events,
+            }
+            torch.save(checkpoint, f"segments/segment_{i}.pt")
 
+        return torch.tensor([seq], dtype=torch.long)
 
-class Stage1Pipeline_EXL2(Stage1Pipeline):
+    def load_checkpoint(self, segment: int) -> List[int]:
+        path = Path(f"segments/segment_{segment}.pt")
+        if not path.exists():
+            raise FileNotFoundError(
+                f"Error: file does not exist: {path}. Can't continue generation after segment {segment}. Set --resume_after_n=-1 and try again."
+            )
+        checkpoint = torch.load(path, map_location="cpu")
+        # Older checkpoints hold one identical row per CFG row
+        return checkpoint["seq"][0].tolist()
+
+
+class Stage1Pipeline_HF(Stage1Pipeline):
     def __init__(
         self,
         model_path: str,
         device: torch.device,
-        cache_size: int,
-        cache_mode: str,
-        no_flash_attn: bool,
+        cache_mode: str = "FP16",
+        prefill_chunk: int = 512,
+        compile: bool = True,
         **kwargs,
     ):
         super().__init__(device, **kwargs)
+        self.backend = Stage1Backend_HF(
+            model_path,
+            device,
+            cache_mode=cache_mode,
+            prefill_chunk=prefill_chunk,
+            compile=compile,
+            logits_begin=STAGE1_LOGITS_BEGIN,
+            logits_end=STAGE1_LOGITS_END,
+        )
+        print("load and compile done.")
 
-        assert device != "cpu", "ExLlamaV2 does not support CPU inference."
-
-        # Load EXL2 model
-        device_idx = self.device.index
-        gpu_split = [0] * torch.cuda.device_count()
-        gpu_split[device_idx] = 9999
-        exl2_config = ExLlamaV2Config(model_path)
-        exl2_config.no_sdpa = True  # TODO: Figure out why SDPA slows to a crawl when given custom attn mask
-        if no_flash_attn:
-            exl2_config.no_flash_attn = True  # for old devices, 2000 series and older
-        self.model = ExLlamaV2(exl2_config)
-        self.model.load(gpu_split)
-
-        # Load tokenizer (only needed for vocab size in disallow_tokens)
-        self.tokenizer = ExLlamaV2Tokenizer(exl2_config)
-
-        # Define cache
-        self.cache_size = cache_size
-        self.cache_mode = get_cache_class(cache_mode)
 
-        # TODO: Output layer could be trimmed here to avoid masking out the first 32k tokens during generation
+class Stage1Pipeline_GGUF(Stage1Pipeline):
+    """Stage 1 on CPU through llama.cpp with a quantized GGUF model (see convert_gguf.py)."""
 
-    def _rebuild_cache(self, seq, cache, max_new_tokens, cache_size):
-        """Process historical tokens to rebuild KV cache"""
-        max_context = cache_size - max_new_tokens - 1
-        cache.current_seq_len = 0  # Reset cache
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        cache_size: int,
+        cache_mode: str = "FP16",
+        n_threads: int = None,
+        max_new_tokens: int = 3000,
+        **kwargs,
+    ):
+        super().__init__(device, cache_size=cache_size, **kwargs)
+        self.backend = Stage1Backend_GGUF(
+            model_path,
+            cache_size,
+            cache_mode=cache_mode,
+            n_threads=n_threads,
+            max_new_tokens=max_new_tokens,
+            logits_begin=STAGE1_LOGITS_BEGIN,
+            logits_end=STAGE1_LOGITS_END,
+        )
 
-        if seq.shape[-1] > max_context:
-            # Use sliding window matching original logic
-            truncated_seq = seq[:, -max_context:]
-        else:
-            truncated_seq = seq
 
-        # Process through model in one forward pass
-        self.model.forward(truncated_seq, cache=cache)
+class Stage1Pipeline_EXL2(Stage1Pipeline):
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        cache_mode: str,
+        no_flash_attn: bool,
+        **kwargs,
+    ):
+        super().__init__(device, **kwargs)
+        self.backend = Stage1Backend_EXL2(
+            model_path,
+            device,
+            cache_mode=cache_mode,
+            no_flash_attn=no_flash_attn,
+            logits_begin=STAGE1_LOGITS_BEGIN,
+            logits_end=STAGE1_LOGITS_END,
+        )
+        self.model = self.backend.model
+        self.cache_mode = self.backend.cache_class
+
+    def create_engine(
+        self, max_rows: int, max_new_tokens: int, jobs: List[Stage1Job] = ()
+    ) -> Stage1Engine:
+        """Continuous-batching engine sharing this model between many songs.
+
+        Each song gets a cache page sized for it. The batch cache fits the
+        largest page of jobs, or --stage1_cache_size without jobs.
+        """
+        page_len = self.cache_size
+        if jobs:
+            page_len = max(
+                plan_page_len(job, max_new_tokens, self.cache_size, self.cache_bucket)
+                for job in jobs
+            )
+        return Stage1Engine(
+            self.model,
+            self.cache_mode,
+            self,
+            eoa_id=self.mmtokenizer.eoa,
+            logits_begin=STAGE1_LOGITS_BEGIN,
+            logits_end=STAGE1_LOGITS_END,
+            max_rows=max_rows,
+            page_len=page_len,
+            max_new_tokens=max_new_tokens,
+            page_bucket=self.cache_bucket,
+            loop_policy=self.loop_policy,
+            loop_retries=self.loop_retries,
+            loop_window=self.loop_window,
+        )
 
-    def generate(
+    def build_job(
         self,
-        use_dual_tracks_prompt: bool,
-        vocal_track_prompt_path: str,
-        instrumental_track_prompt_path: str,
-        use_audio_prompt: bool,
-        audio_prompt_path: str,
+        job_id: str,
         genres: str,
         lyrics: str,
         run_n_segments: int,
-        max_new_tokens: int,
-        prompt_start_time: int,
-        prompt_end_time: int,
-        seed: int,
-        resume_after_n: int,  # -1: don't resume, 0: after first
-        extend_mp3: bool,
-        extend_mp3_start_time: int,  # 0: start
-        extend_mp3_end_time: int,  # 0: all
-        extend_current_segment: bool,
         sample_settings: SampleSettings,
-    ) -> torch.Tensor:
-        if sample_settings.guidance_scale_seg0 is None:
-            bsz = 1
-            cfg = False
-            position_offsets = None
-            input_mask = None
-        else:
-            bsz = 2
-            cfg = True
-
+        seed: int,
+        use_dual_tracks_prompt: bool = False,
+        vocal_track_prompt_path: str = "",
+        instrumental_track_prompt_path: str = "",
+        use_audio_prompt: bool = False,
+        audio_prompt_path: str = "",
+        prompt_start_time: float = 0.0,
+        prompt_end_time: float = 30.0,
+    ) -> Stage1Job:
+        """Build an engine job with the same prompts as generate() uses for a fresh song."""
         lyrics, prompt_texts = self.get_prompt_texts(genres, lyrics)
         run_n_segments = min(run_n_segments, len(lyrics))
-
-        # Cache for the whole output sequence
-        cache = self.cache_mode(self.model, batch_size=bsz, max_seq_len=self.cache_size)
-        max_context = self.cache_size - max_new_tokens - 1
-
-        # Add existing song context for continuation
-        if extend_mp3:
-            if vocal_track_prompt_path and instrumental_track_prompt_path:
-                print("Tokenizing mp3s")
-                existing_tokens = self.encode_existing_song_for_continuation(
-                    vocal_track_prompt_path,
-                    instrumental_track_prompt_path,
-                    extend_mp3_start_time,
-                    extend_mp3_end_time,
-                )
-                seq_prefix = torch.tensor([existing_tokens] * bsz, dtype=torch.long)
-                # Truncate to context limit
-                if seq_prefix.shape[-1] > max_context:
-                    seq_prefix = seq_prefix[:, -max_context:]
-                    print(
-                        "seq_prefix > max_context, truncating up to " + str(max_context)
-                    )
-            else:
-                print(
-                    "Error: empty vocal_track_prompt_path or instrumental_track_prompt_path"
-                )
-        else:
-            print("Creating empty input seq")
-            seq_prefix = torch.empty((bsz, 0), dtype=torch.long)
-
-        # Initialize seq with prefix
-        if resume_after_n == -1 and not extend_mp3:
-            seq = seq_prefix  # Start fresh
-        elif extend_mp3:
-            seq = seq_prefix.clone()
-            # Ensure prefix fits in context window
-            if seq.shape[-1] > max_context:
-                print(
-                    "seq.shape[-1] > max_context, truncating up to " + str(max_context)
-                )
-                seq = seq[:, -max_context:]
-                cache.current_seq_len = 0
-        else:
-            seq = seq_prefix.clone()  # empty
-
-        # Collect output here
-        if resume_after_n >= 0:
-            print(f"Resuming after segment {resume_after_n}")
-            # Load saved tokens
-            if Path(f"segments/segment_{resume_after_n}.pt").exists():
-                checkpoint = torch.load(
-                    f"segments/segment_{resume_after_n}.pt", map_location="cpu"
-                )
-            else:
-                raise FileNotFoundError(
-                    f"Error: file does not exist: segments/segment_{resume_after_n}.pt. Can't continue generation after segment {resume_after_n}. Set --resume_after_n=-1 and try again."
-                )
-            seq = checkpoint["seq"]
-
-            # Rebuild KV cache by processing the entire loaded sequence
-            # Use the same windowing strategy as during generation
-            if seq.shape[-1] > max_context:
-                # Truncate to fit within model's context window
-                truncated_seq = seq[:, -max_context:]
-                cache.current_seq_len = 0  # Reset cache since we truncated
-                print(
-                    "seq.shape[-1] > max_context (again), truncating up to "
-                    + str(max_context)
-                )
-            else:
-                truncated_seq = seq
-
-            # Forward the entire sequence through the model to populate cache
-            # Process in chunks if necessary to avoid OOM
-            self.model.forward(truncated_seq, cache=cache)
-            start_segment = resume_after_n + 1
-
-        elif extend_mp3 and extend_current_segment:
-            start_segment = 0
-        elif extend_mp3 and not extend_current_segment:
-            start_segment = 1
-        else:
-            start_segment = 0
-
-        # Adjust the number of segments to generate
-        max_possible = len(lyrics) - start_segment
-        remaining_segments = min(run_n_segments, max_possible)
-        if remaining_segments <= 0:
-            return seq[:1, :]  # No more segments to generate
-
-        # Sample settings
-        gen_settings = ExLlamaV2Sampler.Settings(
-            top_k=0,
+        segment_prompts = self.get_segment_prompts(
+            prompt_texts,
+            run_n_segments,
+            use_dual_tracks_prompt,
+            vocal_track_prompt_path,
+            instrumental_track_prompt_path,
+            use_audio_prompt,
+            audio_prompt_path,
+            prompt_start_time,
+            prompt_end_time,
+        )
+        return Stage1Job(
+            job_id=job_id,
+            segment_prompts=segment_prompts,
+            guidance_scale_seg0=sample_settings.guidance_scale_seg0,
+            guidance_scale=sample_settings.guidance_scale,
             top_p=sample_settings.top_p,
-            token_repetition_penalty=sample_settings.repetition_penalty,
             temperature=sample_settings.temperature,
+            repetition_penalty=sample_settings.repetition_penalty,
+            seed=seed,
         )
-        gen_settings.allow_tokens(self.tokenizer, [32002] + list(range(45334, 56722)))
-
-        # RNG for sampling, could seed here
-        rng = random.Random()
-        rng.seed(seed)
 
-        for i in tqdm(range(start_segment, start_segment + remaining_segments)):
-            # Get prompt for this segment
-            if i == 0 and resume_after_n == -1:
-                prompt_ids = self.get_first_segment_prompt(
-                    prompt_texts[1],
-                    prompt_texts[0],
-                    use_dual_tracks_prompt,
-                    vocal_track_prompt_path,
-                    instrumental_track_prompt_path,
-                    use_audio_prompt,
-                    audio_prompt_path,
-                    prompt_start_time,
-                    prompt_end_time,
-                )
-            else:
-                prompt_ids = self.get_segment_prompt(prompt_texts[i + 1])
-            prompt_ids = torch.tensor([prompt_ids] * bsz, dtype=torch.long)
 
-            # Accept prompt tokens
-            if extend_mp3 and i == start_segment and resume_after_n == -1:
-                prompt_ids_init = self.get_first_segment_prompt(
-                    prompt_texts[1],
-                    prompt_texts[0],
-                    use_dual_tracks_prompt,
-                    vocal_track_prompt_path,
-                    instrumental_track_prompt_path,
-                    use_audio_prompt,
-                    audio_prompt_path,
-                    prompt_start_time,
-                    prompt_end_time,
-                )
-                prompt_ids = self.get_segment_prompt(prompt_texts[i + 1])
-                prompt_ids_init = torch.tensor(prompt_ids_init, dtype=torch.long)
-                prompt_ids_init = prompt_ids_init.unsqueeze(0).repeat(bsz, 1)
-                sample_eoa = torch.tensor(
-                    [[self.mmtokenizer.eoa]] * bsz, dtype=torch.long
-                )  # add OEA after mp3
-                prompt_ids = torch.tensor([prompt_ids] * bsz, dtype=torch.long)
-
-                if extend_current_segment:
-                    # CURRENT verse. init + mp3
-                    print("extending current [segment] 0")
-                    seq = torch.cat((prompt_ids_init, seq), dim=-1)
-                else:
-                    # NEW verse. init + mp3 + EOA + new_lyrics
-                    print("extending mp3, creating new [segment] 1")
-                    seq = torch.cat(
-                        (prompt_ids_init, seq, sample_eoa, prompt_ids), dim=-1
-                    )
-                # Forward mp3 prompt
-                mask_len = seq.shape[-1] - 1
-                full_mask = torch.zeros(
-                    (2, cache.max_seq_len), dtype=torch.half, device=self.device
-                )
-                full_mask[1, :mask_len] = -65504.0
-                position_offsets = torch.tensor([[0], [-mask_len]], dtype=torch.int)
-                input_mask = full_mask[:, : seq.shape[-1]]
-                logits = self.model.forward(
-                    seq[:, :],
-                    cache=cache,
-                    input_mask=input_mask,
-                    position_offsets=position_offsets,
-                    last_id_only=True,
-                    seed=seed,
-                )
-            else:
-                seq = torch.cat((seq, prompt_ids), dim=-1)
-
-            # Use window slicing in case output sequence exceeds the context of model
-            max_context = self.cache_size - max_new_tokens - 1
-            if seq.shape[-1] > max_context:
-                print(
-                    f"Section {i}: output length {seq.shape[-1]} exceeding context length {max_context}, "
-                    f"now using the last {max_context} tokens."
-                )
-                cache.current_seq_len = 0
-                full_ids = seq[:, -max_context:]
-                incremental_ids = full_ids
-            else:
-                full_ids = seq
-                if extend_mp3:  # mp3 continue
-                    incremental_ids = prompt_ids
-                else:
-                    incremental_ids = prompt_ids  # original
-
-            # For the unconditional context, mask out all but the last token
-            if cfg:
-                mask_len = full_ids.shape[-1] - 1
-                full_mask = torch.zeros(
-                    (2, cache.max_seq_len), dtype=torch.half, device=self.device
-                )
-                full_mask[1, :mask_len] = -65504.0
-                position_offsets = torch.tensor([[0], [-mask_len]], dtype=torch.int)
-                input_mask = full_mask[:, : full_ids.shape[-1]]
-
-            # Forward prompt
-            logits = self.model.forward(
-                incremental_ids[:, :],
-                cache=cache,
-                input_mask=input_mask,
-                position_offsets=position_offsets,
-                last_id_only=True,
-                seed=seed,
+def run_manifest(args, pipeline: Stage1Pipeline, sample_settings: SampleSettings):
+    """Render stage 1 for every pending job of --manifest, batching songs together."""
+    jobs = load_manifest(args.manifest)
+    progress = ManifestProgress(args.output_dir)
+    pending = progress.pending(jobs, "stage1")
+    print(f"Manifest: {len(jobs)} jobs ({progress.summary(jobs)})")
+
+    def n_segments(job: ManifestJob) -> int:
+        lyrics, _ = pipeline.get_prompt_texts(job.genre, job.lyrics)
+        return min(job.run_n_segments or args.run_n_segments, len(lyrics))
+
+    def save(job: ManifestJob, raw_output: torch.Tensor):
+        pipeline.save(
+            raw_output,
+            job.output_dir(args.output_dir),
+            job.use_audio_prompt,
+            job.use_dual_tracks_prompt,
+            preview=args.preview or args.preview_only,
+        )
+        progress.mark(job, "stage1")
+        print(f"Stage 1 done: {job.name} ({progress.summary(jobs)})")
+
+    # Songs with the same segment count and similar length run side by side
+    pending.sort(key=lambda job: (n_segments(job), len(job.lyrics)))
+
+    # The engine needs ExLlamaV2, other backends render the songs one at a time
+    if isinstance(pipeline, Stage1Pipeline_EXL2):
+        by_name = {job.name: job for job in pending}
+        engine_jobs = [
+            pipeline.build_job(
+                job_id=job.name,
+                genres=job.genre,
+                lyrics=job.lyrics,
+                run_n_segments=n_segments(job),
+                sample_settings=sample_settings,
+                seed=job.seed if job.seed is not None else args.seed,
+                use_dual_tracks_prompt=job.use_dual_tracks_prompt,
+                vocal_track_prompt_path=job.vocal_track_prompt_path,
+                instrumental_track_prompt_path=job.instrumental_track_prompt_path,
+                use_audio_prompt=job.use_audio_prompt,
+                audio_prompt_path=job.audio_prompt_path,
+                prompt_start_time=job.prompt_start_time,
+                prompt_end_time=job.prompt_end_time,
             )
-
-            # Generate until EOS or max_new_tokens
-            for new_tokens in tqdm(range(max_new_tokens), mininterval=10):
-                # Transformers-equiv. CFG
-                if cfg:
-                    cfg_scale = (
-                        sample_settings.guidance_scale_seg0
-                        if i == 0
-                        else sample_settings.guidance_scale
-                    )
-                    logits = logits.float()
-                    logits = F.log_softmax(logits, dim=-1)
-                    logits = cfg_scale * logits[0] + (1 - cfg_scale) * logits[1]
-                    logits = logits.unsqueeze(0)
-
-                # Sample
-                logits = logits.float().cpu()
-                sample, _, _, _, _ = ExLlamaV2Sampler.sample(
-                    logits, gen_settings, full_ids[:1], rng.random(), self.tokenizer
-                )
-                if cfg:
-                    sample = torch.cat((sample, sample), dim=0)
-
-                # Accept token
-                full_ids = torch.cat((full_ids, sample), dim=-1)
-                seq = torch.cat((seq, sample), dim=-1)
-
-                # Get next logits (update cache even if sample is EOA and we don't need next logits)
-                if cfg:
-                    input_mask = full_mask[:, : full_ids.shape[-1]]
-                logits = self.model.forward(
-                    sample,
-                    cache=cache,
-                    input_mask=input_mask,
-                    position_offsets=position_offsets,
-                )
-
-                # End on EOA
-                if sample[0].item() == self.mmtokenizer.eoa:
-                    break
-
-            # Make sure sequence ends with EOA if we reached max_new_tokens
-            else:
-                sample = torch.tensor([[self.mmtokenizer.eoa]] * bsz, dtype=torch.long)
-                seq = torch.cat((seq, sample), dim=-1)
-                # Update cache with forced token
-                self.model.forward(sample, cache=cache)
-
-            # After each segment, save only the generated tokens
-            checkpoint = {
-                "current_segment": i,
-                "seq": seq.cpu().clone(),
-                "lyrics": lyrics,  # Save original lyrics structure
-            }
-            torch.save(checkpoint, f"segments/segment_{i}.pt")
-
-        raw_output = seq[:1, :]
-        return raw_output
+            for job in pending
+        ]
+        engine = pipeline.create_engine(
+            args.stage1_engine_rows, args.max_new_tokens, engine_jobs
+        )
+        for engine_job in engine_jobs:
+            engine.submit(engine_job)
+        while engine.has_work():
+            engine.step()
+            for engine_job in engine.finished:
+                save(by_name[engine_job.job_id], engine_job.seq[:1])
+            engine.finished.clear()
+    else:
+        for job in pending:
+            raw_output = pipeline.generate(
+                use_dual_tracks_prompt=job.use_dual_tracks_prompt,
+                vocal_track_prompt_path=job.vocal_track_prompt_path,
+                instrumental_track_prompt_path=job.instrumental_track_prompt_path,
+                use_audio_prompt=job.use_audio_prompt,
+                audio_prompt_path=job.audio_prompt_path,
+                genres=job.genre,
+                lyrics=job.lyrics,
+                run_n_segments=n_segments(job),
+                max_new_tokens=args.max_new_tokens,
+                prompt_start_time=job.prompt_start_time,
+                prompt_end_time=job.prompt_end_time,
+                seed=job.seed if job.seed is not None else args.seed,
+                sample_settings=sample_settings,
+            )
+            save(job, raw_output)
 
 
 def main():
     args = parser.parse_args()
+    if not args.manifest and not (args.genre_txt and args.lyrics_txt):
+        parser.error("--genre_txt and --lyrics_txt are required without --manifest")
     if args.use_audio_prompt and not args.audio_prompt_path:
         raise FileNotFoundError(
             "Please offer audio prompt filepath using '--audio_prompt_path', when you enable 'use_audio_prompt'!"
@@ -810,11 +923,6 @@ def main():
         f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu"
     )
 
-    with open(args.genre_txt, encoding="utf-8") as f:
-        genres = f.read().strip()
-    with open(args.lyrics_txt, encoding="utf-8") as f:
-        lyrics = f.read().strip()
-
     if args.stage1_use_exl2:
         pipeline = Stage1Pipeline_EXL2(
             model_path=args.stage1_model,
@@ -823,6 +931,11 @@ def main():
             resume_path=args.resume_path,
             cache_size=args.stage1_cache_size,
             cache_mode=args.stage1_cache_mode,
+            cache_bucket=args.cache_alloc_bucket,
+            loop_policy=args.stage1_loop_policy,
+            loop_retries=args.stage1_loop_retries,
+            loop_window=args.stage1_loop_window,
+            audio_prompt_cache=args.audio_prompt_cache,
             no_flash_attn=args.no_flash_attn,
             seed=args.seed,
             resume_after_n=args.resume_after_n,
@@ -831,6 +944,28 @@ def main():
             extend_mp3_end_time=args.extend_mp3_end_time,
             extend_current_segment=args.extend_current_segment,
         )
+    elif args.stage1_use_gguf:
+        pipeline = Stage1Pipeline_GGUF(
+            model_path=args.stage1_model,
+            device=device,
+            basic_model_config=args.basic_model_config,
+            resume_path=args.resume_path,
+            cache_size=args.stage1_cache_size,
+            cache_mode=args.stage1_cache_mode,
+            cache_bucket=args.cache_alloc_bucket,
+            n_threads=args.gguf_threads,
+            max_new_tokens=args.max_new_tokens,
+            loop_policy=args.stage1_loop_policy,
+            loop_retries=args.stage1_loop_retries,
+            loop_window=args.stage1_loop_window,
+            audio_prompt_cache=args.audio_prompt_cache,
+            seed=args.seed,
+            resume_after_n=args.resume_after_n,
+            extend_mp3=args.extend_mp3,
+            extend_mp3_start_time=args.extend_mp3_start_time,
+            extend_mp3_end_time=args.extend_mp3_end_time,
+            extend_current_segment=args.extend_current_segment,
+        )
     else:
         pipeline = Stage1Pipeline_HF(
             model_path=args.stage1_model,
@@ -838,9 +973,32 @@ def main():
             basic_model_config=args.basic_model_config,
             resume_path=args.resume_path,
             cache_size=args.stage1_cache_size,
+            cache_mode=args.stage1_cache_mode,
+            cache_bucket=args.cache_alloc_bucket,
+            prefill_chunk=args.stage1_prefill_chunk,
+            compile=not args.no_compile,
+            loop_policy=args.stage1_loop_policy,
+            loop_retries=args.stage1_loop_retries,
+            loop_window=args.stage1_loop_window,
+            audio_prompt_cache=args.audio_prompt_cache,
             seed=args.seed,
+            resume_after_n=args.resume_after_n,
+            extend_mp3=args.extend_mp3,
+            extend_mp3_start_time=args.extend_mp3_start_time,
+            extend_mp3_end_time=args.extend_mp3_end_time,
+            extend_current_segment=args.extend_current_segment,
         )
 
+    sample_settings = SampleSettings(use_guidance=not args.stage1_no_guidance)
+    if args.manifest:
+        run_manifest(args, pipeline, sample_settings)
+        return
+
+    with open(args.genre_txt, encoding="utf-8") as f:
+        genres = f.read().strip()
+    with open(args.lyrics_txt, encoding="utf-8") as f:
+        lyrics = f.read().strip()
+
     # Load tokenizer and models
     raw_output = pipeline.generate(
         use_dual_tracks_prompt=args.use_dual_tracks_prompt,
@@ -860,12 +1018,16 @@ def main():
         max_new_tokens=args.max_new_tokens,
         prompt_start_time=args.prompt_start_time,
         prompt_end_time=args.prompt_end_time,
-        sample_settings=SampleSettings(use_guidance=not args.stage1_no_guidance),
+        sample_settings=sample_settings,
     )
 
     # Save result
     pipeline.save(
-        raw_output, args.output_dir, args.use_audio_prompt, args.use_dual_tracks_prompt
+        raw_output,
+        args.output_dir,
+        args.use_audio_prompt,
+        args.use_dual_tracks_prompt,
+        preview=args.preview or args.preview_only,
     )
 
 
@@ -1,39 +1,94 @@
-import copy
 import gc
 import math
 import os
-from collections import Counter
+import queue
+import traceback
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List
 
 import numpy as np
 import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
 from codecmanipulator import CodecManipulator
-from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Tokenizer
+from gguf_context import GGUFContext
+from manifest import ManifestProgress, load_manifest
 from mmtokenizer import _MMSentencePieceTokenizer
+from stage2_cache import Stage2ResultCache, model_fingerprint
+from stage2_memory import CACHE_MODE_BYTES, Stage2MemoryModel, memory_budget
 from tqdm import tqdm
-from transformers import AutoModelForCausalLM, LogitsProcessorList
+from transformers import AutoModelForCausalLM
 from transformers.cache_utils import StaticCache
 
-from common import BlockTokenRangeProcessor, get_cache_class, parser, seed_everything
+from common import (
+    align,
+    get_cache_class,
+    parser,
+    seed_everything,
+)
 
+try:
+    from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Tokenizer
+except ImportError:  # HF-only install
+    ExLlamaV2 = ExLlamaV2Config = ExLlamaV2Tokenizer = None
 
-def align(n, m):
-    return ((n + m - 1) // m) * m
 
+# Songs decoded together in --manifest mode, results are saved after each pass
+MANIFEST_SONGS_PER_PASS = 16
 
-def split_bsz(bsz, maxbsz):
-    n_sub_batches = math.ceil(bsz / maxbsz)
-    base_size = bsz // n_sub_batches
-    remainder = bsz % n_sub_batches
-    sub_batch_sizes = [base_size + 1] * remainder + [base_size] * (
-        n_sub_batches - remainder
-    )
-    indices = []
-    start = 0
-    for size in sub_batch_sizes:
-        end = start + size
-        indices.append((start, end))
-        start = end
-    return indices
+STAGE2_PARTS = ["vtrack.npy", "itrack.npy"]
+
+# Step i of a frame generates codebook i + 1, whose 1024 ids start at
+# STAGE2_CODEBOOK_BEGIN + i * CODEBOOK_SIZE (after cb0 at 45334)
+STAGE2_CODEBOOK_BEGIN = 46358
+CODEBOOK_SIZE = 1024
+
+
+@dataclass
+class Stage2Window:
+    """Up to 300 codebook 0 frames (6s) of one track of one song."""
+
+    song_idx: int
+    part_idx: int
+    seg_idx: int
+    codec_ids: torch.Tensor  # (1, n_frames)
+
+    @property
+    def n_frames(self) -> int:
+        return self.codec_ids.shape[-1]
+
+
+class Stage2CachePool:
+    """One KV cache shared by all stage 2 batches instead of a new one per batch.
+
+    new_cache(batch_size, max_seq_len) creates it. The cache is replaced only
+    when a batch needs more rows or a longer sequence than any before it, and
+    plan_batches puts the longest windows first, so it is usually allocated
+    once. Smaller batches use its first rows and leave the end of the sequence
+    unused. A batch of more but shorter rows gets a cache of exactly its shape,
+    growing to cover both would exceed the memory budget they were planned for.
+    """
+
+    def __init__(self, new_cache: Callable[[int, int], object]):
+        self.new_cache = new_cache
+        self.cache = None
+        self.batch_size = 0
+        self.max_seq_len = 0
+
+    def get(self, batch_size: int, max_seq_len: int):
+        if batch_size > self.batch_size or max_seq_len > self.max_seq_len:
+            if batch_size < self.batch_size or max_seq_len < self.max_seq_len:
+                self.batch_size, self.max_seq_len = batch_size, max_seq_len
+            else:
+                self.batch_size = max(batch_size, self.batch_size)
+                self.max_seq_len = max(max_seq_len, self.max_seq_len)
+
+            # Free the old cache before allocating the larger one
+            self.cache = None
+            gc.collect()
+            torch.cuda.empty_cache()
+            self.cache = self.new_cache(self.batch_size, self.max_seq_len)
+        return self.cache
 
 
 class Stage2Pipeline:
@@ -51,6 +106,8 @@ class Stage2Pipeline:
                 "tokenizer.model",
             )
         )
+        # Set by main() with --stage2_result_cache
+        self.result_cache = None
 
     def get_codec_ids(self, prompt: np.array):
         codec_ids = self.codec_tool.unflatten(prompt, n_quantizer=1)
@@ -62,19 +119,67 @@ class Stage2Pipeline:
         ).astype(np.int32)
         return codec_ids
 
-    def fix_output(self, output):
+    def fix_output(self, output: np.array) -> np.array:
+        """Replace codes outside 0-1023 with the most frequent value of their codebook row.
+
+        output is a (8, T) track or a batch of them (..., 8, T). As in the
+        original Counter loop, the mode is over the whole row, invalid values
+        included, and ties go to the value seen first.
+        """
         # Fix invalid codes (a dirty solution, which may harm the quality of audio)
         # We are trying to find better one
-        fixed_output = copy.deepcopy(output)
-        for i, line in enumerate(output):
-            for j, element in enumerate(line):
-                if element < 0 or element > 1023:
-                    counter = Counter(line)
-                    most_frequant = sorted(
-                        counter.items(), key=lambda x: x[1], reverse=True
-                    )[0][0]
-                    fixed_output[i, j] = most_frequant
-        return fixed_output
+        rows = output.reshape(-1, output.shape[-1])
+        invalid = (rows < 0) | (rows > 1023)
+        fixed_output = rows.copy()
+        bad_rows = np.flatnonzero(invalid.any(axis=1))
+        if len(bad_rows) == 0:
+            return fixed_output.reshape(output.shape)
+
+        # Count the valid codes of all rows with invalid ones in one bincount
+        valid = ~invalid[bad_rows]
+        codes = np.where(valid, rows[bad_rows], 0)
+        keys = np.arange(len(bad_rows))[:, None] * 1024 + codes
+        counts = np.bincount(keys[valid], minlength=len(bad_rows) * 1024)
+        counts = counts.reshape(-1, 1024)
+
+        for i, row_idx in enumerate(bad_rows):
+            line = rows[row_idx]
+            n_mode = counts[i].max()
+            _, invalid_counts = np.unique(line[invalid[row_idx]], return_counts=True)
+            if invalid_counts.max() >= n_mode:
+                # An invalid value is (one of) the most frequent, rank the whole row
+                values, first, n = np.unique(line, return_index=True, return_counts=True)
+                most_frequent = values[np.lexsort((first, -n))[0]]
+            else:
+                is_mode = valid[i] & (counts[i][codes[i]] == n_mode)
+                most_frequent = line[np.argmax(is_mode)]
+            fixed_output[row_idx, invalid[row_idx]] = most_frequent
+        return fixed_output.reshape(output.shape)
+
+    def generate(self, output_dir: str) -> Dict[str, np.array]:
+        return self.generate_many([output_dir])[0]
+
+    def generate_many(self, output_dirs: List[str]) -> List[Dict[str, np.array]]:
+        """Decode the stage 1 tracks of several songs, sharing batches across tracks and songs."""
+        windows = self.collect_windows(output_dirs)
+        outputs, windows = self.cached_outputs(windows)
+        for batch in tqdm(self.plan_batches(windows), mininterval=10):
+            batch_outputs = self.generate_windows(batch)
+            self.cache_outputs(batch, batch_outputs)
+            outputs += zip(batch, batch_outputs)
+        return self.assemble(output_dirs, outputs)
+
+    def generate_windows(self, windows: List[Stage2Window]) -> List[np.array]:
+        """Teacher-forced greedy decode of a batch, the 8 codebook ids of every frame of each window."""
+        raise NotImplementedError
+
+    def max_batch_size(self, n_frames: int) -> int:
+        """The number of windows of up to n_frames that fit in one batch."""
+        raise NotImplementedError
+
+    def close(self):
+        """Stop worker processes, only Stage2Pipeline_Pool has any."""
+        pass
 
     def save(self, output_dir: str, outputs):
         for output_name, output in outputs.items():
@@ -89,160 +194,250 @@ class Stage2Pipeline:
         prompt = np.load(os.path.join(stage1_output_dir, output_name)).astype(np.int32)
         return prompt
 
-    def prepare_prompt_batch(self, prompt: np.array, batch_size: int):
-        codec_ids = self.get_codec_ids(prompt)
-
-        # Prepare prompt_ids based on batch size or single input
-        if batch_size > 1:
-            codec_list = []
-            for i in range(batch_size):
-                idx_begin = i * 300
-                idx_end = (i + 1) * 300
-                codec_list.append(codec_ids[:, idx_begin:idx_end])
-
-            codec_ids = np.concatenate(codec_list, axis=0)
-            prompt_ids = np.concatenate(
-                [
-                    np.tile(
-                        [self.mmtokenizer.soa, self.mmtokenizer.stage_1],
-                        (batch_size, 1),
-                    ),
-                    codec_ids,
-                    np.tile([self.mmtokenizer.stage_2], (batch_size, 1)),
-                ],
-                axis=1,
+    def collect_windows(self, output_dirs: List[str]) -> List[Stage2Window]:
+        """Cut both tracks of all songs into 300 frame (6s) windows, the last one of a track is shorter."""
+        windows = []
+        for song_idx, output_dir in enumerate(output_dirs):
+            for part_idx, output_name in enumerate(STAGE2_PARTS):
+                prompt = self.get_stage1_prompt(output_dir, output_name)
+                codec_ids = torch.as_tensor(self.get_codec_ids(prompt), dtype=torch.long)
+                for seg_idx, seg in enumerate(torch.split(codec_ids, 300, dim=-1)):
+                    windows.append(Stage2Window(song_idx, part_idx, seg_idx, seg))
+        return windows
+
+    def cached_outputs(self, windows: List[Stage2Window]):
+        """Look windows up in the result cache, returns the (window, output) hits and the windows to decode."""
+        if self.result_cache is None:
+            return [], windows
+        outputs, misses = [], []
+        for w in windows:
+            codes = self.result_cache.get(w.codec_ids.numpy())
+            if codes is None:
+                misses.append(w)
+            else:
+                ids = self.codec_tool_stage2.npy2ids(codes.astype(np.int64))
+                outputs.append((w, np.array(ids)))
+        print(f"Stage 2 result cache: {len(outputs)} of {len(windows)} windows cached")
+        return outputs, misses
+
+    def cache_outputs(self, windows: List[Stage2Window], outputs: List[np.array]):
+        if self.result_cache is None:
+            return
+        for w, output in zip(windows, outputs):
+            codes = self.codec_tool_stage2.ids2npy(output)
+            self.result_cache.put(w.codec_ids.numpy(), codes)
+
+    def plan_batches(self, windows: List[Stage2Window]) -> List[List[Stage2Window]]:
+        """Sort windows longest first and split them into as few batches as fit.
+
+        Windows of different lengths share a batch (see pad_batch), so the
+        short tail windows ride along with full ones instead of taking passes
+        of their own. Each batch is sized by max_batch_size of its longest
+        window, which allows more rows once only shorter windows are left, and
+        the windows are spread evenly over the batches that length needs.
+        """
+        windows = sorted(windows, key=lambda w: w.n_frames, reverse=True)
+        batches = []
+        while windows:
+            max_bsz = self.max_batch_size(windows[0].n_frames)
+            assert max_bsz > 0
+            n_batches = math.ceil(len(windows) / max_bsz)
+            size = math.ceil(len(windows) / n_batches)
+            batches.append(windows[:size])
+            windows = windows[size:]
+        return batches
+
+    def pad_batch(self, windows: List[Stage2Window]):
+        """Stack windows of different lengths into one batch.
+
+        Prompts are left-padded so that codebook 0 frames are fed at the same
+        step for all rows; the padding must be masked out and the positions of
+        a row shifted back by its padding. Shorter rows repeat their last frame
+        and decode past their end, those frames are dropped by the caller.
+        Returns codec_ids, prompt_ids and the padding of each row.
+        """
+        n_frames = max(w.n_frames for w in windows)
+        codec_ids = torch.empty((len(windows), n_frames), dtype=torch.long)
+        prompt_ids = torch.full(
+            (len(windows), n_frames + 3), self.mmtokenizer.eoa, dtype=torch.long
+        )
+        pad = torch.tensor([n_frames - w.n_frames for w in windows], dtype=torch.long)
+        prefix = torch.tensor([self.mmtokenizer.soa, self.mmtokenizer.stage_1])
+        suffix = torch.tensor([self.mmtokenizer.stage_2])
+        for i, w in enumerate(windows):
+            codec_ids[i, : w.n_frames] = w.codec_ids[0]
+            codec_ids[i, w.n_frames :] = w.codec_ids[0, -1]
+            prompt_ids[i, pad[i] :] = torch.cat([prefix, w.codec_ids[0], suffix])
+        return codec_ids, prompt_ids, pad
+
+    def assemble(self, output_dirs: List[str], outputs) -> List[Dict[str, np.array]]:
+        """Put the (window, output) pairs of all batches back together by song, track and segment."""
+        parts = {}
+        for window, output in outputs:
+            parts.setdefault((window.song_idx, window.part_idx), []).append(
+                (window.seg_idx, output)
             )
-        else:
-            prompt_ids = np.concatenate(
-                [
-                    np.array([self.mmtokenizer.soa, self.mmtokenizer.stage_1]),
-                    codec_ids.flatten(),  # Flatten the 2D array to 1D
-                    np.array([self.mmtokenizer.stage_2]),
-                ]
-            ).astype(np.int32)
-            prompt_ids = prompt_ids[np.newaxis, ...]
 
-        codec_ids = torch.as_tensor(codec_ids, dtype=torch.long)
-        prompt_ids = torch.as_tensor(prompt_ids, dtype=torch.long)
-        return codec_ids, prompt_ids
+        results = [{} for _ in output_dirs]
+        for (song_idx, part_idx), p in parts.items():
+            p = sorted(p, key=lambda x: x[0])
+            part_o = np.concatenate([pp[1] for pp in p])
+            part_o = self.codec_tool_stage2.ids2npy(part_o)
+            # Decoding only emits ids of the right codebook, this is a cheap guard
+            part_o = self.fix_output(part_o)
+            results[song_idx][STAGE2_PARTS[part_idx]] = part_o
+        return results
 
 
 class Stage2Pipeline_HF(Stage2Pipeline):
-    def __init__(self, model_path: str, device: torch.device, batch_size: int):
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        batch_size: int = 0,
+        compile: bool = False,
+        dtype: torch.dtype = torch.float16,
+        memory_gb: float = 0.0,
+        memory_share: float = 1.0,
+    ):
         super().__init__(device)
         self.batch_size = batch_size
 
         self.model = AutoModelForCausalLM.from_pretrained(
-            model_path, torch_dtype=torch.float16, attn_implementation="sdpa"
+            model_path, torch_dtype=dtype, attn_implementation="sdpa"
         )
         self.model.to(device)
         self.model.eval()
-        if torch.__version__ >= "2.0.0":
-            self.model = torch.compile(self.model)
 
-    def generate_batch(self, prompt: np.array, batch_size: int):
-        codec_ids, prompt_ids = self.prepare_prompt_batch(prompt, batch_size)
-        len_prompt = prompt_ids.shape[-1]
+        # Each step can only emit one codebook, only its 1024 lm_head rows are computed.
+        # This saving is HF only: exllamav2 and llama.cpp compute the full head in forward.
+        self.codebook_heads = self.model.lm_head.weight[
+            STAGE2_CODEBOOK_BEGIN : STAGE2_CODEBOOK_BEGIN + 7 * CODEBOOK_SIZE
+        ].view(7, CODEBOOK_SIZE, -1)
 
-        # Teacher forcing generate loop
-        codec_ids = codec_ids.to(self.device)
-        prompt_ids = prompt_ids.to(self.device)
-        block_list = LogitsProcessorList(
-            [
-                BlockTokenRangeProcessor(0, 46358),
-                BlockTokenRangeProcessor(53526, self.mmtokenizer.vocab_size),
-            ]
+        self.cache_pool = Stage2CachePool(self.new_cache)
+        self.memory_model = Stage2MemoryModel.from_config(
+            self.model.config, dtype.itemsize, dtype.itemsize
+        )
+        self.memory_budget = memory_budget(device, memory_gb, memory_share)
+
+        # Batch size and prompt length change from batch to batch, and so do the
+        # pooled cache views, so the graph is compiled with dynamic shapes. Off by
+        # default (--stage2_compile), compiling takes longer than it saves on a short run.
+        self.body = self.model.model
+        if compile and torch.__version__ >= "2.0.0":
+            self.body = torch.compile(self.model.model, dynamic=True)
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        cache,
+        pos: int,
+        attention_mask: torch.Tensor,
+        pad: torch.Tensor,
+    ) -> torch.Tensor:
+        """Forward input_ids into cache positions pos.., return the hidden state of the last one."""
+        cache_position = torch.arange(
+            pos, pos + input_ids.shape[1], device=self.device
         )
-        past_key_values = StaticCache(
+        # Rows start after their left padding, padding positions are masked anyway
+        position_ids = (cache_position[None] - pad[:, None]).clamp(min=0)
+        hidden = self.body(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            cache_position=cache_position,
+            past_key_values=cache,
+            use_cache=True,
+        ).last_hidden_state
+        return hidden[:, -1]
+
+    def max_batch_size(self, n_frames: int) -> int:
+        if self.batch_size > 0:
+            return self.batch_size
+        return self.memory_model.max_batch_size(n_frames, self.memory_budget)
+
+    def new_cache(self, batch_size: int, max_cache_len: int) -> StaticCache:
+        cache = StaticCache(
             self.model.config,
             max_batch_size=batch_size,
-            max_cache_len=prompt_ids.shape[1] + codec_ids.shape[1] * 8,
-            device=self.model.device,
+            max_cache_len=max_cache_len,
+            device=self.device,
             dtype=self.model.dtype,
         )
-        for frames_idx in range(codec_ids.shape[1]):
-            cb0 = codec_ids[:, frames_idx : frames_idx + 1]
-            prompt_ids = torch.cat([prompt_ids, cb0], dim=1)
-            input_ids = prompt_ids
-
-            stage2_output = self.model.generate(
-                input_ids=input_ids,
-                min_new_tokens=7,
-                max_new_tokens=7,
-                eos_token_id=self.mmtokenizer.eoa,
-                pad_token_id=self.mmtokenizer.eoa,
-                logits_processor=block_list,
-                past_key_values=past_key_values,
+        if hasattr(cache, "layers"):
+            # Newer transformers allocate on the first forward, sized to that batch
+            config = self.model.config
+            head_dim = getattr(config, "head_dim", None) or (
+                config.hidden_size // config.num_attention_heads
             )
-
-            assert stage2_output.shape[1] - prompt_ids.shape[1] == 7, (
-                f"output new tokens={stage2_output.shape[1] - prompt_ids.shape[1]}"
+            cache.early_initialization(
+                batch_size,
+                config.num_key_value_heads,
+                head_dim,
+                self.model.dtype,
+                self.device,
             )
-            prompt_ids = stage2_output
-
-        # Return output based on batch size
-        if batch_size > 1:
-            output = prompt_ids.cpu().numpy()[:, len_prompt:]
-            output_list = [output[i] for i in range(batch_size)]
-            output = np.concatenate(output_list, axis=0)
+            self.cache_tensors = [(layer.keys, layer.values) for layer in cache.layers]
         else:
-            output = prompt_ids[0].cpu().numpy()[len_prompt:]
-
-        return output
-
-    def generate(self, output_dir: str) -> dict[str, np.array]:
-        outputs = {}
-        for output_name in tqdm(["vtrack.npy", "itrack.npy"]):
-            # Load the prompt
-            prompt = self.get_stage1_prompt(output_dir, output_name)
-
-            # Only accept 6s segments
-            output_duration = prompt.shape[-1] // 50 // 6 * 6
-            num_batch = output_duration // 6
-
-            if num_batch <= self.batch_size:
-                # If num_batch is less than or equal to batch_size, we can infer the entire prompt at once
-                output = self.generate_batch(
-                    prompt[:, : output_duration * 50], batch_size=num_batch
-                )
-            else:
-                # If num_batch is greater than batch_size, process in chunks of batch_size
-                segments = []
-                num_segments = (num_batch // self.batch_size) + (
-                    1 if num_batch % self.batch_size != 0 else 0
-                )
+            self.cache_tensors = list(zip(cache.key_cache, cache.value_cache))
+        return cache
+
+    def get_cache(self, batch_size: int, max_cache_len: int) -> StaticCache:
+        """The pooled StaticCache cut to batch_size rows, rewound to position 0."""
+        cache = self.cache_pool.get(batch_size, max_cache_len)
+        rows = [
+            (keys[:batch_size], values[:batch_size]) if batch_size < len(keys) else (keys, values)
+            for keys, values in self.cache_tensors
+        ]
+        if hasattr(cache, "layers"):
+            for layer, (keys, values) in zip(cache.layers, rows):
+                layer.keys, layer.values = keys, values
+                layer.batch_size = batch_size
+                layer.cumulative_length.zero_()
+        else:
+            # Older transformers write at cache_position, only the rows change
+            cache.key_cache = [keys for keys, _ in rows]
+            cache.value_cache = [values for _, values in rows]
+        return cache
 
-                for seg in range(num_segments):
-                    start_idx = seg * self.batch_size * 300
-                    # Ensure the end_idx does not exceed the available length
-                    end_idx = min(
-                        (seg + 1) * self.batch_size * 300, output_duration * 50
-                    )  # Adjust the last segment
-                    current_batch_size = (
-                        self.batch_size
-                        if seg != num_segments - 1 or num_batch % self.batch_size == 0
-                        else num_batch % self.batch_size
-                    )
-                    segment = self.generate_batch(
-                        prompt[:, start_idx:end_idx], batch_size=current_batch_size
-                    )
-                    segments.append(segment)
-
-                # Concatenate all the segments
-                output = np.concatenate(segments, axis=0)
-
-            # Process the ending part of the prompt
-            if output_duration * 50 != prompt.shape[-1]:
-                ending = self.generate_batch(
-                    prompt[:, output_duration * 50 :], batch_size=1
+    def generate_windows(self, windows: List[Stage2Window]) -> List[np.array]:
+        codec_ids, prompt_ids, pad = self.pad_batch(windows)
+        codec_ids = codec_ids.to(self.device)
+        prompt_ids = prompt_ids.to(self.device)
+        pad = pad.to(self.device)
+        batch_size, n_frames = codec_ids.shape
+
+        cache = self.get_cache(batch_size, prompt_ids.shape[1] + n_frames * 8)
+        # The mask spans the whole pooled cache, positions past this batch stay unused
+        cache_len = self.cache_pool.max_seq_len
+        attention_mask = (
+            torch.arange(cache_len, device=self.device)[None] >= pad[:, None]
+        ).long()
+
+        # Each frame is cb0 followed by 7 greedy codes
+        output = torch.empty((batch_size, n_frames, 8), dtype=torch.long, device=self.device)
+        output[:, :, 0] = codec_ids
+
+        # Teacher forcing loop, the last code of a frame goes in together with the next cb0
+        pos = 0
+        input_ids = torch.cat([prompt_ids, codec_ids[:, :1]], dim=1)
+        for frames_idx in range(n_frames):
+            if frames_idx > 0:
+                input_ids = torch.cat(
+                    [output[:, frames_idx - 1, 7:], codec_ids[:, frames_idx : frames_idx + 1]],
+                    dim=1,
                 )
-                output = np.concatenate([output, ending], axis=0)
+            for i in range(7):
+                hidden = self.forward(input_ids, cache, pos, attention_mask, pad)
+                pos += input_ids.shape[1]
+                logits = F.linear(hidden, self.codebook_heads[i])
+                first_logit = STAGE2_CODEBOOK_BEGIN + i * CODEBOOK_SIZE
+                output[:, frames_idx, i + 1] = logits.argmax(dim=-1) + first_logit
+                input_ids = output[:, frames_idx, i + 1 : i + 2]
 
-            output = self.codec_tool_stage2.ids2npy(output)
-
-            output = self.fix_output(output)
-            outputs[output_name] = output
-        return outputs
+        output = output.cpu().numpy()
+        return [output[i, : w.n_frames].reshape(-1) for i, w in enumerate(windows)]
 
 
 class Stage2Pipeline_EXL2(Stage2Pipeline):
@@ -253,6 +448,8 @@ class Stage2Pipeline_EXL2(Stage2Pipeline):
         cache_size: int,
         cache_mode: str,
         no_flash_attn: bool,
+        memory_gb: float = 0.0,
+        memory_share: float = 1.0,
     ):
         super().__init__(device)
 
@@ -279,133 +476,278 @@ class Stage2Pipeline_EXL2(Stage2Pipeline):
 
         # Define cache
         self.cache_mode = get_cache_class(cache_mode)
+        self.cache_pool = Stage2CachePool(
+            lambda batch_size, max_seq_len: self.cache_mode(
+                self.model, batch_size=batch_size, max_seq_len=max_seq_len
+            )
+        )
+        self.memory_model = Stage2MemoryModel.from_config(
+            exl2_config, CACHE_MODE_BYTES.get(cache_mode, CACHE_MODE_BYTES["FP16"]), 2
+        )
+        self.memory_budget = memory_budget(device, memory_gb, memory_share)
 
-    def generate(self, output_dir: str) -> dict[str, np.array]:
-        parts = ["vtrack.npy", "itrack.npy"]
-        full_batch = []
-
-        # Collect up to 300 token (6s) segments for all parts
-        for output_idx, output_name in tqdm(enumerate(parts)):
-            prompt = self.get_stage1_prompt(output_dir, output_name)
-            prompt = self.get_codec_ids(prompt)
-            prompt = torch.as_tensor(prompt, dtype=torch.long)
-
-            segs = torch.split(prompt, 300, dim=-1)
+    def max_batch_size(self, n_frames: int) -> int:
+        if self.cache_size > 0:
+            return self.cache_size // align(3 + n_frames * 9, 32)
+        return self.memory_model.max_batch_size(n_frames, self.memory_budget)
 
-            for seg_idx, seg in enumerate(segs):
-                seg_len = seg.shape[-1]
-                full_batch.append((seg_len, seg_idx, output_idx, seg))
+    @staticmethod
+    def slice_mask(input_mask, n_tokens: int):
+        return None if input_mask is None else input_mask[:, :n_tokens]
 
-        # Prepare segments
-        prefix = torch.tensor(
-            [[self.mmtokenizer.soa, self.mmtokenizer.stage_1]], dtype=torch.long
+    def generate_windows(self, windows: List[Stage2Window]) -> List[np.array]:
+        codec_ids, prompt_ids, pad = self.pad_batch(windows)
+        codec_ids = codec_ids.to(self.device)
+        prompt_ids = prompt_ids.to(self.device)
+        batch_size, len_prompt = prompt_ids.shape
+        cache_len = align(prompt_ids.shape[1] + codec_ids.shape[1] * 8, 32)
+
+        # Rows past batch_size and positions past cache_len of the pooled cache stay unused
+        cache = self.cache_pool.get(batch_size, cache_len)
+        cache.current_seq_len = 0
+        output_ids = torch.empty(
+            (batch_size, 0), dtype=torch.long, device=self.device
         )
-        suffix = torch.tensor([[self.mmtokenizer.stage_2]], dtype=torch.long)
-        for i in range(len(full_batch)):
-            seg_len, seg_idx, output_idx, codec_ids = full_batch[i]
-            prompt_ids = torch.cat((prefix, codec_ids, suffix), dim=-1)
-            full_batch[i] = (seg_len, seg_idx, output_idx, codec_ids, prompt_ids)
-
-        # Group prompts by length
-        batches = {}
-        for seq in full_batch:
-            if seq[0] not in batches:
-                batches[seq[0]] = []
-            batches[seq[0]].append(seq)
-
-        # Split into on minibatches
-        split_batch = []
-        for idx, (seg_len, batch) in enumerate(batches.items()):
-            b_seg_order = [b[1] for b in batch]
-            b_part_order = [b[2] for b in batch]
-            b_codec_ids = torch.cat([b[3] for b in batch], dim=0)
-            b_prompt_ids = torch.cat([b[4] for b in batch], dim=0)
-
-            max_bsz = self.cache_size // align(
-                b_prompt_ids.shape[1] + b_codec_ids.shape[1] * 8, 32
-            )
-            assert max_bsz > 0
-            for a, b in split_bsz(b_prompt_ids.shape[0], max_bsz):
-                split_batch.append(
-                    (
-                        b_seg_order[a:b],
-                        b_part_order[a:b],
-                        b_codec_ids[a:b],
-                        b_prompt_ids[a:b],
-                    )
-                )
 
-        # Inference
-        output_parts = []
-        for _ in parts:
-            output_parts.append([])
-
-        for seg_order, part_order, codec_ids, prompt_ids in tqdm(
-            split_batch, mininterval=10
-        ):
-            codec_ids = codec_ids.to(self.device)
-            prompt_ids = prompt_ids.to(self.device)
-            batch_size, len_prompt = prompt_ids.shape
-
-            cache = self.cache_mode(
-                self.model,
-                batch_size=batch_size,
-                max_seq_len=align(prompt_ids.shape[1] + codec_ids.shape[1] * 8, 32),
-            )
-            output_ids = torch.empty(
-                (batch_size, 0), dtype=torch.long, device=self.device
+        # Mask the left padding of shorter rows and shift their positions back
+        input_mask = None
+        position_offsets = None
+        if pad.any():
+            input_mask = torch.zeros(
+                (batch_size, cache_len), dtype=torch.half, device=self.device
             )
+            for i, n in enumerate(pad.tolist()):
+                input_mask[i, :n] = -65504.0
+            position_offsets = -pad[:, None].int()
 
-            for frames_idx in tqdm(range(codec_ids.shape[1]), mininterval=10):
-                cb0 = codec_ids[:, frames_idx : frames_idx + 1]
-
-                # Append the initial prompt to the first codec frame
-                if frames_idx == 0:
-                    cb0 = torch.cat([prompt_ids, cb0], dim=-1)
+        for frames_idx in tqdm(range(codec_ids.shape[1]), mininterval=10):
+            cb0 = codec_ids[:, frames_idx : frames_idx + 1]
 
-                # Forward prompt
-                output_ids = torch.cat((output_ids, cb0), dim=-1)
-                logits = self.model.forward(cb0, cache=cache, last_id_only=True)
+            # Append the initial prompt to the first codec frame
+            if frames_idx == 0:
+                cb0 = torch.cat([prompt_ids, cb0], dim=-1)
+
+            # Forward prompt
+            output_ids = torch.cat((output_ids, cb0), dim=-1)
+            logits = self.model.forward(
+                cb0,
+                cache=cache,
+                input_mask=self.slice_mask(input_mask, output_ids.shape[1]),
+                position_offsets=position_offsets,
+                last_id_only=True,
+            )
 
-                for i in range(7):
-                    # Slice logits instead of biasing start and end of distribution
-                    first_logit = 46358
-                    last_logit = 53526
-                    logits = logits[:, :, first_logit:last_logit]
+            for i in range(7):
+                # exllamav2 computes logits over the full vocabulary (its quantized head
+                # can't be cut to rows), only the argmax is limited to this step's codebook
+                first_logit = STAGE2_CODEBOOK_BEGIN + i * CODEBOOK_SIZE
+                last_logit = first_logit + CODEBOOK_SIZE
+                logits = logits[:, :, first_logit:last_logit]
+
+                # Greedy sampling
+                sample = logits.argmax(dim=-1) + first_logit
+                output_ids = torch.cat((output_ids, sample), dim=-1)
+
+                # TODO: Here, original asserts that we didn't sample mmtokenizer.eoa (can we just mask it out?)
+
+                # Forward sample
+                logits = self.model.forward(
+                    sample,
+                    cache=cache,
+                    input_mask=self.slice_mask(input_mask, output_ids.shape[1]),
+                    position_offsets=position_offsets,
+                )
 
-                    # Greedy sampling
-                    sample = logits.argmax(dim=-1) + first_logit
-                    output_ids = torch.cat((output_ids, sample), dim=-1)
+        # Trim prompt
+        output_ids = output_ids[:, len_prompt:].cpu().numpy()
+        return [output_ids[i, : w.n_frames * 8] for i, w in enumerate(windows)]
 
-                    # TODO: Here, original asserts that we didn't sample mmtokenizer.eoa (can we just mask it out?)
 
-                    # Forward sample
-                    logits = self.model.forward(sample, cache=cache)
+class Stage2Pipeline_GGUF(Stage2Pipeline):
+    """Stage 2 on CPU through llama.cpp with a quantized GGUF model (see convert_gguf.py)."""
 
-            # Trim prompt
-            output_ids = output_ids[:, len_prompt:]
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        cache_mode: str = "FP16",
+        n_threads: int = None,
+    ):
+        super().__init__(device)
 
-            # Split outputs
-            for i in range(batch_size):
-                output_parts[part_order[i]].append(
-                    (seg_order[i], output_ids[i : i + 1, :])
-                )
+        # One 300 frame (6s) window: prompt, codebook 0 and 7 generated codes per frame
+        self.context = GGUFContext(
+            model_path, align(3 + 300 * 9, 256), n_threads, cache_mode
+        )
 
-            # Release cache tensors
-            del cache
-            torch.cuda.empty_cache()
-            gc.collect()
+    def generate_window(self, codec_ids: np.array) -> np.array:
+        """Teacher-forced greedy decode of one window of codebook 0 ids."""
+        self.context.reset()
+        prompt_ids = [self.mmtokenizer.soa, self.mmtokenizer.stage_1]
+        prompt_ids += codec_ids.tolist() + [self.mmtokenizer.stage_2]
+
+        output_ids = []
+        for frames_idx, cb0 in enumerate(codec_ids.tolist()):
+            # Append the initial prompt to the first codec frame
+            tokens = prompt_ids + [cb0] if frames_idx == 0 else [cb0]
+            output_ids.append(cb0)
+            logits = self.context.eval(tokens)
+            for i in range(7):
+                # Greedy sampling over the ids of the codebook of this step only
+                first_logit = STAGE2_CODEBOOK_BEGIN + i * CODEBOOK_SIZE
+                last_logit = first_logit + CODEBOOK_SIZE
+                sample = int(logits[first_logit:last_logit].argmax()) + first_logit
+                output_ids.append(sample)
+                logits = self.context.eval([sample])
+        return np.array(output_ids)
+
+    def max_batch_size(self, n_frames: int) -> int:
+        return 1
+
+    def generate_windows(self, windows: List[Stage2Window]) -> List[np.array]:
+        return [self.generate_window(w.codec_ids[0].numpy()) for w in windows]
+
+
+def stage2_worker(args, device: str, n_threads: int, memory_share: float, tasks, results):
+    """Worker process of Stage2Pipeline_Pool, decodes batches from tasks until it gets None."""
+    torch.autograd.grad_mode._enter_inference_mode(True)
+    torch.autograd.set_grad_enabled(False)
+    if n_threads:
+        torch.set_num_threads(n_threads)
+    try:
+        pipeline = build_pipeline(args, torch.device(device), memory_share, n_threads)
+        results.put(("ready", [pipeline.max_batch_size(n) for n in range(1, 301)]))
+        for batch_idx, windows in iter(tasks.get, None):
+            windows = [replace(w, codec_ids=torch.from_numpy(w.codec_ids)) for w in windows]
+            results.put((batch_idx, pipeline.generate_windows(windows)))
+    except Exception:
+        results.put(("error", f"{device}: {traceback.format_exc()}"))
+
+
+class Stage2Pipeline_Pool(Stage2Pipeline):
+    """Data-parallel stage 2, a worker process with a replica of the args pipeline per device.
+
+    Batches are planned here and queued longest first. A worker takes the next
+    batch as soon as it is done with its last one, so uneven batches and
+    devices of different speed even out, and outputs are put back in order by
+    (song, track, seg_idx) like for a single pipeline.
+    """
+
+    def __init__(self, args, devices: List[str]):
+        super().__init__(torch.device("cpu"))
+        # CPU workers share the cores instead of each using all of them
+        n_cpu_workers = sum(device == "cpu" for device in devices)
+        cpu_threads = max(1, torch.get_num_threads() // max(n_cpu_workers, 1))
+
+        ctx = mp.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = [
+            ctx.Process(
+                target=stage2_worker,
+                args=(
+                    args,
+                    device,
+                    cpu_threads if device == "cpu" else None,
+                    # Workers on the same device split its memory
+                    1 / devices.count(device),
+                    self.tasks,
+                    self.results,
+                ),
+                daemon=True,
+            )
+            for device in devices
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        # Plan batches that fit on every device
+        sizes = [self.receive()[1] for _ in self.workers]
+        self.batch_sizes = [min(s) for s in zip(*sizes)]
+
+    def receive(self):
+        while True:
+            try:
+                key, value = self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A stage 2 worker process died")
+                continue
+            if key == "error":
+                raise RuntimeError(f"Stage 2 worker failed on {value}")
+            return key, value
+
+    def max_batch_size(self, n_frames: int) -> int:
+        return self.batch_sizes[n_frames - 1]
+
+    def generate_many(self, output_dirs: List[str]) -> List[Dict[str, np.array]]:
+        windows = self.collect_windows(output_dirs)
+        outputs, windows = self.cached_outputs(windows)
+        batches = self.plan_batches(windows)
+        for batch_idx, batch in enumerate(batches):
+            # Arrays pickle by value, tensors would be shared until a worker gets them
+            batch = [replace(w, codec_ids=w.codec_ids.numpy()) for w in batch]
+            self.tasks.put((batch_idx, batch))
+
+        for _ in tqdm(range(len(batches)), mininterval=10):
+            batch_idx, batch_outputs = self.receive()
+            self.cache_outputs(batches[batch_idx], batch_outputs)
+            outputs += zip(batches[batch_idx], batch_outputs)
+        return self.assemble(output_dirs, outputs)
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def run_manifest(args, pipeline: Stage2Pipeline):
+    """Run stage 2 for every --manifest job that finished stage 1, windows of several songs share batches."""
+    jobs = load_manifest(args.manifest)
+    progress = ManifestProgress(args.output_dir)
+    pending = progress.pending(jobs, "stage2")
+    for start in range(0, len(pending), MANIFEST_SONGS_PER_PASS):
+        chunk = pending[start : start + MANIFEST_SONGS_PER_PASS]
+        output_dirs = [job.output_dir(args.output_dir) for job in chunk]
+        for job, output_dir, outputs in zip(
+            chunk, output_dirs, pipeline.generate_many(output_dirs)
+        ):
+            pipeline.save(output_dir=output_dir, outputs=outputs)
+            progress.mark(job, "stage2")
+        print(f"Manifest: {progress.summary(jobs)}")
 
-        # Unshuffle and recombine output parts
-        output = {}
-        for i, p in enumerate(output_parts):
-            p = sorted(p, key=lambda x: x[0])
-            part_o = torch.cat([pp[1] for pp in p], dim=-1).flatten().cpu().numpy()
-            part_o = self.codec_tool_stage2.ids2npy(part_o)
-            part_o = self.fix_output(part_o)
-            output[parts[i]] = part_o
 
-        return output
+def build_pipeline(
+    args, device: torch.device, memory_share: float = 1.0, n_threads: int = None
+) -> Stage2Pipeline:
+    """The args stage 2 pipeline, n_threads (a pool worker's CPU share) overrides --gguf_threads."""
+    if args.stage2_use_exl2:
+        return Stage2Pipeline_EXL2(
+            model_path=args.stage2_model,
+            device=device,
+            cache_size=args.stage2_cache_size,
+            cache_mode=args.stage2_cache_mode,
+            no_flash_attn=args.no_flash_attn,
+            memory_gb=args.stage2_memory_gb,
+            memory_share=memory_share,
+        )
+    elif args.stage2_use_gguf:
+        return Stage2Pipeline_GGUF(
+            model_path=args.stage2_model,
+            device=device,
+            cache_mode=args.stage2_cache_mode,
+            n_threads=n_threads or args.gguf_threads,
+        )
+    else:
+        return Stage2Pipeline_HF(
+            model_path=args.stage2_model,
+            device=device,
+            batch_size=args.stage2_batch_size,
+            compile=args.stage2_compile,
+            memory_gb=args.stage2_memory_gb,
+            memory_share=memory_share,
+        )
 
 
 def main():
@@ -417,25 +759,27 @@ def main():
         f"cuda:{args.cuda_idx}" if torch.cuda.is_available() else "cpu"
     )
 
-    if args.stage2_use_exl2:
-        pipeline = Stage2Pipeline_EXL2(
-            model_path=args.stage2_model,
-            device=device,
-            cache_size=args.stage2_cache_size,
-            cache_mode=args.stage2_cache_mode,
-            no_flash_attn=args.no_flash_attn,
-        )
-        pass
+    if args.stage2_devices:
+        pipeline = Stage2Pipeline_Pool(args, args.stage2_devices)
     else:
-        pipeline = Stage2Pipeline_HF(
-            model_path=args.stage2_model,
-            device=device,
-            batch_size=args.stage2_batch_size,
+        pipeline = build_pipeline(args, device)
+    if args.stage2_result_cache:
+        pipeline.result_cache = Stage2ResultCache(
+            args.stage2_result_cache,
+            model_fingerprint(args),
+            int(args.stage2_result_cache_gb * 2**30),
         )
 
-    outputs = pipeline.generate(output_dir=args.output_dir)
+    try:
+        if args.manifest:
+            run_manifest(args, pipeline)
+            return
+
+        outputs = pipeline.generate(output_dir=args.output_dir)
 
-    pipeline.save(output_dir=args.output_dir, outputs=outputs)
+        pipeline.save(output_dir=args.output_dir, outputs=outputs)
+    finally:
+        pipeline.close()
 
 
 if __name__ == "__main__":
@@ -868,7 +868,7 @@ def build_gradio_interface():
                     label="Stage2 Cache Size",
                     value=16384,
                     precision=0,
-                    info="The cache size used in Stage 2 inference (8192 for 6GB, 16384 for 8GB, 100000 for 24GB).",
+                    info="The cache size used in Stage 2 inference (8192 for 6GB, 16384 for 8GB, 100000 for 24GB). 0: fit batches to the free VRAM.",
                 )
 
                 stage2_cache_mode = gr.Dropdown(
@@ -0,0 +1,124 @@
+import math
+from collections import Counter, deque
+from typing import Optional
+
+# xcodec codebook 0 ids, the only codec tokens stage 1 generates
+CODEBOOK0_BEGIN = 45334
+CODEBOOK0_END = 45334 + 1024
+
+
+class LoopDetector:
+    """Online detector for degenerate stage 1 output.
+
+    Watches the interleaved vocal/instrumental codec stream of the current
+    segment, one (vocal, instrumental) frame at a time, and reports a
+    degeneration event when, over the last `window` frames, either
+
+    - the frame n-gram repetition rate exceeds `max_repetition` (token loop), or
+    - the codebook entropy of both tracks drops below `min_entropy` bits (silence).
+
+    A condition must hold for `patience` consecutive checks, checks run every
+    `stride` frames once the window is full.
+
+    Args:
+        window (int): Number of frames (50 per second) in the rolling window.
+        ngram (int): Frame n-gram length used for the repetition rate.
+        max_repetition (float): Repetition rate in [0, 1] considered a loop.
+        min_entropy (float): Entropy in bits considered a collapsed codebook.
+        stride (int): Check every `stride` frames.
+        patience (int): Number of consecutive failed checks before reporting.
+    """
+
+    def __init__(
+        self,
+        window: int = 200,
+        ngram: int = 4,
+        max_repetition: float = 0.9,
+        min_entropy: float = 1.5,
+        stride: int = 50,
+        patience: int = 2,
+    ):
+        self.window = window
+        self.ngram = ngram
+        self.max_repetition = max_repetition
+        self.min_entropy = min_entropy
+        self.stride = stride
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        self.n_frames = 0
+        self._pending = None
+        self._frames = deque()
+        self._track_counts = (Counter(), Counter())
+        self._ngrams = deque()
+        self._ngram_counts = Counter()
+        self._strikes = 0
+
+    def repetition_rate(self) -> float:
+        if not self._ngrams:
+            return 0.0
+        return 1.0 - len(self._ngram_counts) / len(self._ngrams)
+
+    def entropy(self, track: int) -> float:
+        counts = self._track_counts[track]
+        total = sum(counts.values())
+        if total == 0:
+            return 0.0
+        return -sum(c / total * math.log2(c / total) for c in counts.values())
+
+    def update(self, token_id: int) -> Optional[dict]:
+        """Feed one generated token, return an event dict when degeneration is detected."""
+        if not CODEBOOK0_BEGIN <= token_id < CODEBOOK0_END:
+            return None
+        if self._pending is None:
+            self._pending = token_id
+            return None
+        frame = (self._pending, token_id)
+        self._pending = None
+        return self._push(frame)
+
+    def _push(self, frame) -> Optional[dict]:
+        self.n_frames += 1
+        self._frames.append(frame)
+        for track, code in enumerate(frame):
+            self._track_counts[track][code] += 1
+        if len(self._frames) >= self.ngram:
+            ngram = tuple(self._frames[i] for i in range(-self.ngram, 0))
+            self._ngrams.append(ngram)
+            self._ngram_counts[ngram] += 1
+
+        if len(self._frames) > self.window:
+            old = self._frames.popleft()
+            for track, code in enumerate(old):
+                self._track_counts[track][code] -= 1
+                if self._track_counts[track][code] == 0:
+                    del self._track_counts[track][code]
+            old_ngram = self._ngrams.popleft()
+            self._ngram_counts[old_ngram] -= 1
+            if self._ngram_counts[old_ngram] == 0:
+                del self._ngram_counts[old_ngram]
+
+        if len(self._frames) < self.window or self.n_frames % self.stride != 0:
+            return None
+
+        repetition = self.repetition_rate()
+        entropy = max(self.entropy(0), self.entropy(1))
+        if repetition >= self.max_repetition:
+            reason = "repetition"
+        elif entropy <= self.min_entropy:
+            reason = "entropy"
+        else:
+            self._strikes = 0
+            return None
+
+        self._strikes += 1
+        if self._strikes < self.patience:
+            return None
+        return {
+            "reason": reason,
+            "frame": self.n_frames,
+            "repetition": round(repetition, 4),
+            "entropy": round(entropy, 4),
+        }
+
@@ -0,0 +1,117 @@
+import json
+import os
+from dataclasses import dataclass, fields
+from typing import Dict, List, Optional
+
+from common import sanitize_filename
+
+STAGES = ("stage1", "stage2", "postprocess")
+
+
+@dataclass
+class ManifestJob:
+    """One song of a --manifest jobs.jsonl file.
+
+    Each manifest line is a JSON object with `name` (output name), `genre` or
+    `genre_txt`, `lyrics` or `lyrics_txt`, and optionally `seed`,
+    `audio_prompt_path`, `vocal_track_prompt_path`,
+    `instrumental_track_prompt_path`, `prompt_start_time`, `prompt_end_time`
+    and `run_n_segments`.
+    """
+
+    name: str
+    genre: str
+    lyrics: str
+    seed: Optional[int] = None
+    audio_prompt_path: str = ""
+    vocal_track_prompt_path: str = ""
+    instrumental_track_prompt_path: str = ""
+    prompt_start_time: float = 0.0
+    prompt_end_time: float = 30.0
+    run_n_segments: Optional[int] = None
+
+    @property
+    def use_audio_prompt(self) -> bool:
+        return bool(self.audio_prompt_path)
+
+    @property
+    def use_dual_tracks_prompt(self) -> bool:
+        return bool(self.vocal_track_prompt_path and self.instrumental_track_prompt_path)
+
+    def output_dir(self, root: str) -> str:
+        return os.path.join(root, self.name)
+
+
+# Keys a manifest line may have, genre and lyrics can be given as files instead
+MANIFEST_KEYS = {f.name for f in fields(ManifestJob)} | {"genre_txt", "lyrics_txt"}
+
+
+def _read_text(base_dir: str, path: str) -> str:
+    with open(os.path.join(base_dir, path), encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def load_manifest(path: str) -> List[ManifestJob]:
+    base_dir = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    names = set()
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line)
+            unknown = set(entry) - MANIFEST_KEYS
+            if unknown:
+                raise ValueError(
+                    f"{path}:{line_no}: unknown key(s) {sorted(unknown)} in job "
+                    f"'{entry.get('name', f'job_{line_no:05d}')}', expected {sorted(MANIFEST_KEYS)}"
+                )
+            genre = entry.pop("genre", None)
+            if genre is None:
+                genre = _read_text(base_dir, entry.pop("genre_txt"))
+            lyrics = entry.pop("lyrics", None)
+            if lyrics is None:
+                lyrics = _read_text(base_dir, entry.pop("lyrics_txt"))
+            name = sanitize_filename(str(entry.pop("name", f"job_{line_no:05d}")))
+            if name in names:
+                raise ValueError(f"{path}:{line_no}: duplicate job name '{name}'")
+            names.add(name)
+            jobs.append(ManifestJob(name=name, genre=genre.strip(), lyrics=lyrics.strip(), **entry))
+    return jobs
+
+
+class ManifestProgress:
+    """Per-job stage completion, persisted next to the outputs so a rerun resumes."""
+
+    def __init__(self, output_dir: str):
+        self.path = os.path.join(output_dir, "manifest_progress.json")
+        self.state: Dict[str, Dict[str, str]] = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def is_done(self, job: ManifestJob, stage: str) -> bool:
+        return self.state.get(job.name, {}).get(stage) == "done"
+
+    def pending(self, jobs: List[ManifestJob], stage: str) -> List[ManifestJob]:
+        """Jobs that finished the previous stage but not this one."""
+        previous = STAGES[STAGES.index(stage) - 1] if stage != STAGES[0] else None
+        return [
+            job
+            for job in jobs
+            if not self.is_done(job, stage)
+            and (previous is None or self.is_done(job, previous))
+        ]
+
+    def mark(self, job: ManifestJob, stage: str, status: str = "done"):
+        self.state.setdefault(job.name, {})[stage] = status
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def summary(self, jobs: List[ManifestJob]) -> str:
+        counts = [sum(self.is_done(job, stage) for job in jobs) for stage in STAGES]
+        return ", ".join(f"{stage} {n}/{len(jobs)}" for stage, n in zip(STAGES, counts))
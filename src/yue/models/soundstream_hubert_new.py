@@ -1,7 +1,7 @@
 # sys.path.append('/aifs4su/data/zheny/fairseq/vae_v2/codec_final')
 import math
 from collections.abc import Sequence
-from typing import Optional, Union
+from typing import List, Optional, Union
 
 # sys.path.append('/data/zheny/UniAudio/codec/descriptaudiocodecs')
 # descript-audio-codec/dac/model
@@ -120,6 +120,9 @@ class SoundStream(nn.Module):
         # self.fc_prior= nn.Linear( D, D )
         self.fc_post1 = nn.Linear(D + 768, 768)
         self.fc_post2 = nn.Linear(D + 768, D)
+        # Set by fuse_quantizer() for inference
+        self.fused_embed = None
+        self.fused_decode = None
 
     def get_last_layer(self):
         return self.decoder.layers[-1].weight
@@ -136,7 +139,14 @@ class SoundStream(nn.Module):
     def get_regress_target(self, x):
         x = x[:, 0, :]
         x = F.pad(x, (160, 160))
-        target = self.semantic_model(x, output_hidden_states=True).hidden_states
+        return self.semantic_features(x)
+
+    @torch.no_grad()
+    def semantic_features(self, x, attention_mask=None):
+        """Mean hidden state of the semantic model, one frame per hop of x (already padded)."""
+        target = self.semantic_model(
+            x, attention_mask=attention_mask, output_hidden_states=True
+        ).hidden_states
         target = torch.stack(
             target, dim=1
         )  # .transpose(-1, -2)#.flatten(start_dim=1, end_dim=2)
@@ -203,16 +213,250 @@ class SoundStream(nn.Module):
         )
         return codes
 
+    @torch.no_grad()
+    def frame_lengths(self, length: int):
+        """Frames of the acoustic and semantic encoder for length samples, as encode() gets them.
+
+        Both downsample by hop_length, so each hop more adds exactly one frame
+        and a short input of the same length modulo hop_length tells.
+        """
+        hop = int(self.hop_length)
+        probe_length = min(length, 2 * hop + length % hop)
+        probe = torch.zeros((1, 1, probe_length), device=self.fc_prior.weight.device)
+        n_acoustic = self.encoder(probe).shape[-1]
+        n_semantic = self.get_regress_target(probe).shape[1]
+        shift = (length - probe_length) // hop
+        return n_acoustic + shift, n_semantic + shift
+
+    @torch.no_grad()
+    def encode_chunked(
+        self,
+        x: torch.Tensor,
+        target_bw: Optional[int] = None,
+        chunk_frames: int = 1500,
+        context_frames: int = 250,
+    ) -> torch.Tensor:
+        """encode() of long audio in chunks, with the same peak memory for any length.
+
+        Chunks of chunk_frames frames (30s at 50 Hz) are encoded with
+        context_frames of audio on both sides, of which only the chunk's own
+        frames are kept. Chunks start on frame boundaries of the padded inputs
+        encode() uses, so the frames line up exactly with a full-length encode.
+        The acoustic and semantic conv encoders see about 1s around a frame,
+        well within the context, so their part is the same as in encode(). The
+        semantic model attends to its whole input, so a code can still differ
+        where the audio outside the context would have changed its choice,
+        mostly near chunk boundaries. Input of up to chunk_frames frames goes
+        through encode() unchanged.
+        """
+        hop = int(self.hop_length)
+        if x.shape[-1] <= chunk_frames * hop:
+            return self.encode(x, target_bw)
+
+        n_acoustic, n_frames = self.frame_lengths(x.shape[-1])
+        semantic_input = F.pad(x[:, 0, :], (160, 160))
+        # encode() falls back to the padded signal when the encoders disagree on the length
+        acoustic_input = x if n_acoustic == n_frames else F.pad(x, (160, 160))
+        return self.encode_frames(
+            semantic_input, acoustic_input, n_frames, target_bw, chunk_frames, context_frames
+        )
+
+    @torch.no_grad()
+    def encode_batch(
+        self,
+        x: torch.Tensor,
+        lengths: List[int],
+        target_bw: Optional[int] = None,
+        chunk_frames: int = 1500,
+        context_frames: int = 250,
+    ) -> List[torch.Tensor]:
+        """encode_chunked() of a (B, 1, T) batch of signals zero padded to T, in one pass.
+
+        lengths are the samples of each signal. Each one's acoustic input is the
+        one encode() uses alone: the signal, or where encode() falls back, the
+        signal padded by 160 on both sides. Only the inputs narrower than the
+        widest are zero padded on the right, so x goes through unchanged when no
+        signal falls back. The semantic model gets an attention mask of each
+        signal's samples, and each keeps the frames of its own length,
+        (n_q, 1, frames) like encode(). Signals of equal length, like the stems
+        of one song, get exactly the codes they get alone; shorter ones see
+        zeros past their end in the acoustic encoder, and the feature encoder of
+        the semantic model still normalizes over their padding.
+        """
+        semantic_input = F.pad(x[:, 0, :], (160, 160))
+        positions = torch.arange(semantic_input.shape[-1], device=x.device)
+        attention_mask = positions < torch.tensor(lengths, device=x.device)[:, None] + 320
+
+        shifts, frames = [], []
+        for length in lengths:
+            n_acoustic, n_frames = self.frame_lengths(length)
+            shifts.append(0 if n_acoustic == n_frames else 160)
+            frames.append(n_frames)
+        if any(shifts):
+            width = max(length + 2 * shift for length, shift in zip(lengths, shifts))
+            acoustic_input = torch.stack(
+                [
+                    F.pad(signal[..., :length], (shift, width - length - shift))
+                    for signal, length, shift in zip(x, lengths, shifts)
+                ]
+            )
+        else:
+            acoustic_input = x
+
+        codes = self.encode_frames(
+            semantic_input,
+            acoustic_input,
+            max(frames),
+            target_bw,
+            chunk_frames,
+            context_frames,
+            attention_mask.long() if len(set(lengths)) > 1 else None,
+        )
+        return [codes[:, i : i + 1, :n] for i, n in enumerate(frames)]
+
+    @torch.no_grad()
+    def encode_frames(
+        self,
+        semantic_input: torch.Tensor,
+        acoustic_input: torch.Tensor,
+        n_frames: int,
+        target_bw: Optional[int],
+        chunk_frames: int,
+        context_frames: int,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Codes of n_frames frames of the padded encoder inputs, chunk by chunk."""
+        hop = int(self.hop_length)
+        codes = []
+        for start in range(0, n_frames, chunk_frames):
+            end = min(start + chunk_frames, n_frames)
+            a = max(start - context_frames, 0)
+            b = end + context_frames  # slicing stops at the end of the input
+            # Semantic frames span 400 padded samples, the last one ends 80 past b * hop
+            semantic_slice = slice(a * hop, b * hop + 320)
+            e_semantic_input = self.semantic_features(
+                semantic_input[:, semantic_slice],
+                None if attention_mask is None else attention_mask[:, semantic_slice],
+            )
+            e_semantic = self.encoder_semantic(e_semantic_input.transpose(1, 2))
+            e_acoustic = self.encoder(acoustic_input[..., a * hop : b * hop])
+
+            keep = slice(start - a, end - a)
+            e = torch.cat([e_acoustic[..., keep], e_semantic[..., keep]], dim=1)
+            e = self.fc_prior(e.transpose(1, 2)).transpose(1, 2)
+            _, chunk_codes, _, _ = self.quantizer(e, self.frame_rate, target_bw)
+            codes.append(chunk_codes)
+        return torch.cat(codes, dim=-1)
+
+    @torch.no_grad()
+    def fuse_quantizer(self):
+        """Precompute get_embed() and the quantizer and fc_post2 part of decode() for inference.
+
+        Both then sum one precomputed row per code in a single gather (see
+        FusedResidualDecoder) instead of running each quantizer layer. Call it
+        after loading the weights.
+        """
+        self.fused_embed = self.quantizer.fused_decoder()
+        self.fused_decode = self.quantizer.fused_decoder(self.fc_post2)
+
     def get_embed(self, codes: torch.Tensor) -> torch.Tensor:
+        if self.fused_embed is not None:
+            return self.fused_embed(codes)
         return self.quantizer.decode(codes)
 
     def decode(self, codes: torch.Tensor) -> torch.Tensor:
-        quantized = self.quantizer.decode(codes)
-        quantized_acoustic = self.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
+        if self.fused_decode is not None:
+            quantized_acoustic = self.fused_decode(codes)
+        else:
+            quantized = self.quantizer.decode(codes)
+            quantized_acoustic = self.fc_post2(quantized.transpose(1, 2)).transpose(1, 2)
 
         o = self.decoder_2(quantized_acoustic)
         return o
 
+    @torch.no_grad()
+    def decode_chunked(
+        self,
+        codes: torch.Tensor,
+        chunk_frames: int = 1500,
+        context_frames: int = 16,
+    ) -> torch.Tensor:
+        """decode() of long (n_q, B, T) codes in chunks, with the same peak memory for any length.
+
+        Chunks of chunk_frames frames (30s at 50 Hz) are decoded with
+        context_frames on both sides, of which only the chunk's own samples are
+        kept. The quantizer and fc_post2 work frame by frame and an output
+        sample of decoder_2 depends on the frames within about 11 of its own,
+        so with more context than that the chunks join without seams and equal
+        decode() up to float rounding. Codes of up to chunk_frames frames go
+        through decode() unchanged.
+        """
+        n_frames = codes.shape[-1]
+        if n_frames <= chunk_frames:
+            return self.decode(codes)
+
+        hop = int(self.hop_length)
+        chunks = []
+        for start in range(0, n_frames, chunk_frames):
+            end = min(start + chunk_frames, n_frames)
+            a = max(start - context_frames, 0)
+            b = min(end + context_frames, n_frames)
+            o = self.decode(codes[..., a:b])
+            chunks.append(o[..., (start - a) * hop : (end - a) * hop])
+        return torch.cat(chunks, dim=-1)
+
+
+class SoundStreamDecoder(nn.Module):
+    """The decoding part of SoundStream, for codes -> audio only.
+
+    Takes the arguments of SoundStream and builds just its quantizer, fc_post2
+    and decoder_2, under the same names, so neither the semantic model nor the
+    encoders are loaded. load_state_dict takes the state dict of a whole
+    SoundStream checkpoint and keeps the weights of these modules.
+    """
+
+    def __init__(
+        self,
+        n_filters: int = 32,
+        D: int = 128,
+        target_bandwidths: Sequence[Union[int, float]] = [1, 1.5, 2, 4, 6],
+        ratios: Sequence[int] = [8, 5, 4, 2],
+        sample_rate: int = 16000,
+        bins: int = 1024,
+        normalize: bool = False,
+        causal: bool = False,
+    ):
+        super().__init__()
+        self.hop_length = np.prod(ratios)
+        n_q = int(
+            1000
+            * target_bandwidths[-1]
+            // (math.ceil(sample_rate / self.hop_length) * 10)
+        )
+        self.frame_rate = math.ceil(sample_rate / np.prod(ratios))  # 50 Hz
+        self.n_q = n_q
+        self.sample_rate = sample_rate
+
+        self.quantizer = ResidualVectorQuantizer(dimension=D + 768, n_q=n_q, bins=bins)
+        self.fc_post2 = nn.Linear(D + 768, D)
+        self.decoder_2 = dac2.Decoder(
+            D,
+            1024,
+            ratios,
+        )
+        self.fused_embed = None
+        self.fused_decode = None
+
+    def load_state_dict(self, state_dict, strict: bool = True, **kwargs):
+        prefixes = tuple(f"{name}." for name, _ in self.named_children())
+        state_dict = {k: v for k, v in state_dict.items() if k.startswith(prefixes)}
+        return super().load_state_dict(state_dict, strict=strict, **kwargs)
+
+    fuse_quantizer = SoundStream.fuse_quantizer
+    get_embed = SoundStream.get_embed
+    decode = SoundStream.decode
+    decode_chunked = SoundStream.decode_chunked
+
 
 # test
 if __name__ == "__main__":
@@ -5,7 +5,7 @@ import time
 
 import torchaudio
 import torchaudio.functional as F
-import torchaudio.transforms as T
+from audio_io import load_audio
 
 
 def replace_low_freq_with_energy_matched(
@@ -33,14 +33,9 @@ def replace_low_freq_with_energy_matched(
     # ----------------------------------------------------------
     # 1. Load the two files
     # ----------------------------------------------------------
-    wave_a, sr_a = torchaudio.load(a_file)
-    wave_b, sr_b = torchaudio.load(b_file)
-
-    # If 'a' doesn't match 'b' sample rate, resample it
-    if sr_a != sr_b:
-        resampler = T.Resample(orig_freq=sr_a, new_freq=sr_b)
-        wave_a = resampler(wave_a)
-        sr_a = sr_b  # Now they match
+    wave_b, sr_b = load_audio(b_file)
+    # If 'a' doesn't match 'b' sample rate, it is resampled while loading
+    wave_a, sr_a = load_audio(a_file, sampling_rate=sr_b)
 
     # ----------------------------------------------------------
     # 2. Low-pass both signals to isolate low-frequency content
@@ -451,3 +451,38 @@ class ResidualVectorQuantization(nn.Module):
             quantized = layer.decode(indices)
             quantized_out = quantized_out + quantized
         return quantized_out
+
+
+class FusedResidualDecoder(nn.Module):
+    """Inference-only ResidualVectorQuantization.decode as one gather and sum.
+
+    At inference each layer's decode is a codebook lookup followed by the
+    fixed project_out, and a Linear post applied to the sum (like fc_post2)
+    distributes over it. So every codebook row is precomputed through
+    project_out and post's weight into one (n_q * codebook_size, dim) table, and a
+    decode is an embedding_bag summing the rows of a frame's codes, plus
+    post's bias. Built from the current weights, rebuild after changing them.
+    """
+
+    def __init__(
+        self, rvq: ResidualVectorQuantization, post: tp.Optional[nn.Linear] = None
+    ):
+        super().__init__()
+        with torch.no_grad():
+            table = torch.stack([layer.project_out(layer.codebook) for layer in rvq.layers])
+            if post is not None:
+                table = table @ post.weight.t()
+        self.codebook_size = table.shape[1]
+        self.register_buffer("table", table.reshape(-1, table.shape[-1]), persistent=False)
+        bias = None if post is None or post.bias is None else post.bias.detach().clone()
+        self.register_buffer("bias", bias, persistent=False)
+
+    def forward(self, q_indices: torch.Tensor) -> torch.Tensor:
+        """(n_q, B, T) codes -> (B, dim, T), like decode (then post)."""
+        n_q, batch_size, n_frames = q_indices.shape
+        offsets = torch.arange(n_q, device=q_indices.device) * self.codebook_size
+        rows = (q_indices + offsets.view(-1, 1, 1)).permute(1, 2, 0).reshape(-1, n_q)
+        quantized = F.embedding_bag(rows, self.table, mode="sum")
+        if self.bias is not None:
+            quantized = quantized + self.bias
+        return rearrange(quantized.view(batch_size, n_frames, -1), "b n d -> b d n")
@@ -14,7 +14,7 @@ import torch
 from torch import nn
 
 # from .core_vq import ResidualVectorQuantization
-from .core_vq_lsx_version import ResidualVectorQuantization
+from .core_vq_lsx_version import FusedResidualDecoder, ResidualVectorQuantization
 
 
 @dataclass
@@ -117,3 +117,7 @@ class ResidualVectorQuantizer(nn.Module):
         """Decode the given codes to the quantized representation."""
         quantized = self.vq.decode(codes)
         return quantized
+
+    def fused_decoder(self, post: tp.Optional[nn.Linear] = None) -> FusedResidualDecoder:
+        """decode (followed by post) precomputed for inference, see FusedResidualDecoder."""
+        return FusedResidualDecoder(self.vq, post)
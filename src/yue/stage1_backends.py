@@ -0,0 +1,346 @@
+"""Stage 1 generation backends.
+
+A backend owns the model and one KV cache holding the song context plus, with
+CFG, an unconditional row. Stage1Pipeline.generate writes prompt assembly,
+window slicing, CFG, sampling, loop handling and resume/extend once on top of
+this protocol:
+
+    alloc(bsz, cache_len)         allocate the cache of a job, bsz 2 adds the CFG row
+    prefill(tokens, uncond_from)  append prompt tokens
+    decode_step(token)            append one sampled token
+    trim(n_tokens)                roll the cache back to its first n_tokens
+    snapshot()                    state that trim() can return to
+
+prefill and decode_step return float32 logits (bsz, logits_end - logits_begin)
+of the last token on `backend.device`. The unconditional row only attends to
+the tokens from uncond_from on, with positions starting at 0 there.
+benchmark/stage1_backend_kit.py checks a backend against the HF reference.
+"""
+
+from typing import List
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from gguf_context import GGUFContext
+from transformers import AutoModelForCausalLM, QuantizedCache, StaticCache
+
+from common import align, get_cache_class, get_hf_cache_kwargs
+
+try:
+    from exllamav2 import ExLlamaV2, ExLlamaV2Config
+except ImportError:  # HF-only install
+    ExLlamaV2 = ExLlamaV2Config = None
+
+
+class Stage1Backend:
+    def __init__(self, device: torch.device, logits_begin: int = 0, logits_end: int = None):
+        self.device = device
+        self.logits_begin = logits_begin
+        self.logits_end = logits_end
+        self.bsz = 1
+        self.tokens: List[int] = []
+        self.uncond_from = 0
+
+    @property
+    def n_tokens(self) -> int:
+        return len(self.tokens)
+
+    def alloc(self, bsz: int, cache_len: int):
+        raise NotImplementedError
+
+    def prefill(self, tokens: List[int], uncond_from: int = 0) -> torch.Tensor:
+        raise NotImplementedError
+
+    def decode_step(self, token: int) -> torch.Tensor:
+        return self.prefill([token], self.uncond_from)
+
+    def trim(self, n_tokens: int):
+        raise NotImplementedError
+
+    def snapshot(self):
+        return self.n_tokens
+
+
+class Stage1Backend_HF(Stage1Backend):
+    """Transformers model with a StaticCache (compiled) or a QuantizedCache.
+
+    Both rows share one cache; an additive attention bias hides the prompt from
+    the CFG row. Prefill runs in chunks padded to power-of-two buckets, the
+    padding stays masked and is overwritten by later tokens.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        cache_mode: str = "FP16",
+        prefill_chunk: int = 512,
+        compile: bool = True,
+        dtype: torch.dtype = torch.bfloat16,
+        **kwargs,
+    ):
+        super().__init__(device, **kwargs)
+
+        # Load HF model, sdpa so the CFG row can use an additive attention mask
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_path,
+            torch_dtype=dtype,
+            attn_implementation="sdpa",
+            device_map=self.device,
+        )
+        self.model.eval()
+        # Only the rows of the sampled logits range go through the output layer
+        self.lm_head = self.model.lm_head.weight[self.logits_begin : self.logits_end]
+
+        self.cache_kwargs = get_hf_cache_kwargs(cache_mode)
+        if cache_mode == "Q6":
+            print("HF has no 6-bit KV cache, cache mode Q6 uses the 8-bit hqq cache of Q8.")
+        self.static_cache = not self.cache_kwargs
+        self.prefill_chunk = prefill_chunk
+
+        # With a StaticCache every decode step has the same shapes, so it compiles
+        # to a single graph (CUDA graph on GPU); prefill compiles once per bucket.
+        self.prefill_body = self.model.model
+        self.decode_body = self.model.model
+        if compile and self.static_cache and torch.__version__ >= "2.0.0":
+            self.prefill_body = torch.compile(self.model.model, dynamic=False)
+            self.decode_body = torch.compile(
+                self.model.model,
+                mode="reduce-overhead" if self.device.type == "cuda" else "default",
+                dynamic=False,
+            )
+
+    def new_cache(self):
+        if not self.static_cache:
+            return QuantizedCache(
+                config=self.model.config, **self.cache_kwargs["cache_config"]
+            )
+        return StaticCache(
+            config=self.model.config,
+            max_batch_size=self.bsz,
+            max_cache_len=self.cache_len,
+            device=self.device,
+            dtype=self.model.dtype,
+        )
+
+    def seek_cache(self, pos: int):
+        """Make the next StaticCache write start at pos, this also rolls the cache back."""
+        # Newer transformers write at a running offset instead of cache_position
+        for layer in getattr(self.cache, "layers", ()):
+            if torch.is_tensor(getattr(layer, "cumulative_length", None)):
+                layer.cumulative_length.fill_(pos)
+
+    def alloc(self, bsz: int, cache_len: int):
+        self.bsz = bsz
+        self.cache_len = cache_len
+        self.cache = self.new_cache()
+        # (bsz, 1, 1, cache_len), 0 for the slots each row may attend to
+        self.attn_bias = torch.full(
+            (bsz, 1, 1, cache_len),
+            torch.finfo(self.model.dtype).min,
+            dtype=self.model.dtype,
+            device=self.device,
+        )
+        self.tokens = []
+        self.uncond_from = 0
+
+    def prefill(self, tokens: List[int], uncond_from: int = 0) -> torch.Tensor:
+        if self.bsz > 1 and uncond_from != self.uncond_from:
+            self.attn_bias[1, ..., :uncond_from] = torch.finfo(self.attn_bias.dtype).min
+            self.uncond_from = uncond_from
+        input_ids = torch.tensor([tokens], dtype=torch.long).repeat(self.bsz, 1)
+        logits = self.forward(input_ids, self.n_tokens)
+        self.tokens += tokens
+        return logits
+
+    def trim(self, n_tokens: int):
+        tokens = self.tokens[:n_tokens]
+        self.tokens = tokens
+        self.attn_bias[..., n_tokens:] = torch.finfo(self.attn_bias.dtype).min
+        if not self.static_cache:
+            # Quantized caches can't be cropped, rebuild the context
+            self.cache = self.new_cache()
+            self.attn_bias.fill_(torch.finfo(self.attn_bias.dtype).min)
+            self.tokens = []
+            if tokens:
+                self.prefill(tokens, self.uncond_from)
+
+    def forward(self, input_ids: torch.Tensor, pos: int) -> torch.Tensor:
+        """Forward input_ids into cache positions pos.., return the logits of the last token."""
+        attn_bias = self.attn_bias
+        min_value = torch.finfo(attn_bias.dtype).min
+        uncond_from = self.uncond_from
+        n = input_ids.shape[-1]
+        logits = None
+        for start in range(0, n, self.prefill_chunk):
+            chunk = input_ids[:, start : start + self.prefill_chunk]
+            chunk_len = chunk.shape[-1]
+            chunk_pos = pos + start
+            padded_len = chunk_len
+            if self.static_cache and chunk_len > 1:
+                padded_len = min(
+                    1 << (chunk_len - 1).bit_length(),
+                    self.prefill_chunk,
+                    self.cache_len - chunk_pos,
+                )
+                chunk = F.pad(chunk, (0, padded_len - chunk_len), value=0)
+            attn_bias[..., chunk_pos : chunk_pos + chunk_len] = 0
+            if self.bsz > 1 and uncond_from > chunk_pos:
+                hidden_end = min(chunk_pos + chunk_len, uncond_from)
+                attn_bias[1, ..., chunk_pos:hidden_end] = min_value
+
+            cache_position = torch.arange(
+                chunk_pos, chunk_pos + padded_len, device=self.device
+            )
+            if self.static_cache:
+                kv_len = self.cache_len
+            else:
+                kv_len = chunk_pos + chunk_len
+            mask = attn_bias[..., :kv_len]
+            if padded_len > 1:
+                key_position = torch.arange(kv_len, device=self.device)
+                causal = key_position > cache_position[:, None]
+                mask = mask.expand(-1, -1, padded_len, -1).masked_fill(causal, min_value)
+            position_ids = cache_position.repeat(self.bsz, 1)
+            position_ids[1:] -= uncond_from
+            if self.static_cache:
+                self.seek_cache(chunk_pos)
+            body = self.decode_body if padded_len == 1 else self.prefill_body
+            hidden = body(
+                input_ids=chunk.to(self.device),
+                attention_mask=mask,
+                position_ids=position_ids,
+                cache_position=cache_position,
+                past_key_values=self.cache,
+                use_cache=True,
+            ).last_hidden_state
+            logits = F.linear(hidden[:, chunk_len - 1], self.lm_head).float()
+        return logits
+
+
+class Stage1Backend_EXL2(Stage1Backend):
+    """ExLlamaV2 model, the CFG row is masked with input_mask and position_offsets."""
+
+    def __init__(
+        self,
+        model_path: str,
+        device: torch.device,
+        cache_mode: str = "FP16",
+        no_flash_attn: bool = False,
+        **kwargs,
+    ):
+        super().__init__(device, **kwargs)
+
+        assert device != "cpu", "ExLlamaV2 does not support CPU inference."
+
+        # Load EXL2 model
+        device_idx = self.device.index
+        gpu_split = [0] * torch.cuda.device_count()
+        gpu_split[device_idx] = 9999
+        exl2_config = ExLlamaV2Config(model_path)
+        exl2_config.no_sdpa = True  # TODO: Figure out why SDPA slows to a crawl when given custom attn mask
+        if no_flash_attn:
+            exl2_config.no_flash_attn = True  # for old devices, 2000 series and older
+        self.config = exl2_config
+        self.model = ExLlamaV2(exl2_config)
+        self.model.load(gpu_split)
+        self.cache_class = get_cache_class(cache_mode)
+
+    def alloc(self, bsz: int, cache_len: int):
+        self.bsz = bsz
+        self.cache = self.cache_class(self.model, batch_size=bsz, max_seq_len=cache_len)
+        self.input_mask = torch.zeros((bsz, cache_len), dtype=torch.half, device=self.device)
+        self.tokens = []
+        self.uncond_from = 0
+
+    def prefill(self, tokens: List[int], uncond_from: int = 0) -> torch.Tensor:
+        input_mask = None
+        position_offsets = None
+        if self.bsz > 1:
+            if uncond_from != self.uncond_from:
+                self.input_mask[1].zero_()
+                self.input_mask[1, :uncond_from] = -65504.0
+                self.uncond_from = uncond_from
+            input_mask = self.input_mask[:, : self.n_tokens + len(tokens)]
+            position_offsets = torch.tensor([[0], [-uncond_from]], dtype=torch.int)
+        logits = self.model.forward(
+            torch.tensor([tokens] * self.bsz, dtype=torch.long),
+            cache=self.cache,
+            input_mask=input_mask,
+            position_offsets=position_offsets,
+            last_id_only=True,
+        )
+        self.tokens += tokens
+        return logits[:, -1, self.logits_begin : self.logits_end].float().to(self.device)
+
+    def trim(self, n_tokens: int):
+        self.tokens = self.tokens[:n_tokens]
+        self.cache.current_seq_len = n_tokens
+
+
+class Stage1Backend_GGUF(Stage1Backend):
+    """llama.cpp on CPU (see convert_gguf.py).
+
+    llama.cpp has no per-row attention mask, so the CFG row is a second context
+    holding the tokens from uncond_from on. llama.cpp can't resize a KV cache,
+    so alloc creates the main context again whenever a job plans a different
+    cache_len (at most n_ctx), and only resets it otherwise. The CFG context is
+    created once, sized to one segment.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        n_ctx: int,
+        cache_mode: str = "FP16",
+        n_threads: int = None,
+        max_new_tokens: int = 3000,
+        **kwargs,
+    ):
+        super().__init__(torch.device("cpu"), **kwargs)
+        self.model_path = model_path
+        self.cache_mode = cache_mode
+        self.n_threads = n_threads
+        self.n_ctx = n_ctx
+        self.context = None
+        # The CFG row holds the last prompt token and one segment at most
+        self.uncond_n_ctx = align(max_new_tokens + 2, 256)
+        self.uncond_context = None
+
+    def alloc(self, bsz: int, cache_len: int):
+        assert cache_len <= self.n_ctx
+        self.bsz = bsz
+        if self.context is None or self.context.n_ctx != cache_len:
+            self.context = None  # free the last job's cache first
+            self.context = GGUFContext(
+                self.model_path, cache_len, self.n_threads, self.cache_mode
+            )
+        else:
+            self.context.reset()
+        if bsz > 1 and self.uncond_context is None:
+            self.uncond_context = GGUFContext(
+                self.model_path, self.uncond_n_ctx, self.n_threads, self.cache_mode
+            )
+        if self.uncond_context is not None:
+            self.uncond_context.reset()
+        self.tokens = []
+        self.uncond_from = 0
+
+    def prefill(self, tokens: List[int], uncond_from: int = 0) -> torch.Tensor:
+        logits = [self.context.eval(tokens)]
+        self.tokens += tokens
+        if self.bsz > 1:
+            if uncond_from != self.uncond_from:
+                self.uncond_context.reset()
+                self.uncond_from = uncond_from
+            pending = self.tokens[self.uncond_from + self.uncond_context.n_tokens :]
+            logits.append(self.uncond_context.eval(pending))
+        logits = np.stack(logits)[:, self.logits_begin : self.logits_end]
+        return torch.from_numpy(logits)
+
+    def trim(self, n_tokens: int):
+        self.tokens = self.tokens[:n_tokens]
+        self.context.seek(n_tokens)
+        if self.bsz > 1:
+            self.uncond_context.seek(max(n_tokens - self.uncond_from, 0))
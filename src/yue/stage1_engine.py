@@ -0,0 +1,462 @@
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+import torch
+from loop_detector import LoopDetector
+
+from common import plan_cache_len, stage1_needed_tokens
+
+MASKED = -65504.0
+
+
+@dataclass
+class Stage1Job:
+    """One song for the continuous-batching stage 1 engine.
+
+    `segment_prompts[0]` is the first segment prompt (header, optional audio
+    prompt, extend_mp3 context), the rest are the following segment prompts.
+    `prefix` holds tokens already in the context before the first prompt
+    (e.g. a resumed sequence). top_p, temperature and repetition_penalty are
+    read by the pipeline's sampler, like SampleSettings in generate().
+    """
+
+    job_id: str
+    segment_prompts: List[List[int]]
+    guidance_scale_seg0: Optional[float] = 1.5
+    guidance_scale: Optional[float] = 1.2
+    top_p: float = 0.93
+    temperature: float = 1.0
+    repetition_penalty: float = 1.1
+    seed: Optional[int] = None
+    prefix: List[int] = field(default_factory=list)
+    first_segment_index: int = 0
+    on_segment_end: Optional[Callable[["Stage1Job", int], None]] = None
+
+    # Filled in by the engine
+    seq: Optional[torch.Tensor] = None
+    loop_events: List[dict] = field(default_factory=list)
+    done: bool = False
+
+    @property
+    def cfg(self) -> bool:
+        return self.guidance_scale_seg0 is not None
+
+    @property
+    def n_rows(self) -> int:
+        return 2 if self.cfg else 1
+
+
+def plan_page_len(job: Stage1Job, max_new_tokens: int, max_page_len: int, bucket: int) -> int:
+    """Page length of a job: what its prefix, prompts and segments need, bucketed."""
+    needed_tokens = stage1_needed_tokens(
+        len(job.prefix), job.segment_prompts, max_new_tokens, max_page_len
+    )
+    return plan_cache_len(needed_tokens, max_page_len, bucket)
+
+
+class _Slot:
+    """Engine-side state of a job: its private cache page and batch rows."""
+
+    def __init__(self, job: Stage1Job, page, max_context: int, device: torch.device):
+        self.job = job
+        self.page = page
+        self.max_context = max_context
+        self.generator = torch.Generator(device=device)
+        if job.seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(job.seed)
+        self.segment = 0
+        self.ctx = torch.tensor([job.prefix], dtype=torch.long)
+        self.uncond_from = 0
+        self.page_len = 0
+        self.segment_seq_len = 0
+        self.first_logits = None
+        self.first_seen = None
+        self.seen = None
+        self.pending = None
+        self.new_tokens = 0
+        self.row = None
+        self.start = 0
+        self.detector = None
+
+    def cfg_scale(self) -> Optional[float]:
+        if not self.job.cfg:
+            return None
+        index = self.job.first_segment_index + self.segment
+        if index == 0:
+            return self.job.guidance_scale_seg0
+        return self.job.guidance_scale
+
+
+class Stage1Engine:
+    """Continuous-batching stage 1 decoder on top of an ExLlamaV2 model.
+
+    Songs share every decode step through one batch cache of `max_rows` rows.
+    Each song owns a private cache page where its context lives between
+    segments, sized for the song like generate() sizes its cache (see
+    plan_cache_len); prompts are prefilled on the page and the page is copied into
+    free batch rows (left-padded with a mask and position offsets, the same
+    mechanism stage 1 uses for the CFG row). A song that hits EOA leaves the
+    batch right away, its new tokens are copied back to its page, the next
+    segment prompt is prefilled and the song re-enters at the next step.
+    Other songs keep decoding meanwhile.
+
+    The engine only runs on ExLlamaV2, whose forward takes per-row masks and
+    position offsets; run_manifest renders songs one at a time with
+    Stage1Pipeline.generate() on the other backends. Tokens are sampled with
+    the pipeline's sampler, so a song gets the same CFG, repetition penalty,
+    allowed vocabulary and min_new_tokens as in generate().
+
+    Args:
+        model: Loaded ExLlamaV2 stage 1 model.
+        cache_class: ExLlamaV2 cache class (see common.get_cache_class).
+        sampler: Stage1Pipeline whose sample_token() and seen_mask() are used.
+        eoa_id (int): End-of-audio token id.
+        logits_begin (int): First token id passed to the sampler.
+        logits_end (int): End of the token id range passed to the sampler.
+        max_rows (int): Rows of the batch cache, a CFG song takes two.
+        page_len (int): Largest page, i.e. context length of a song (like --stage1_cache_size).
+        max_new_tokens (int): Max tokens per segment before EOA is forced.
+        page_bucket (int): Pages are rounded up to this many tokens, 0 gives every song page_len.
+        loop_policy (str): off, stop or resample, see loop_detector.
+        loop_retries (int): Resample attempts before a degenerate segment is stopped.
+    """
+
+    def __init__(
+        self,
+        model,
+        cache_class,
+        sampler,
+        eoa_id: int,
+        logits_begin: int,
+        logits_end: int,
+        max_rows: int,
+        page_len: int,
+        max_new_tokens: int,
+        page_bucket: int = 0,
+        loop_policy: str = "off",
+        loop_retries: int = 0,
+        loop_window: int = 200,
+    ):
+        self.model = model
+        self.cache_class = cache_class
+        self.sampler = sampler
+        self.eoa_id = eoa_id
+        self.logits_begin = logits_begin
+        self.logits_end = logits_end
+        self.max_rows = max_rows
+        self.page_len = page_len
+        self.max_new_tokens = max_new_tokens
+        self.page_bucket = page_bucket
+        self.loop_policy = loop_policy
+        self.loop_retries = loop_retries
+        self.loop_window = loop_window
+        assert page_len > max_new_tokens + 1, "page_len must exceed max_new_tokens"
+
+        # Slack columns let the batch advance between compactions
+        self.capacity = page_len + max_new_tokens
+        self.cache = cache_class(model, batch_size=max_rows, max_seq_len=self.capacity)
+        self.device = self.cache.key_states[0].device
+        self.mask = torch.full(
+            (max_rows, self.capacity), MASKED, dtype=torch.half, device=self.device
+        )
+        self.offsets = torch.zeros((max_rows, 1), dtype=torch.int)
+        self.rows: List[Optional[_Slot]] = [None] * max_rows
+
+        self.waiting = deque()  # submitted jobs without a page yet
+        self.ready = deque()  # prefilled slots waiting for free rows
+        self.active: List[_Slot] = []
+        self.finished: List[Stage1Job] = []
+        self.free_pages = {1: [], 2: []}
+
+    # Public API
+
+    def submit(self, job: Stage1Job):
+        """Queue a song, it is admitted into the batch at the next step with free rows."""
+        assert job.n_rows <= self.max_rows
+        self.waiting.append(job)
+
+    def has_work(self) -> bool:
+        return bool(self.waiting or self.ready or self.active)
+
+    def run(self) -> List[Stage1Job]:
+        """Step until every submitted job is done, return the finished jobs in order."""
+        while self.has_work():
+            self.step()
+        finished, self.finished = self.finished, []
+        return finished
+
+    def step(self):
+        """Admit ready songs into free rows and run one batched decode step."""
+        self._start_waiting()
+        self._admit()
+        if not self.active:
+            return
+        if self.cache.current_seq_len + 1 > self.capacity:
+            self._compact()
+
+        seq_len = self.cache.current_seq_len
+        tokens = torch.full((self.max_rows, 1), self.eoa_id, dtype=torch.long)
+        for slot in self.active:
+            tokens[slot.row : slot.row + slot.job.n_rows] = slot.pending
+        logits = self.model.forward(
+            tokens,
+            cache=self.cache,
+            input_mask=self.mask[:, : seq_len + 1],
+            position_offsets=self.offsets,
+        )
+        logits = logits[:, -1, self.logits_begin : self.logits_end].float()
+
+        for slot in list(self.active):
+            job = slot.job
+            slot.ctx = torch.cat((slot.ctx, slot.pending[:1]), dim=-1)
+            job.seq = torch.cat((job.seq, slot.pending[:1]), dim=-1)
+            if slot.pending[0, 0].item() == self.eoa_id:
+                self._end_segment(slot)
+                continue
+            self._sample(slot, logits[slot.row : slot.row + job.n_rows])
+
+    # Scheduling
+
+    def _start_waiting(self):
+        # Only hold pages for songs that can enter the batch soon
+        free_rows = self.max_rows - sum(s.job.n_rows for s in self.active)
+        free_rows -= sum(s.job.n_rows for s in self.ready)
+        while self.waiting and self.waiting[0].n_rows <= free_rows:
+            job = self.waiting.popleft()
+            free_rows -= job.n_rows
+            page_len = plan_page_len(job, self.max_new_tokens, self.page_len, self.page_bucket)
+            slot = _Slot(
+                job,
+                self._get_page(job.n_rows, page_len),
+                page_len - self.max_new_tokens - 1,
+                self.device,
+            )
+            job.seq = slot.ctx.clone()
+            self._prefill(slot, job.segment_prompts[0])
+            self.ready.append(slot)
+
+    def _admit(self):
+        while self.ready:
+            slot = self.ready[0]
+            row = self._find_rows(slot.job.n_rows)
+            if row is None:
+                return
+            self.ready.popleft()
+            self._enter(slot, row)
+
+    def _find_rows(self, n: int) -> Optional[int]:
+        for row in range(self.max_rows - n + 1):
+            if all(r is None for r in self.rows[row : row + n]):
+                return row
+        return None
+
+    def _get_page(self, n_rows: int, page_len: int):
+        # Smallest free page that fits, a too small one is dropped for the new page
+        free = self.free_pages[n_rows]
+        fits = [page for page in free if page.max_seq_len >= page_len]
+        if fits:
+            page = min(fits, key=lambda page: page.max_seq_len)
+            free.remove(page)
+            page.current_seq_len = 0
+            return page
+        if free:
+            free.pop()
+        return self.cache_class(self.model, batch_size=n_rows, max_seq_len=page_len)
+
+    # Per-song work
+
+    def _prefill(self, slot: _Slot, prompt: List[int]):
+        """Append a segment prompt on the song's page and sample its first token."""
+        job = slot.job
+        prompt = torch.tensor([prompt], dtype=torch.long)
+        ctx = torch.cat((slot.ctx, prompt), dim=-1)
+        if ctx.shape[-1] > slot.max_context:
+            print(
+                f"{job.job_id}: output length {ctx.shape[-1]} exceeding context length "
+                f"{slot.max_context}, now using the last {slot.max_context} tokens."
+            )
+            ctx = ctx[:, -slot.max_context :]
+            slot.page.current_seq_len = 0
+        # Everything not on the page yet, i.e. the prompt, or prefix + prompt at first
+        incremental = ctx[:, slot.page.current_seq_len :]
+        slot.ctx = ctx
+        job.seq = torch.cat((job.seq, prompt), dim=-1)
+
+        input_mask = None
+        position_offsets = None
+        if job.cfg:
+            # For the unconditional context, mask out all but the last token
+            mask_len = ctx.shape[-1] - 1
+            input_mask = torch.zeros(
+                (2, ctx.shape[-1]), dtype=torch.half, device=self.device
+            )
+            input_mask[1, :mask_len] = MASKED
+            position_offsets = torch.tensor([[0], [-mask_len]], dtype=torch.int)
+            slot.uncond_from = mask_len
+        slot.first_logits = self.model.forward(
+            incremental.repeat(job.n_rows, 1),
+            cache=slot.page,
+            input_mask=input_mask,
+            position_offsets=position_offsets,
+            last_id_only=True,
+        )[:, -1, self.logits_begin : self.logits_end].float()
+        slot.first_seen = self.sampler.seen_mask(ctx[0].tolist(), self.device)
+        slot.page_len = ctx.shape[-1]
+        slot.segment_seq_len = job.seq.shape[-1]
+        self._start_segment(slot)
+
+    def _start_segment(self, slot: _Slot):
+        slot.new_tokens = 0
+        slot.seen = slot.first_seen.clone()
+        if self.loop_policy != "off":
+            slot.detector = LoopDetector(window=self.loop_window)
+        self._sample(slot, slot.first_logits)
+
+    def _sample(self, slot: _Slot, logits: torch.Tensor):
+        job = slot.job
+        if slot.new_tokens == self.max_new_tokens:
+            # Make sure the segment ends with EOA if we reached max_new_tokens
+            slot.pending = torch.tensor([[self.eoa_id]] * job.n_rows, dtype=torch.long)
+            return
+
+        token = self.sampler.sample_token(
+            logits, slot.cfg_scale(), slot.seen, slot.new_tokens, job, slot.generator
+        )
+
+        if slot.detector is not None:
+            event = slot.detector.update(token)
+            if event is not None:
+                segment = job.first_segment_index + slot.segment
+                retry = sum(e["segment"] == segment for e in job.loop_events)
+                event.update(segment=segment, new_tokens=slot.new_tokens, retry=retry)
+                job.loop_events.append(event)
+                if self.loop_policy == "resample" and retry < self.loop_retries:
+                    print(f"{job.job_id}: degenerate segment {segment}, resampling.")
+                    self._resample(slot)
+                    return
+                print(f"{job.job_id}: degenerate segment {segment}, ending early.")
+                token = self.eoa_id
+
+        slot.new_tokens += 1
+        slot.seen[token - self.logits_begin] = True
+        slot.pending = torch.tensor([[token]] * job.n_rows, dtype=torch.long)
+
+    def _resample(self, slot: _Slot):
+        # The page still holds the segment start, drop the batch rows and start over
+        if slot.row is not None:
+            self._leave(slot)
+        slot.ctx = slot.ctx[:, : slot.page_len]
+        slot.job.seq = slot.job.seq[:, : slot.segment_seq_len]
+        slot.page.current_seq_len = slot.page_len
+        self._start_segment(slot)
+        self.ready.appendleft(slot)
+
+    def _end_segment(self, slot: _Slot):
+        job = slot.job
+        self._copy_back(slot)
+        self._leave(slot)
+        if job.on_segment_end is not None:
+            job.on_segment_end(job, job.first_segment_index + slot.segment)
+        slot.segment += 1
+        if slot.segment < len(job.segment_prompts):
+            self._prefill(slot, job.segment_prompts[slot.segment])
+            self.ready.append(slot)
+        else:
+            job.done = True
+            self.free_pages[job.n_rows].append(slot.page)
+            self.finished.append(job)
+
+    # Batch cache bookkeeping
+
+    def _enter(self, slot: _Slot, row: int):
+        n = slot.page_len
+        if self.cache.current_seq_len + 1 > self.capacity:
+            self._compact()
+        seq_len = self.cache.current_seq_len
+        if n > seq_len:
+            self._shift(n - seq_len)
+            seq_len = n
+        start = seq_len - n
+        rows = slice(row, row + slot.job.n_rows)
+        for src, dst in zip(_cache_tensors(slot.page), _cache_tensors(self.cache)):
+            dst[rows, start:seq_len].copy_(src[:, :n])
+        slot.row = row
+        slot.start = start
+        self.mask[rows] = MASKED
+        self.mask[row, start:] = 0
+        self.offsets[row] = -start
+        if slot.job.cfg:
+            self.mask[row + 1, start + slot.uncond_from :] = 0
+            self.offsets[row + 1] = -(start + slot.uncond_from)
+        for r in range(row, row + slot.job.n_rows):
+            self.rows[r] = slot
+        self.active.append(slot)
+
+    def _leave(self, slot: _Slot):
+        rows = slice(slot.row, slot.row + slot.job.n_rows)
+        self.mask[rows] = MASKED
+        self.offsets[rows] = 0
+        for r in range(slot.row, slot.row + slot.job.n_rows):
+            self.rows[r] = None
+        self.active.remove(slot)
+        slot.row = None
+        if not self.active:
+            self.cache.current_seq_len = 0
+
+    def _copy_back(self, slot: _Slot):
+        # Tokens generated in the batch are appended to the song's page
+        n_new = slot.ctx.shape[-1] - slot.page_len
+        src_begin = slot.start + slot.page_len
+        rows = slice(slot.row, slot.row + slot.job.n_rows)
+        for src, dst in zip(_cache_tensors(self.cache), _cache_tensors(slot.page)):
+            dst[:, slot.page_len : slot.page_len + n_new].copy_(
+                src[rows, src_begin : src_begin + n_new]
+            )
+        slot.page.current_seq_len = slot.ctx.shape[-1]
+        slot.page_len = slot.ctx.shape[-1]
+
+    def _shift(self, delta: int):
+        """Move all rows delta columns to the right to make room for a longer page."""
+        seq_len = self.cache.current_seq_len
+        for t in _cache_tensors(self.cache):
+            t[:, delta : delta + seq_len] = t[:, :seq_len].clone()
+        self.mask[:, delta:] = self.mask[:, : self.capacity - delta].clone()
+        self.mask[:, :delta] = MASKED
+        self.offsets -= delta
+        self._clear_free_offsets()
+        for slot in self.active:
+            slot.start += delta
+        self.cache.current_seq_len = seq_len + delta
+
+    def _compact(self):
+        """Drop the columns left of every active song to free room on the right."""
+        seq_len = self.cache.current_seq_len
+        delta = min(slot.start for slot in self.active)
+        assert delta > 0, "batch cache full"
+        for t in _cache_tensors(self.cache):
+            t[:, : seq_len - delta] = t[:, delta:seq_len].clone()
+        self.mask[:, : self.capacity - delta] = self.mask[:, delta:].clone()
+        self.mask[:, self.capacity - delta :] = MASKED
+        for slot in self.active:
+            self.mask[slot.row : slot.row + slot.job.n_rows, self.capacity - delta :] = 0
+            slot.start -= delta
+        self.offsets += delta
+        self._clear_free_offsets()
+        self.cache.current_seq_len = seq_len - delta
+
+    def _clear_free_offsets(self):
+        # Free rows decode masked filler from position 0, never a negative one
+        for r, slot in enumerate(self.rows):
+            if slot is None:
+                self.offsets[r] = 0
+
+
+def _cache_tensors(cache):
+    """All per-layer cache tensors, laid out as (batch, seq, ...)."""
+    for name in ("key_states", "value_states", "key_scales", "value_scales"):
+        for t in getattr(cache, name, None) or []:
+            if t is not None:
+                yield t
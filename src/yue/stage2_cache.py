@@ -0,0 +1,108 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+# Bump when the decoding of a window changes, old entries are then never hit
+CACHE_VERSION = 1
+
+
+def model_fingerprint(args) -> str:
+    """Identify the stage 2 model and backend whose outputs go into the cache.
+
+    Local model files are identified by name, size and mtime, so a re-converted
+    or re-downloaded model does not hit the entries of the old one.
+    """
+    if args.stage2_use_exl2:
+        parts = ["exl2", args.stage2_cache_mode]
+    elif args.stage2_use_gguf:
+        parts = ["gguf", args.stage2_cache_mode]
+    else:
+        parts = ["hf"]
+    parts = [CACHE_VERSION] + parts + [args.stage2_model]
+
+    path = args.stage2_model
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, name) for name in os.listdir(path))
+    else:
+        files = [path] if os.path.isfile(path) else []
+    for file in files:
+        stat = os.stat(file)
+        parts += [os.path.basename(file), stat.st_size, stat.st_mtime_ns]
+    return hashlib.sha256("\n".join(map(str, parts)).encode()).hexdigest()
+
+
+class Stage2ResultCache:
+    """On-disk cache of stage 2 window outputs, keyed by model and codebook 0 frames.
+
+    Stage 2 decodes greedily, so a window with the same codebook 0 frames as
+    one of an earlier run (--resume_after_n, --extend_mp3, reruns) gives the
+    same codes. Each entry is the (8, n_frames) uint16 codes of one window in
+    <cache_dir>/<key[:2]>/<key>.npy. Once the entries exceed max_bytes the
+    least recently used ones are deleted.
+    """
+
+    def __init__(self, cache_dir: str, model_key: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.model_key = model_key
+        self.max_bytes = max_bytes
+
+        # Least recently used first, by mtime (touched on every hit)
+        entries = []
+        os.makedirs(cache_dir, exist_ok=True)
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                if name.endswith(".npy"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime_ns, name[:-4], stat.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.entries.values())
+        self.evict()
+
+    def key(self, codec_ids: np.ndarray) -> str:
+        frames = np.ascontiguousarray(codec_ids, dtype=np.int64).reshape(-1)
+        return hashlib.sha256(self.model_key.encode() + frames.tobytes()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def get(self, codec_ids: np.ndarray) -> Optional[np.ndarray]:
+        key = self.key(codec_ids)
+        if key in self.entries:
+            try:
+                codes = np.load(self.path(key))
+                os.utime(self.path(key))
+            except (OSError, ValueError):  # evicted by another run, or a partial file
+                self.total_bytes -= self.entries.pop(key)
+            else:
+                self.entries.move_to_end(key)
+                return codes
+        return None
+
+    def put(self, codec_ids: np.ndarray, codes: np.ndarray):
+        if codes.min() < 0 or codes.max() > 1023:
+            return  # left to fix_output, which looks at the whole track
+        key = self.key(codec_ids)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, codes.astype(np.uint16))
+        os.replace(tmp_path, path)
+
+        self.total_bytes -= self.entries.pop(key, 0)
+        self.entries[key] = os.path.getsize(path)
+        self.total_bytes += self.entries[key]
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits max_bytes, the newest one is kept."""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            old_key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self.path(old_key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+
+import psutil
+import torch
+
+from common import align
+
+# Bytes per cached K or V value. The quantized ExLlamaV2 caches also keep an
+# fp16 scale per group of 32 values.
+CACHE_MODE_BYTES = {
+    "FP16": 2.0,
+    "Q8": 1.0 + 2 / 32,
+    "Q6": 0.75 + 2 / 32,
+    "Q4": 0.5 + 2 / 32,
+}
+
+# Share of the free memory used for batches, the rest is left to the allocator's
+# fragmentation and to the CUDA context and other processes
+FREE_MEMORY_FRACTION = 0.9
+
+
+@dataclass
+class Stage2MemoryModel:
+    """Estimate of the memory one row of a stage 2 batch needs.
+
+    A row of a window of n frames holds a KV cache of 3 + 9 * n tokens (prompt,
+    then cb0 and 7 codes per frame). The activation peak is the prompt forward:
+    the hidden states and MLP intermediates of its n + 4 tokens in one layer,
+    the attention scores if they are materialized, and the logits of the last
+    token. Estimates are slightly high rather than low.
+    """
+
+    n_layers: int
+    n_heads: int
+    n_kv_heads: int
+    head_dim: int
+    hidden_size: int
+    intermediate_size: int
+    vocab_size: int
+    cache_bytes: float  # per K or V value
+    activation_bytes: int  # per activation value
+
+    @classmethod
+    def from_config(cls, config, cache_bytes: float, activation_bytes: int) -> "Stage2MemoryModel":
+        """From a transformers or ExLlamaV2 config, which use the same attribute names."""
+        n_heads = config.num_attention_heads
+        return cls(
+            n_layers=config.num_hidden_layers,
+            n_heads=n_heads,
+            n_kv_heads=getattr(config, "num_key_value_heads", None) or n_heads,
+            head_dim=getattr(config, "head_dim", None) or config.hidden_size // n_heads,
+            hidden_size=config.hidden_size,
+            intermediate_size=config.intermediate_size,
+            vocab_size=config.vocab_size,
+            cache_bytes=cache_bytes,
+            activation_bytes=activation_bytes,
+        )
+
+    def cache_bytes_per_token(self) -> float:
+        return 2 * self.n_layers * self.n_kv_heads * self.head_dim * self.cache_bytes
+
+    def row_bytes(self, n_frames: int) -> int:
+        seq_len = align(3 + n_frames * 9, 32)
+        prompt_len = n_frames + 4
+        cache = seq_len * self.cache_bytes_per_token()
+        activations = (
+            prompt_len * (4 * self.hidden_size + 3 * self.intermediate_size)
+            + self.n_heads * prompt_len * prompt_len
+        ) * self.activation_bytes
+        logits = self.vocab_size * 4
+        return int(cache + activations + logits)
+
+    def max_batch_size(self, n_frames: int, budget: int) -> int:
+        """Rows of windows of up to n_frames that fit in budget bytes, at least one."""
+        return max(1, budget // self.row_bytes(n_frames))
+
+
+def memory_budget(device: torch.device, memory_gb: float = 0.0, share: float = 1.0) -> int:
+    """Bytes stage 2 batches may use on device.
+
+    memory_gb overrides the measurement (--stage2_memory_gb, which also makes
+    plans reproducible on any machine). Otherwise it is the free memory at the
+    time of the call, after the model is loaded, times FREE_MEMORY_FRACTION and
+    share, the part of the device this pipeline has to itself.
+    """
+    if memory_gb > 0:
+        return int(memory_gb * 2**30 * share)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        # Blocks the torch allocator holds but doesn't use are free for the cache too
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    else:
+        free = psutil.virtual_memory().available
+    return int(free * FREE_MEMORY_FRACTION * share)
@@ -8,13 +8,16 @@ from time import time
 import numpy as np
 import torch
 import torchaudio
+from models.soundstream_hubert_new import SoundStreamDecoder
 from omegaconf import OmegaConf
 from tqdm import tqdm
 from vocos import VocosDecoder
 
 
 def build_soundstream_model(config):
-    model = eval(config.generator.name)(**config.generator.config)
+    # Only get_embed is used, so the semantic model and the encoders are never built
+    assert config.generator.name == "SoundStream"
+    model = SoundStreamDecoder(**config.generator.config)
     return model
 
 
@@ -168,9 +171,10 @@ def main():
     # Initialize models
     config_ss = OmegaConf.load("./final_ckpt/config.yaml")
     soundstream = build_soundstream_model(config_ss)
-    parameter_dict = torch.load(args.resume_path)
+    parameter_dict = torch.load(args.resume_path, map_location="cpu")
     soundstream.load_state_dict(parameter_dict["codec_model"])
     soundstream.eval()
+    soundstream.fuse_quantizer()
 
     vocal_decoder, inst_decoder = build_codec_model(
         args.config_path, args.vocal_decoder_path, args.inst_decoder_path
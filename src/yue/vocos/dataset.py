@@ -3,6 +3,7 @@ from dataclasses import dataclass
 import numpy as np
 import torch
 import torchaudio
+from audio_io import load_audio, resample
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, Dataset
 
@@ -55,18 +56,13 @@ class VocosDataset(Dataset):
 
     def __getitem__(self, index: int) -> torch.Tensor:
         audio_path = self.filelist[index]
-        y, sr = torchaudio.load(audio_path)
-        if y.size(0) > 1:
-            # mix to mono
-            y = y.mean(dim=0, keepdim=True)
+        y, sr = load_audio(audio_path, mono=True)
         gain = np.random.uniform(-1, -6) if self.train else -3
         y, _ = torchaudio.sox_effects.apply_effects_tensor(
             y, sr, [["norm", f"{gain:.2f}"]]
         )
         if sr != self.sampling_rate:
-            y = torchaudio.functional.resample(
-                y, orig_freq=sr, new_freq=self.sampling_rate
-            )
+            y = resample(y, sr, self.sampling_rate)
         if y.size(-1) < self.num_samples:
             pad_length = self.num_samples - y.size(-1)
             padding_tensor = y.repeat(1, 1 + pad_length // y.size(-1))
@@ -3,8 +3,8 @@ import math
 import numpy as np
 import pytorch_lightning as pl
 import torch
-import torchaudio
 import transformers
+from audio_io import resample
 from vocos.discriminators import MultiPeriodDiscriminator, MultiResolutionDiscriminator
 from vocos.feature_extractors import FeatureExtractor
 from vocos.heads import FourierHead
@@ -237,12 +237,8 @@ class VocosExp(pl.LightningModule):
         audio_input = batch
         audio_hat = self(audio_input, **kwargs)
 
-        audio_16_khz = torchaudio.functional.resample(
-            audio_input, orig_freq=self.hparams.sample_rate, new_freq=16000
-        )
-        audio_hat_16khz = torchaudio.functional.resample(
-            audio_hat, orig_freq=self.hparams.sample_rate, new_freq=16000
-        )
+        audio_16_khz = resample(audio_input, self.hparams.sample_rate, 16000)
+        audio_hat_16khz = resample(audio_hat, self.hparams.sample_rate, 16000)
 
         if self.hparams.evaluate_periodicty:
             from metrics.periodicity import calculate_periodicity_metrics
@@ -2,6 +2,7 @@ from typing import List
 
 import torch
 import torchaudio
+from audio_io import resample
 from omegaconf import OmegaConf
 
 # from encodec import EncodecModel
@@ -132,14 +133,11 @@ class xCodecFeatures(FeatureExtractor):
         self.model = eval(self.config.generator.name)(**self.config.generator.config)
         parameter_dict = torch.load(ckpt, map_location="cpu")
         self.model.load_state_dict(parameter_dict["codec_model"])
-        self.resampler = torchaudio.transforms.Resample(
-            orig_freq=44100, new_freq=16000
-        ).to("cuda")
         self.model.eval()
 
     def forward(self, audio: torch.Tensor):
         # resample audio from 44100 to 16000
-        audio = self.resampler(audio)
+        audio = resample(audio, 44100, 16000)
         with torch.no_grad():
             codes = self.model.encode(audio, target_bw=6)
         return codes
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# Modules of src/yue import each other by flat names, like when run from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "yue"))
+
+
+@pytest.fixture
+def randomize_codebooks():
+    """Fill the codebooks of a module's vector quantizers with random vectors.
+
+    Freshly built codebooks are zeros until k-means runs on the first batch,
+    which would make every decode trivially zero.
+    """
+
+    def randomize(module):
+        for name, buffer in module.named_buffers():
+            if name.endswith("inited"):
+                buffer.fill_(True)
+            elif name.endswith("embed"):
+                buffer.normal_()
+        return module
+
+    return randomize
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from audio_prompt_cache import AudioPromptCache
+
+
+@pytest.fixture
+def files(tmp_path):
+    checkpoint = tmp_path / "ckpt.pth"
+    checkpoint.write_bytes(b"codec")
+    audio = tmp_path / "a.mp3"
+    audio.write_bytes(b"audio a")
+    other = tmp_path / "b.mp3"
+    other.write_bytes(b"audio b")
+    return str(checkpoint), str(audio), str(other)
+
+
+class CountingEncoder:
+    """encode() callback returning (1, 1, frames) codes of each path, counting the paths it saw."""
+
+    def __init__(self, frames: int = 100):
+        self.frames = frames
+        self.paths = []
+
+    def __call__(self, paths):
+        self.paths += paths
+        return [
+            np.arange(self.frames, dtype=np.int16).reshape(1, 1, -1) + i * 1000
+            for i, _ in enumerate(paths)
+        ]
+
+
+def test_ranges_of_a_file_share_one_encode(files):
+    checkpoint, audio, _ = files
+    cache = AudioPromptCache(checkpoint)
+    encoder = CountingEncoder()
+
+    prompt = cache.get_many([audio], 0.5, encoder, 10, 30)[0]
+    extend = cache.get_many([audio], 0.5, encoder, 20, None)[0]
+    whole = cache.get_many([audio], 0.5, encoder)[0]
+
+    assert encoder.paths == [audio]
+    np.testing.assert_array_equal(prompt[0, 0], np.arange(10, 30))
+    np.testing.assert_array_equal(extend[0, 0], np.arange(20, 100))
+    assert whole.shape == (1, 1, 100)
+
+
+def test_trimmed_copies_leave_the_entry_whole(files):
+    checkpoint, audio, _ = files
+    cache = AudioPromptCache(checkpoint)
+    encoder = CountingEncoder()
+
+    cache.get_many([audio], 0.5, encoder, 0, 10)[0][:] = -1
+    np.testing.assert_array_equal(cache.get_many([audio], 0.5, encoder)[0][0, 0], np.arange(100))
+
+
+def test_misses_are_encoded_once_in_one_batch(files):
+    checkpoint, audio, other = files
+    cache = AudioPromptCache(checkpoint)
+    encoder = CountingEncoder()
+
+    codes = cache.get_many([audio, other, audio], 0.5, encoder, 5, 6)
+    assert encoder.paths == [audio, other]
+    assert [int(c[0, 0, 0]) for c in codes] == [5, 1005, 5]
+
+
+def test_key_changes_with_bandwidth_and_checkpoint(files, tmp_path):
+    checkpoint, audio, _ = files
+    cache = AudioPromptCache(checkpoint)
+    key = cache.key(audio, 0.5)
+    assert cache.key(audio, 1.0) != key
+
+    other_checkpoint = tmp_path / "other.pth"
+    other_checkpoint.write_bytes(b"codec")
+    assert AudioPromptCache(str(other_checkpoint)).key(audio, 0.5) != key
+
+
+def test_cache_dir_is_shared_across_runs(files, tmp_path):
+    checkpoint, audio, _ = files
+    cache_dir = str(tmp_path / "cache")
+    AudioPromptCache(checkpoint, cache_dir).get_many([audio], 0.5, CountingEncoder(), 0, 10)
+
+    encoder = CountingEncoder()
+    codes = AudioPromptCache(checkpoint, cache_dir).get_many([audio], 0.5, encoder, 50, None)[0]
+    assert encoder.paths == []
+    np.testing.assert_array_equal(codes[0, 0], np.arange(50, 100))
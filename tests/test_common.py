@@ -0,0 +1,60 @@
+import pytest
+import torch
+
+from common import AllowedVocabProcessor
+
+EOA = 32002
+CODEC_BEGIN, CODEC_END = 45334, 56722
+VOCAB = 83734
+
+
+@pytest.fixture
+def vocab():
+    return AllowedVocabProcessor([(EOA, EOA + 1), (CODEC_BEGIN, CODEC_END)])
+
+
+def test_masks_all_but_allowed_ranges(vocab):
+    scores = torch.randn(2, VOCAB)
+    masked = vocab.apply(scores)
+    allowed = torch.zeros(VOCAB, dtype=torch.bool)
+    allowed[EOA] = True
+    allowed[CODEC_BEGIN:CODEC_END] = True
+    assert torch.equal(masked[:, allowed], scores[:, allowed])
+    assert torch.isneginf(masked[:, ~allowed]).all()
+
+
+def test_logits_processor_call(vocab):
+    scores = torch.randn(1, VOCAB)
+    assert torch.equal(vocab(torch.zeros((1, 5), dtype=torch.long), scores), vocab.apply(scores))
+
+
+def test_slice_then_apply_with_offset(vocab):
+    scores = torch.randn(3, VOCAB)
+    assert (vocab.begin, vocab.end) == (EOA, CODEC_END)
+    sliced = vocab.slice(scores)
+    assert sliced.shape == (3, CODEC_END - EOA)
+    assert torch.equal(vocab.apply(sliced, offset=vocab.begin), vocab.slice(vocab.apply(scores)))
+
+
+def test_offset_past_a_range():
+    # A slice starting inside the second range, the first one is left of it
+    vocab = AllowedVocabProcessor([(10, 20), (30, 40)])
+    bias = vocab.bias(20, "cpu", torch.float32, offset=35)
+    assert torch.equal(bias[:5], torch.zeros(5))
+    assert torch.isneginf(bias[5:]).all()
+
+
+def test_bias_cached_per_shape_and_dtype(vocab):
+    bias = vocab.bias(VOCAB, "cpu", torch.float32)
+    assert vocab.bias(VOCAB, "cpu", torch.float32) is bias
+    half = vocab.bias(VOCAB, "cpu", torch.float16)
+    assert half.dtype == torch.float16
+    assert half is not bias
+    scores = torch.randn(VOCAB, dtype=torch.float16)
+    assert vocab.apply(scores).dtype == torch.float16
+
+
+def test_empty_ranges_are_dropped():
+    vocab = AllowedVocabProcessor([(5, 5), (7, 9)])
+    assert vocab.allowed_ranges == [(7, 9)]
+    assert (vocab.begin, vocab.end) == (7, 9)
@@ -0,0 +1,134 @@
+import copy
+from collections import Counter
+
+import numpy as np
+import pytest
+import torch
+
+from infer_stage2 import Stage2Pipeline, Stage2Window
+
+
+class PlannedPipeline(Stage2Pipeline):
+    """Stage2Pipeline without a model, batches of up to 4 full windows or 8 short ones."""
+
+    def __init__(self):
+        super().__init__(torch.device("cpu"))
+
+    def max_batch_size(self, n_frames: int) -> int:
+        return 4 if n_frames > 150 else 8
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    return PlannedPipeline()
+
+
+def window(song_idx: int, seg_idx: int, n_frames: int, part_idx: int = 0) -> Stage2Window:
+    codec_ids = torch.arange(n_frames).view(1, -1) + 1000 * seg_idx
+    return Stage2Window(song_idx, part_idx, seg_idx, codec_ids)
+
+
+def test_plan_batches(pipeline):
+    # Three songs of 11 full windows and a tail, both tracks
+    windows = [
+        window(song_idx, seg_idx, 300 if seg_idx < 11 else tail, part_idx)
+        for song_idx, tail in enumerate([40, 160, 299])
+        for part_idx in range(2)
+        for seg_idx in range(12)
+    ]
+    batches = pipeline.plan_batches(windows)
+
+    planned = sorted(id(w) for batch in batches for w in batch)
+    assert planned == sorted(id(w) for w in windows)
+    longest = [batch[0].n_frames for batch in batches]
+    assert longest == sorted(longest, reverse=True)
+    for batch in batches:
+        assert batch[0].n_frames == max(w.n_frames for w in batch)
+        assert len(batch) <= pipeline.max_batch_size(batch[0].n_frames)
+    # The 160 frame tails ride along with full windows, 72 windows in 18 batches of 4
+    assert [len(batch) for batch in batches] == [4] * 18
+
+
+def test_plan_batches_spreads_windows_evenly(pipeline):
+    # 10 windows need 3 batches of up to 4, 4 + 3 + 3 rather than 4 + 4 + 2
+    batches = pipeline.plan_batches([window(0, i, 300) for i in range(10)])
+    assert [len(batch) for batch in batches] == [4, 3, 3]
+
+
+def test_plan_batches_short_windows_share_bigger_batches(pipeline):
+    windows = [window(0, i, 300) for i in range(4)] + [window(1, i, 100) for i in range(8)]
+    batches = pipeline.plan_batches(windows)
+    assert [len(batch) for batch in batches] == [4, 8]
+    assert all(w.n_frames == 100 for w in batches[1])
+
+
+def test_pad_batch(pipeline):
+    tokenizer = pipeline.mmtokenizer
+    windows = [window(0, 0, 5), window(0, 1, 2), window(1, 0, 4)]
+    codec_ids, prompt_ids, pad = pipeline.pad_batch(windows)
+
+    assert pad.tolist() == [0, 3, 1]
+    assert codec_ids.shape == (3, 5)
+    assert prompt_ids.shape == (3, 5 + 3)
+    for row, w in enumerate(windows):
+        ids = w.codec_ids[0]
+        # Short rows repeat their last frame
+        assert codec_ids[row, : w.n_frames].tolist() == ids.tolist()
+        assert (codec_ids[row, w.n_frames :] == ids[-1]).all()
+        # Prompts are left padded, so codebook 0 frames line up across rows
+        prompt = [tokenizer.soa, tokenizer.stage_1] + ids.tolist() + [tokenizer.stage_2]
+        assert prompt_ids[row, pad[row] :].tolist() == prompt
+        assert (prompt_ids[row, : pad[row]] == tokenizer.eoa).all()
+
+
+def fix_output_reference(output):
+    """The original Counter loop of Stage2Pipeline.fix_output."""
+    fixed_output = copy.deepcopy(output)
+    for i, line in enumerate(output):
+        for j, element in enumerate(line):
+            if element < 0 or element > 1023:
+                counter = Counter(line)
+                most_frequant = sorted(counter.items(), key=lambda x: x[1], reverse=True)[0][0]
+                fixed_output[i, j] = most_frequant
+    return fixed_output
+
+
+def random_track(rng, n_frames: int, invalid_rate: float, n_codes: int = 1024):
+    output = rng.integers(0, n_codes, (8, n_frames))
+    invalid = rng.random((8, n_frames)) < invalid_rate
+    output[invalid] = rng.choice([-1, 1024, 2047, -45334], invalid.sum())
+    return output
+
+
+FIX_OUTPUT_CASES = {
+    "all valid": lambda rng: random_track(rng, 30, 0.0),
+    "few invalid": lambda rng: random_track(rng, 500, 0.01),
+    "ties": lambda rng: random_track(rng, 40, 0.1, n_codes=4),
+    "invalid mode": lambda rng: np.where(
+        rng.random((8, 50)) < 0.6, -1, rng.integers(0, 1024, (8, 50))
+    ),
+    "invalid tie": lambda rng: np.array([[-1, 5, -1, 5, 7, 1024, 1024, 1024, 5, -1]] * 8),
+    "no valid code": lambda rng: rng.choice([-1, 1024, 5000], (8, 30)),
+}
+
+
+@pytest.mark.parametrize("case", FIX_OUTPUT_CASES)
+def test_fix_output_matches_counter_loop(pipeline, case):
+    output = FIX_OUTPUT_CASES[case](np.random.default_rng(0))
+    fixed = pipeline.fix_output(output)
+    assert np.array_equal(fixed, fix_output_reference(output))
+
+
+def test_fix_output_batched(pipeline):
+    rng = np.random.default_rng(1)
+    batch = np.stack([random_track(rng, 200, 0.05) for _ in range(4)])
+    fixed = pipeline.fix_output(batch)
+    assert fixed.shape == batch.shape
+    assert np.array_equal(fixed, np.stack([fix_output_reference(t) for t in batch]))
+
+
+def test_fix_output_leaves_input_alone(pipeline):
+    output = random_track(np.random.default_rng(2), 100, 0.05)
+    original = output.copy()
+    pipeline.fix_output(output)
+    assert np.array_equal(output, original)
@@ -0,0 +1,63 @@
+import numpy as np
+from loop_detector import CODEBOOK0_BEGIN, LoopDetector
+
+
+def feed(detector: LoopDetector, frames):
+    """Feed (vocal, instrumental) codebook 0 frames, return the events reported."""
+    events = []
+    for vocal, instrumental in frames:
+        for code in (vocal, instrumental):
+            event = detector.update(CODEBOOK0_BEGIN + int(code))
+            if event is not None:
+                events.append(event)
+    return events
+
+
+def test_ignores_tokens_outside_codebook_0():
+    detector = LoopDetector(window=8, stride=1, patience=1)
+    for token in [0, 32002, CODEBOOK0_BEGIN - 1, CODEBOOK0_BEGIN + 1024, 56000] * 10:
+        assert detector.update(token) is None
+    assert detector.n_frames == 0
+
+
+def test_diverse_output_passes():
+    rng = np.random.default_rng(0)
+    assert feed(LoopDetector(), rng.integers(0, 1024, (1000, 2))) == []
+
+
+def test_token_loop():
+    loop = [(1, 2), (3, 4), (5, 6), (7, 8), (9, 10)] * 100
+    events = feed(LoopDetector(window=200, stride=50, patience=2), loop)
+    # The window is full at frame 200, the second failed check is at frame 250
+    assert events[0]["reason"] == "repetition"
+    assert events[0]["frame"] == 250
+    assert events[0]["repetition"] >= 0.9
+
+
+def test_collapsed_codebook():
+    # Two codes per track, random enough that frame 4-grams rarely repeat
+    rng = np.random.default_rng(0)
+    events = feed(LoopDetector(window=200), rng.integers(0, 2, (400, 2)))
+    assert events and events[0]["reason"] == "entropy"
+    assert events[0]["entropy"] <= 1.5
+
+
+def test_patience_needs_consecutive_checks():
+    rng = np.random.default_rng(0)
+    loop = [(1, 2), (3, 4)] * 100
+    diverse = [tuple(f) for f in rng.integers(0, 1024, (100, 2))]
+    # The check at frame 100 fails, the ones at 150 to 250 see diverse frames,
+    # so the next failed check at 300 is a first strike again
+    events = feed(LoopDetector(window=100, stride=50, patience=2), loop[:100] + diverse + loop)
+    assert events[0]["frame"] == 350
+
+
+def test_reset():
+    detector = LoopDetector(window=8, stride=1, patience=1)
+    feed(detector, [(1, 1)] * 5)
+    detector.update(CODEBOOK0_BEGIN)  # half a frame
+    detector.reset()
+    assert detector.n_frames == 0
+    assert detector.repetition_rate() == 0.0
+    assert detector.entropy(0) == 0.0
+    assert feed(detector, [(1, 2)] * 7) == []
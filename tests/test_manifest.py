@@ -0,0 +1,85 @@
+import json
+
+import pytest
+from manifest import ManifestProgress, load_manifest
+
+
+def write_manifest(tmp_path, *entries) -> str:
+    path = tmp_path / "jobs.jsonl"
+    lines = [e if isinstance(e, str) else json.dumps(e) for e in entries]
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+def test_load_manifest(tmp_path):
+    (tmp_path / "lyrics.txt").write_text("[verse]\nla la\n", encoding="utf-8")
+    path = write_manifest(
+        tmp_path,
+        "# comment",
+        {"name": "first", "genre": " pop ", "lyrics": "[chorus]\noh", "seed": 7},
+        "",
+        {"genre": "rock", "lyrics_txt": "lyrics.txt", "prompt_end_time": 12.5},
+        {"name": "a/b", "genre": "jazz", "lyrics": "x", "audio_prompt_path": "p.mp3"},
+    )
+    jobs = load_manifest(path)
+
+    assert [job.name for job in jobs] == ["first", "job_00004", "a_b"]
+    assert (jobs[0].genre, jobs[0].lyrics, jobs[0].seed) == ("pop", "[chorus]\noh", 7)
+    assert jobs[1].lyrics == "[verse]\nla la"
+    assert jobs[1].prompt_end_time == 12.5
+    assert jobs[2].use_audio_prompt and not jobs[2].use_dual_tracks_prompt
+
+
+def test_unknown_key_names_the_job(tmp_path):
+    path = write_manifest(
+        tmp_path,
+        {"name": "fine", "genre": "pop", "lyrics": "x"},
+        {"name": "typo", "genre": "pop", "lyrics": "x", "prompt_endtime": 10},
+    )
+    with pytest.raises(ValueError, match=r"jobs\.jsonl:2: .*'prompt_endtime'.* job 'typo'"):
+        load_manifest(path)
+
+
+def test_unknown_key_of_an_unnamed_job(tmp_path):
+    path = write_manifest(tmp_path, {"genre": "pop", "lyric": "x"})
+    with pytest.raises(ValueError, match="job 'job_00001'"):
+        load_manifest(path)
+
+
+def test_duplicate_names(tmp_path):
+    job = {"name": "same", "genre": "pop", "lyrics": "x"}
+    with pytest.raises(ValueError, match="duplicate job name 'same'"):
+        load_manifest(write_manifest(tmp_path, job, job))
+
+
+def test_pending_follows_the_stages(tmp_path):
+    jobs = load_manifest(
+        write_manifest(tmp_path, *[{"name": n, "genre": "pop", "lyrics": "x"} for n in "abc"])
+    )
+    progress = ManifestProgress(str(tmp_path / "out"))
+    assert progress.pending(jobs, "stage1") == jobs
+    assert progress.pending(jobs, "stage2") == []
+
+    progress.mark(jobs[0], "stage1")
+    progress.mark(jobs[1], "stage1", "failed")
+    assert progress.pending(jobs, "stage1") == jobs[1:]
+    assert progress.pending(jobs, "stage2") == [jobs[0]]
+    assert progress.summary(jobs) == "stage1 1/3, stage2 0/3, postprocess 0/3"
+
+
+def test_rerun_skips_completed_jobs(tmp_path):
+    path = write_manifest(tmp_path, *[{"name": n, "genre": "pop", "lyrics": "x"} for n in "abc"])
+    output_dir = str(tmp_path / "out")
+    jobs = load_manifest(path)
+    progress = ManifestProgress(output_dir)
+    for stage in ("stage1", "stage2", "postprocess"):
+        progress.mark(jobs[0], stage)
+    progress.mark(jobs[1], "stage1")
+
+    # A rerun reads the progress saved next to the outputs
+    jobs = load_manifest(path)
+    progress = ManifestProgress(output_dir)
+    assert [job.name for job in progress.pending(jobs, "stage1")] == ["c"]
+    assert [job.name for job in progress.pending(jobs, "stage2")] == ["b"]
+    assert progress.pending(jobs, "postprocess") == []
+    assert progress.is_done(jobs[0], "postprocess")
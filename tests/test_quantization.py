@@ -0,0 +1,51 @@
+import pytest
+import torch
+from torch import nn
+
+from quantization.vq import ResidualVectorQuantizer
+
+N_Q, BINS, DIM = 4, 64, 32
+
+
+@pytest.fixture
+def rvq(randomize_codebooks):
+    torch.manual_seed(0)
+    return randomize_codebooks(ResidualVectorQuantizer(dimension=DIM, n_q=N_Q, bins=BINS)).eval()
+
+
+@pytest.fixture(scope="module")
+def codes():
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(0, BINS, (N_Q, 2, 25), generator=generator)
+
+
+def test_fused_decoder_matches_decode(rvq, codes):
+    with torch.no_grad():
+        expected = rvq.decode(codes)
+        fused = rvq.fused_decoder()(codes)
+    assert fused.shape == expected.shape == (2, DIM, 25)
+    assert expected.abs().max() > 0.1
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def test_fused_decoder_fewer_codebooks(rvq, codes):
+    with torch.no_grad():
+        expected = rvq.decode(codes[:2])
+        fused = rvq.fused_decoder()(codes[:2])
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def test_fused_decoder_folds_in_post(rvq, codes):
+    torch.manual_seed(1)
+    post = nn.Linear(DIM, 16)
+    with torch.no_grad():
+        expected = post(rvq.decode(codes).transpose(1, 2)).transpose(1, 2)
+        fused = rvq.fused_decoder(post)(codes)
+    assert fused.shape == (2, 16, 25)
+    assert torch.allclose(fused, expected, atol=1e-5)
+
+
+def test_fused_decoder_is_not_saved(rvq):
+    decoder = rvq.fused_decoder(nn.Linear(DIM, 16))
+    assert dict(decoder.state_dict()) == {}
+    assert decoder.table.shape == (N_Q * BINS, 16)
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+pytest.importorskip("audiotools")
+pytest.importorskip("dac")
+from models.soundstream_hubert_new import SoundStreamDecoder  # noqa: E402
+
+HOP = 320
+
+
+@pytest.fixture(scope="module")
+def random_codes():
+    generator = torch.Generator().manual_seed(0)
+    # (n_q, batch, frames), 3s of 50 Hz frames
+    return torch.randint(0, 1024, (8, 1, 150), generator=generator)
+
+
+@pytest.fixture
+def codec(randomize_codebooks):
+    torch.manual_seed(0)
+    return randomize_codebooks(SoundStreamDecoder(D=64)).eval()
+
+
+def test_decode_chunked_matches_decode(codec, random_codes):
+    with torch.no_grad():
+        full = codec.decode(random_codes)
+    chunked = codec.decode_chunked(random_codes, chunk_frames=40, context_frames=16)
+    assert chunked.shape == full.shape == (1, 1, 150 * HOP)
+    assert full.abs().max() > 1e-3
+    assert torch.allclose(chunked, full, atol=1e-4)
+
+
+def test_decode_chunked_without_enough_context_differs(codec, random_codes):
+    # The decoder sees about 11 frames on each side, chunks without context show seams
+    with torch.no_grad():
+        full = codec.decode(random_codes)
+    chunked = codec.decode_chunked(random_codes, chunk_frames=40, context_frames=0)
+    assert not torch.allclose(chunked, full, atol=1e-4)
+
+
+def test_decode_chunked_short_codes_use_decode(codec, random_codes):
+    codes = random_codes[..., :40]
+    with torch.no_grad():
+        full = codec.decode(codes)
+    assert torch.equal(codec.decode_chunked(codes, chunk_frames=40), full)
+
+
+def test_fused_quantizer_matches_decode(codec, random_codes):
+    with torch.no_grad():
+        expected = codec.decode(random_codes)
+        expected_embed = codec.get_embed(random_codes)
+        codec.fuse_quantizer()
+        fused = codec.decode(random_codes)
+        fused_embed = codec.get_embed(random_codes)
+    assert torch.allclose(fused_embed, expected_embed, atol=1e-5)
+    assert torch.allclose(fused, expected, atol=1e-4)
+    assert torch.allclose(codec.decode_chunked(random_codes, 40, 16), expected, atol=1e-4)
@@ -0,0 +1,210 @@
+import pytest
+import torch
+
+from stage1_engine import MASKED, Stage1Engine, Stage1Job, _Slot, plan_page_len
+
+MAX_NEW_TOKENS = 16
+
+
+class FakeCache:
+    """The part of an ExLlamaV2 cache the engine's bookkeeping touches."""
+
+    def __init__(self, model, batch_size: int, max_seq_len: int):
+        self.max_seq_len = max_seq_len
+        self.current_seq_len = 0
+        self.key_states = [torch.zeros((batch_size, max_seq_len, 2))]
+        self.value_states = [torch.zeros((batch_size, max_seq_len, 2))]
+
+
+@pytest.fixture
+def engine():
+    return Stage1Engine(
+        model=None,
+        cache_class=FakeCache,
+        sampler=None,
+        eoa_id=0,
+        logits_begin=0,
+        logits_end=10,
+        max_rows=4,
+        page_len=64,
+        max_new_tokens=MAX_NEW_TOKENS,
+    )
+
+
+def song(engine: Stage1Engine, tag: int, page_len: int, cfg: bool) -> _Slot:
+    """A prefilled song whose page holds tag * 100 + position in every row."""
+    job = Stage1Job(f"song{tag}", [[1]], guidance_scale_seg0=1.5 if cfg else None)
+    page = FakeCache(None, job.n_rows, 64)
+    for t in page.key_states + page.value_states:
+        t[:, :page_len] = tag * 100 + torch.arange(page_len, dtype=torch.float)[None, :, None]
+    page.current_seq_len = page_len
+    slot = _Slot(job, page, 64 - MAX_NEW_TOKENS - 1, engine.device)
+    slot.ctx = torch.zeros((1, page_len), dtype=torch.long)
+    slot.page_len = page_len
+    slot.uncond_from = page_len - 1
+    return slot
+
+
+def batch(engine: Stage1Engine, row: int) -> torch.Tensor:
+    return engine.cache.key_states[0][row, : engine.cache.current_seq_len, 0]
+
+
+def visible(engine: Stage1Engine, row: int) -> list:
+    """Columns row attends to, up to the current length of the batch."""
+    mask = engine.mask[row, : engine.cache.current_seq_len]
+    return torch.nonzero(mask == 0).flatten().tolist()
+
+
+def decode(engine: Stage1Engine, n_steps: int, value: float = -1.0):
+    """Write n_steps columns to every row like batched decode steps."""
+    for _ in range(n_steps):
+        seq_len = engine.cache.current_seq_len
+        for t in engine.cache.key_states + engine.cache.value_states:
+            t[:, seq_len] = value
+        engine.cache.current_seq_len += 1
+        for slot in engine.active:
+            slot.ctx = torch.cat((slot.ctx, torch.zeros((1, 1), dtype=torch.long)), dim=-1)
+
+
+def page(slot: _Slot) -> torch.Tensor:
+    return slot.page.key_states[0][:, : slot.page.current_seq_len, 0]
+
+
+def test_enter_right_aligns_pages(engine):
+    a = song(engine, 1, 10, cfg=True)
+    b = song(engine, 2, 6, cfg=False)
+    engine._enter(a, 0)
+    engine._enter(b, 2)
+
+    assert engine.cache.current_seq_len == 10
+    assert (a.row, a.start, b.row, b.start) == (0, 0, 2, 4)
+    assert batch(engine, 0).tolist() == [100 + i for i in range(10)]
+    assert batch(engine, 2)[4:].tolist() == [200 + i for i in range(6)]
+    # The CFG row only sees the segment's last prompt token, positions start at 0 in each row
+    assert visible(engine, 0) == list(range(10))
+    assert visible(engine, 1) == [9]
+    assert visible(engine, 2) == list(range(4, 10))
+    assert visible(engine, 3) == []
+    assert engine.offsets.flatten().tolist() == [0, -9, -4, 0]
+    assert engine.rows == [a, a, b, None]
+
+
+def test_longer_page_shifts_the_batch(engine):
+    a = song(engine, 1, 10, cfg=True)
+    b = song(engine, 2, 6, cfg=False)
+    engine._enter(a, 0)
+    engine._enter(b, 2)
+    decode(engine, 3)
+
+    c = song(engine, 3, 20, cfg=False)
+    engine._enter(c, 3)
+
+    assert engine.cache.current_seq_len == 20
+    assert (a.start, b.start, c.start) == (7, 11, 0)
+    assert batch(engine, 0)[7:].tolist() == [100 + i for i in range(10)] + [-1] * 3
+    assert batch(engine, 2)[11:].tolist() == [200 + i for i in range(6)] + [-1] * 3
+    assert batch(engine, 3).tolist() == [300 + i for i in range(20)]
+    assert visible(engine, 0) == list(range(7, 20))
+    assert visible(engine, 1) == list(range(16, 20))
+    assert engine.offsets.flatten().tolist() == [-7, -16, -11, 0]
+
+
+def test_song_leaves_mid_batch(engine):
+    a = song(engine, 1, 10, cfg=True)
+    b = song(engine, 2, 6, cfg=False)
+    c = song(engine, 3, 8, cfg=False)
+    engine._enter(a, 0)
+    engine._enter(b, 2)
+    engine._enter(c, 3)
+    decode(engine, 4)
+
+    engine._copy_back(b)
+    engine._leave(b)
+
+    # b's page holds its prompt and the 4 decoded tokens, ready for its next segment
+    assert b.page_len == b.page.current_seq_len == 10
+    assert page(b).tolist() == [[200 + i for i in range(6)] + [-1] * 4]
+    assert b.row is None and engine.active == [a, c]
+    assert engine.rows == [a, a, None, c]
+    assert visible(engine, 2) == [] and engine.offsets[2].item() == 0
+    # The songs that stay keep their rows, offsets and cache columns
+    assert (a.start, c.start) == (0, 2)
+    assert engine.offsets.flatten().tolist() == [0, -9, 0, -2]
+    assert batch(engine, 0).tolist() == [100 + i for i in range(10)] + [-1] * 4
+    assert batch(engine, 3)[2:].tolist() == [300 + i for i in range(8)] + [-1] * 4
+    assert engine._find_rows(1) == 2
+    assert engine._find_rows(2) is None
+
+    # b re-enters with its longer page in the free row
+    decode(engine, 2)
+    b.ctx = torch.zeros((1, b.page_len), dtype=torch.long)
+    engine._enter(b, engine._find_rows(1))
+    assert (b.row, b.start) == (2, 6)
+    assert batch(engine, 2)[6:].tolist() == [200 + i for i in range(6)] + [-1] * 4
+    assert engine.offsets[2].item() == -6
+
+
+def test_compact_drops_columns_left_of_every_song(engine):
+    a = song(engine, 1, 10, cfg=True)
+    c = song(engine, 3, 20, cfg=False)
+    engine._enter(c, 3)
+    decode(engine, 5)
+    engine._enter(a, 0)  # starts at 15
+    engine._leave(c)
+
+    engine._compact()
+
+    assert engine.cache.current_seq_len == 10
+    assert a.start == 0
+    assert batch(engine, 0).tolist() == [100 + i for i in range(10)]
+    assert visible(engine, 0) == list(range(10))
+    assert visible(engine, 1) == [9]
+    assert engine.offsets.flatten().tolist() == [0, -9, 0, 0]
+    # Columns freed on the right are open to the songs that stay, for their next tokens
+    assert (engine.mask[0:2, 10:] == 0).all()
+    assert (engine.mask[2:, :] == MASKED).all()
+
+
+def test_last_song_leaving_rewinds_the_batch(engine):
+    a = song(engine, 1, 10, cfg=True)
+    engine._enter(a, 0)
+    decode(engine, 3)
+    engine._leave(a)
+    assert engine.cache.current_seq_len == 0
+    assert engine.rows == [None] * 4
+
+
+def test_get_page_reuses_the_smallest_free_page_that_fits(engine):
+    small, large = FakeCache(None, 2, 256), FakeCache(None, 2, 512)
+    large.current_seq_len = 100
+    engine.free_pages[2] = [large, small]
+
+    assert engine._get_page(2, 200) is small
+    page = engine._get_page(2, 300)
+    assert page is large and page.current_seq_len == 0
+    assert engine.free_pages[2] == []
+
+
+def test_get_page_drops_a_free_page_that_is_too_small(engine):
+    engine.free_pages[1] = [FakeCache(None, 1, 256)]
+    page = engine._get_page(1, 512)
+    assert page.max_seq_len == 512
+    assert engine.free_pages[1] == []
+
+
+def test_plan_page_len():
+    job = Stage1Job("song", [[1] * 50, [1] * 20], prefix=[1] * 100)
+    # prefix + (prompt + max_new_tokens + 1) per segment = 100 + 67 + 37
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 256) == 256
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 64) == 256
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 1) == 204
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 0) == 1024
+    assert plan_page_len(job, MAX_NEW_TOKENS, 200, 64) == 200
+
+
+def test_plan_page_len_counts_at_most_one_window_of_prefix():
+    job = Stage1Job("song", [[1] * 10], prefix=[1] * 5000)
+    # The prefix is cut to the page's max context, 1024 - 16 - 1 tokens
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 1) == 1024
+    job.segment_prompts = []
+    assert plan_page_len(job, MAX_NEW_TOKENS, 1024, 1) == 1007
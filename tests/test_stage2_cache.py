@@ -0,0 +1,123 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from stage2_cache import Stage2ResultCache, model_fingerprint
+
+
+def codec_ids(seed: int, n_frames: int = 10) -> np.ndarray:
+    return np.random.default_rng(seed).integers(45334, 46358, (1, n_frames))
+
+
+def codes(seed: int, n_frames: int = 10) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 1024, (8, n_frames))
+
+
+def entry_bytes(tmp_path) -> int:
+    """Size of the .npy file of one (8, 10) entry."""
+    cache = Stage2ResultCache(str(tmp_path / "probe"), "model", 2**30)
+    cache.put(codec_ids(0), codes(0))
+    return cache.total_bytes
+
+
+@pytest.fixture
+def model_args(tmp_path):
+    model = tmp_path / "s2.gguf"
+    model.write_bytes(b"weights")
+    return SimpleNamespace(
+        stage2_use_exl2=False,
+        stage2_use_gguf=True,
+        stage2_cache_mode="FP16",
+        stage2_model=str(model),
+    )
+
+
+def test_round_trip(tmp_path):
+    cache = Stage2ResultCache(str(tmp_path), "model", 2**30)
+    assert cache.get(codec_ids(0)) is None
+
+    cache.put(codec_ids(0), codes(0))
+    path = cache.path(cache.key(codec_ids(0)))
+    assert np.load(path).dtype == np.uint16
+    np.testing.assert_array_equal(cache.get(codec_ids(0)), codes(0))
+
+    # A later run over the same directory reads the entry back
+    reopened = Stage2ResultCache(str(tmp_path), "model", 2**30)
+    np.testing.assert_array_equal(reopened.get(codec_ids(0)), codes(0))
+    assert reopened.total_bytes == os.path.getsize(path)
+
+
+def test_invalid_codes_are_not_stored(tmp_path):
+    cache = Stage2ResultCache(str(tmp_path), "model", 2**30)
+    bad = codes(0)
+    bad[3, 4] = 1024
+    cache.put(codec_ids(0), bad)
+    assert cache.get(codec_ids(0)) is None
+    assert cache.total_bytes == 0
+
+
+def test_key_changes_with_codebook_0_frames(tmp_path):
+    cache = Stage2ResultCache(str(tmp_path), "model", 2**30)
+    ids = codec_ids(0)
+    changed = ids.copy()
+    changed[0, -1] += 1
+    assert cache.key(changed) != cache.key(ids)
+    assert cache.key(ids[:, :-1]) != cache.key(ids)
+
+    cache.put(ids, codes(0))
+    assert cache.get(changed) is None
+
+
+def test_key_changes_with_model_fingerprint(tmp_path, model_args):
+    fingerprint = model_fingerprint(model_args)
+    assert model_fingerprint(model_args) == fingerprint
+    for changes in [{"stage2_cache_mode": "Q8"}, {"stage2_use_gguf": False}]:
+        assert model_fingerprint(SimpleNamespace(**{**vars(model_args), **changes})) != fingerprint
+
+    # A re-converted model file of the same name
+    stat = os.stat(model_args.stage2_model)
+    os.utime(model_args.stage2_model, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert model_fingerprint(model_args) != fingerprint
+
+    cache = Stage2ResultCache(str(tmp_path / "cache"), fingerprint, 2**30)
+    cache.put(codec_ids(0), codes(0))
+    other = Stage2ResultCache(str(tmp_path / "cache"), model_fingerprint(model_args), 2**30)
+    assert other.key(codec_ids(0)) != cache.key(codec_ids(0))
+    assert other.get(codec_ids(0)) is None
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = Stage2ResultCache(str(tmp_path / "cache"), "model", 2 * entry_bytes(tmp_path))
+    cache.put(codec_ids(0), codes(0))
+    cache.put(codec_ids(1), codes(1))
+    assert cache.get(codec_ids(0)) is not None  # 1 is now the least recently used
+
+    cache.put(codec_ids(2), codes(2))
+    assert cache.get(codec_ids(1)) is None
+    assert not os.path.exists(cache.path(cache.key(codec_ids(1))))
+    assert cache.get(codec_ids(0)) is not None
+    assert cache.get(codec_ids(2)) is not None
+
+
+def test_evicts_by_mtime_when_opened(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = Stage2ResultCache(cache_dir, "model", 2**30)
+    for seed in range(3):
+        cache.put(codec_ids(seed), codes(seed))
+    # Entry 1 was used last and entry 2 first, whatever the order they were written in
+    for seed, mtime in [(2, 1), (0, 2), (1, 3)]:
+        os.utime(cache.path(cache.key(codec_ids(seed))), ns=(mtime * 10**9, mtime * 10**9))
+
+    reopened = Stage2ResultCache(cache_dir, "model", 2 * entry_bytes(tmp_path))
+    assert reopened.get(codec_ids(2)) is None
+    assert reopened.get(codec_ids(0)) is not None
+    assert reopened.get(codec_ids(1)) is not None
+
+
+def test_keeps_the_newest_entry_over_the_limit(tmp_path):
+    cache = Stage2ResultCache(str(tmp_path), "model", 1)
+    cache.put(codec_ids(0), codes(0))
+    cache.put(codec_ids(1), codes(1))
+    assert cache.get(codec_ids(0)) is None
+    np.testing.assert_array_equal(cache.get(codec_ids(1)), codes(1))
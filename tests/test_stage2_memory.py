@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+import stage2_memory
+from infer_stage2 import Stage2Pipeline, Stage2Pipeline_HF, Stage2Window
+from stage2_memory import CACHE_MODE_BYTES, Stage2MemoryModel, memory_budget
+
+CONFIG = SimpleNamespace(
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    hidden_size=64,
+    intermediate_size=128,
+    vocab_size=1000,
+)
+
+
+def memory_model(cache_mode: str = "FP16") -> Stage2MemoryModel:
+    return Stage2MemoryModel.from_config(CONFIG, CACHE_MODE_BYTES[cache_mode], 2)
+
+
+class PlannedPipeline(Stage2Pipeline):
+    """Stage2Pipeline without a model, sized by a memory model and an injected budget."""
+
+    def __init__(self, memory_model: Stage2MemoryModel, memory_budget: int):
+        super().__init__(torch.device("cpu"))
+        self.memory_model = memory_model
+        self.memory_budget = memory_budget
+
+    def max_batch_size(self, n_frames: int) -> int:
+        return self.memory_model.max_batch_size(n_frames, self.memory_budget)
+
+
+def test_from_config_defaults_head_dim_and_kv_heads():
+    config = SimpleNamespace(**{**vars(CONFIG), "num_key_value_heads": None})
+    model = Stage2MemoryModel.from_config(config, 2.0, 2)
+    assert model.n_kv_heads == 4
+    assert model.head_dim == 16
+
+
+def test_row_bytes():
+    model = memory_model()
+    # K and V of 2 layers, 2 kv heads of 16 values at 2 bytes
+    assert model.cache_bytes_per_token() == 256
+    # 300 frames: align(3 + 2700, 32) = 2720 cache tokens, a 304 token prompt
+    cache = 2720 * 256
+    activations = (304 * (4 * 64 + 3 * 128) + 4 * 304 * 304) * 2
+    logits = 1000 * 4
+    assert model.row_bytes(300) == cache + activations + logits
+
+
+def test_quantized_cache_modes_need_less_per_row():
+    rows = [memory_model(mode).row_bytes(300) for mode in ["FP16", "Q8", "Q6", "Q4"]]
+    assert rows == sorted(rows, reverse=True)
+
+
+def test_max_batch_size():
+    model = memory_model()
+    row = model.row_bytes(300)
+    assert model.max_batch_size(300, 3 * row) == 3
+    assert model.max_batch_size(300, 4 * row - 1) == 3
+    # A window that doesn't fit still gets a batch of its own
+    assert model.max_batch_size(300, row // 2) == 1
+    assert model.max_batch_size(100, 3 * row) > 3
+
+
+def test_memory_budget_override():
+    device = torch.device("cpu")
+    assert memory_budget(device, memory_gb=2.0) == 2 * 2**30
+    assert memory_budget(device, memory_gb=2.0, share=0.5) == 2**30
+
+
+def test_memory_budget_free_cpu_memory(monkeypatch):
+    available = 10 * 2**30
+    monkeypatch.setattr(
+        stage2_memory.psutil, "virtual_memory", lambda: SimpleNamespace(available=available)
+    )
+    device = torch.device("cpu")
+    assert memory_budget(device) == int(available * 0.9)
+    assert memory_budget(device, share=0.5) == int(available * 0.9 * 0.5)
+
+
+@pytest.mark.parametrize("rows, sizes", [(1, [1] * 15 + [3]), (3, [3] * 6), (8, [6, 6, 6])])
+def test_batches_fit_an_injected_budget(rows, sizes):
+    model = memory_model()
+    budget = rows * model.row_bytes(300)
+    pipeline = PlannedPipeline(model, budget)
+    windows = [
+        Stage2Window(song_idx, 0, seg_idx, torch.zeros((1, 300 if seg_idx < 5 else 120)))
+        for song_idx in range(3)
+        for seg_idx in range(6)
+    ]
+    batches = pipeline.plan_batches(windows)
+
+    assert sum(len(batch) for batch in batches) == len(windows)
+    for batch in batches:
+        assert len(batch) * model.row_bytes(batch[0].n_frames) <= budget
+    # 15 full windows and 3 tails of 120 frames, a third of a full row each,
+    # spread evenly over the batches; tails left alone share a bigger batch
+    assert [len(batch) for batch in batches] == sizes
+
+
+def test_hf_batch_size_overrides_the_memory_model():
+    pipeline = Stage2Pipeline_HF.__new__(Stage2Pipeline_HF)
+    pipeline.memory_model = memory_model()
+    pipeline.memory_budget = 5 * pipeline.memory_model.row_bytes(300)
+
+    pipeline.batch_size = 4
+    assert pipeline.max_batch_size(300) == 4
+    assert pipeline.max_batch_size(10) == 4
+    pipeline.batch_size = 0
+    assert pipeline.max_batch_size(300) == 5